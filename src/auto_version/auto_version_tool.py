@@ -13,27 +13,58 @@ https://github.com/javrasya/version-manager
 
 """
 import ast
+import concurrent.futures
+import contextlib
+import fnmatch
 import glob
+import hashlib
+import inspect
+import json
+import locale
 import logging
+import mmap
 import os
 import pprint
 import re
-import shlex
+import shutil
 import subprocess
+import sys
+import time
 import warnings
 
 import semver
+import toml
 from auto_version import __version__
+from auto_version import cache
 from auto_version import definitions
+from auto_version import key_index
+from auto_version import processes
+from auto_version import scanners
+from auto_version import tag_router
 from auto_version import utils
+from auto_version import vcs
+from auto_version import watch
 from auto_version.cli import get_cli
 from auto_version.config import AutoVersionConfig as config
 from auto_version.config import Constants
 from auto_version.config import get_or_create_config
+from auto_version.config import get_settings
+from auto_version.config import set_settings
 from auto_version.replacement_handler import ReplacementHandler
+from auto_version.version_engine import VersionRecord
 
 _LOG = logging.getLogger(__file__)
 
+TAG_OUTPUT_CHUNK_SIZE = 1 << 16
+READ_BACKWARDS_CHUNK_SIZE = 1 << 16
+PARALLEL_SCAN_MIN_CHUNK_SIZE = 1 << 20
+# most trigger detection results kept in the cache
+TRIGGER_CACHE_SIZE = 32
+# most commit counts kept in the cache
+COMMIT_COUNT_CACHE_SIZE = 256
+# version of the format of plans made by `make_plan`
+PLAN_FORMAT = 1
+
 
 def replace_lines(regexer, handler, lines):
     """Uses replacement handler to perform replacements on lines of text
@@ -55,118 +86,695 @@ def replace_lines(regexer, handler, lines):
     return result
 
 
+def find_replacements(regexer, handler, text):
+    """Finds the replacements to make in a whole text buffer
+
+    Equivalent to `replace_lines` on each line of the text, but a single search over
+    the whole buffer finds the lines containing one of the handler's keys, and only those
+    lines are stripped and run through the regex.
+
+    :returns: list of (start, end, replacement line) for each line that changes
+    """
+    changes = []
+    line_end = -1
+    for match in handler.key_finder.finditer(text):
+        if match.start() < line_end:
+            # we've already tried this line
+            continue
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        line_end = text.find("\n", match.end())
+        if line_end < 0:
+            line_end = len(text)
+        line = text[line_start:line_end]
+        content = line.strip()
+        try:
+            replaced = regexer.sub(handler, content)
+        except KeyError:
+            continue
+        replaced_line = line.replace(content, replaced, 1)
+        if replaced_line != line:
+            changes.append((line_start, line_end, replaced_line))
+    return changes
+
+
+def find_indexed_replacements(handler, text, definitions):
+    """Finds the replacements to make, from where the key index recorded the keys
+
+    Rather than searching the text, only the lines the index records as defining one of the
+    handler's keys are found, and the recorded span of each value is replaced.
+
+    :param definitions: the key definitions of the text, as from `KeyIndex.definitions`
+    :returns: list of (start, end, replacement line) as from `find_replacements`,
+        or None if the text doesn't hold a value where it was recorded
+    """
+    changes = []
+    line_start = 0
+    line_index = 0
+    for key, defined_at, start, end, value in definitions:
+        if key not in handler.params:
+            continue
+        while line_index < defined_at:
+            line_start = text.find("\n", line_start) + 1
+            if not line_start:
+                return None
+            line_index += 1
+        line_end = text.find("\n", line_start)
+        if line_end < 0:
+            line_end = len(text)
+        line = text[line_start:line_end]
+        if start < 0:
+            # no value, so it's inserted after the content of the line (as the handler does)
+            start = end = len(line.rstrip())
+        elif line[start:end] != value:
+            return None
+        handler.missing.discard(key)
+        replaced_line = "".join([line[:start], str(handler.params[key]), line[end:]])
+        if replaced_line != line:
+            changes.append((line_start, line_end, replaced_line))
+    return changes
+
+
+def apply_replacements(text, changes):
+    """Builds the replaced text from slices of the original around each change"""
+    parts = []
+    position = 0
+    for start, end, replacement in changes:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def replace_text(regexer, handler, text):
+    """Uses replacement handler to perform replacements on a whole text buffer"""
+    return apply_replacements(text, find_replacements(regexer, handler, text))
+
+
+def get_patches(text, changes, encoding):
+    """The byte ranges to overwrite to make some changes, if none of them change length
+
+    :param changes: list of (start, end, replacement) as from `find_replacements`
+    :returns: list of (byte offset, bytes), or None if any change alters the length
+    """
+    patches = []
+    offset = 0
+    position = 0
+    for start, end, replacement in changes:
+        original = text[start:end]
+        # only the part of the line that differs needs to be written
+        prefix = len(os.path.commonprefix([original, replacement]))
+        suffix = len(
+            os.path.commonprefix([original[prefix:][::-1], replacement[prefix:][::-1]])
+        )
+        old = original[prefix:len(original) - suffix].encode(encoding)
+        new = replacement[prefix:len(replacement) - suffix].encode(encoding)
+        if len(old) != len(new):
+            return None
+        offset += len(text[position:start + prefix].encode(encoding))
+        patches.append((offset, new))
+        offset += len(old)
+        position = start + len(original) - suffix
+    return patches
+
+
+def write_patches(path, patches):
+    """Overwrites byte ranges of an existing file, leaving the rest untouched"""
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for offset, data in patches:
+            while data:
+                written = os.pwrite(fd, data, offset)
+                offset += written
+                data = data[written:]
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_replace(path, mode="w"):
+    """Opens a temporary file, which replaces the file at `path` in one step when closed
+
+    So a reader never sees the file partially written.
+    """
+    path = os.path.realpath(path)
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        with open(temp_path, mode) as fh:
+            yield fh
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_atomic(path, text):
+    """Replaces a file in one step, so a reader never sees it partially written"""
+    with atomic_replace(path) as fh:
+        fh.write(text)
+
+
+def get_chunks(data, chunk_size):
+    """Splits a buffer into chunks that end at line boundaries
+
+    :returns: list of (start, end) byte offsets
+    """
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start + chunk_size - 1)
+        end = len(data) if end < 0 else end + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def scan_chunk(path, start, end, regexer, params, encoding):
+    """Finds the replacements to make in one chunk of a file (in a worker process)
+
+    The file is mapped into memory rather than passed to the worker, so it isn't copied.
+
+    :returns: list of (start, end, replacement) byte ranges of changed lines, and the keys replaced
+    """
+    with open(path, "rb") as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode(encoding)
+    handler = ReplacementHandler(**params)
+    changes = []
+    offset = start
+    position = 0
+    for line_start, line_end, replacement in find_replacements(regexer, handler, text):
+        offset += len(text[position:line_start].encode(encoding))
+        original = text[line_start:line_end].encode(encoding)
+        changes.append((offset, offset + len(original), replacement.encode(encoding)))
+        offset += len(original)
+        position = line_end
+    return changes, set(params) - handler.missing
+
+
+def write_target_parallel(target, regexer, handler, encoding):
+    """Writes replacements into a huge target, scanning chunks of it in parallel processes
+
+    :returns: True if the target was changed
+    """
+    with open(target, "rb") as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk_size = max(
+                len(data) // ((config.PARALLEL_SCAN_WORKERS or os.cpu_count()) * 4),
+                PARALLEL_SCAN_MIN_CHUNK_SIZE,
+            )
+            chunks = get_chunks(data, chunk_size)
+            _LOG.debug("scanning %s in %s chunks", target, len(chunks))
+            changes = []
+            with concurrent.futures.ProcessPoolExecutor(
+                config.PARALLEL_SCAN_WORKERS or None
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        scan_chunk,
+                        target,
+                        start,
+                        end,
+                        regexer,
+                        handler.params,
+                        encoding,
+                    )
+                    for start, end in chunks
+                ]
+                for future in futures:
+                    chunk_changes, replaced = future.result()
+                    changes.extend(chunk_changes)
+                    handler.missing.difference_update(replaced)
+            if not changes:
+                return False
+            if hasattr(os, "pwrite") and all(
+                len(new) == end - start for start, end, new in changes
+            ):
+                patches = []
+                for start, end, new in changes:
+                    prefix = len(os.path.commonprefix([data[start:end], new]))
+                    patches.append((start + prefix, new[prefix:]))
+                write_patches(target, patches)
+                return True
+            with atomic_replace(target, "wb") as out:
+                position = 0
+                for start, end, new in changes:
+                    out.write(data[position:start])
+                    out.write(new)
+                    position = end
+                out.write(data[position:])
+    return True
+
+
+def can_scan_in_parallel(target, encoding):
+    """Whether a target can be split into chunks at byte-level line boundaries"""
+    if "\n".encode(encoding) != b"\n":
+        return False
+    with open(target, "rb") as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # other line endings would be converted when written, which needs the whole text
+            return data.find(b"\r") < 0
+
+
+def write_target(target, regexer, handler, definitions=None):
+    """Writes replacements into a single target
+
+    If every replacement keeps its length (e.g. 1.2.3 -> 1.2.4) only the changed bytes are
+    written, in place. Otherwise the file is rewritten atomically.
+
+    :param definitions: where the key index recorded the keys of the target, so they
+        don't need to be searched for
+    :returns: True if the target was changed
+    """
+    # as used when opening in text mode
+    encoding = locale.getpreferredencoding(False)
+    if definitions is not None:
+        _, text, in_place = read_target(target, encoding)
+        changes = find_indexed_replacements(handler, text, definitions)
+        if changes is None:
+            _LOG.debug("%s has changed since it was indexed, so is searched", target)
+            changes = find_replacements(regexer, handler, text)
+        if not changes:
+            return False
+        write_changes(target, text, changes, in_place, encoding)
+        return True
+    if (
+        config.PARALLEL_SCAN_THRESHOLD
+        and os.path.getsize(target) >= config.PARALLEL_SCAN_THRESHOLD
+        and can_scan_in_parallel(target, encoding)
+    ):
+        return write_target_parallel(target, regexer, handler, encoding)
+    _, text, in_place = read_target(target, encoding)
+    changes = find_replacements(regexer, handler, text)
+    if not changes:
+        return False
+    write_changes(target, text, changes, in_place, encoding)
+    return True
+
+
+def read_target(target, encoding):
+    """Reads a target as the text that replacements are found in
+
+    :returns: the bytes read, the text, and whether it can be patched in place
+    """
+    with open(target, "rb") as fh:
+        data = fh.read()
+    text = data.decode(encoding)
+    # patching in place relies on text and byte offsets corresponding, so needs unix line endings
+    # (and an encoding where pieces of the text encode independently)
+    in_place = (
+        "\r" not in text and "\n".encode(encoding) == b"\n" and hasattr(os, "pwrite")
+    )
+    if not in_place:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return data, text, in_place
+
+
+def write_changes(target, text, changes, in_place, encoding):
+    """Writes changes (as from `find_replacements`) to the text read from a target"""
+    patches = get_patches(text, changes, encoding) if in_place else None
+    if patches is not None:
+        _LOG.debug(
+            "patching %s bytes of %s in place", sum(len(p) for _, p in patches), target
+        )
+        write_patches(target, patches)
+    else:
+        write_atomic(target, apply_replacements(text, changes))
+
+
 def write_targets(targets, **params):
-    """Writes version info into version file"""
+    """Writes version info into version file
+
+    Targets are only rewritten if their content changes.
+    With the key index, targets that define none of the keys aren't read, and the others
+    are patched where the index recorded the keys.
+
+    :returns: list of the targets that were written
+    """
     handler = ReplacementHandler(**params)
+    index = key_index.KeyIndex.load() if config.USE_KEY_INDEX else None
+    written = []
     for target, regexer in regexer_for_targets(targets):
-        with open(target) as fh:
-            lines = fh.readlines()
-        lines = replace_lines(regexer, handler, lines)
-        with open(target, "w") as fh:
-            fh.writelines(lines)
+        if index and not index.defines_any(target, handler.params):
+            _LOG.debug("%s defines none of the keys, so isn't read", target)
+            continue
+        definitions = index.definitions(target) if index else None
+        if write_target(target, regexer, handler, definitions):
+            written.append(target)
+    if index:
+        index.save()
+    if handler.missing:
+        raise Exception(
+            "Failed to complete all expected replacements: %r" % handler.missing
+        )
+    return written
+
+
+def plan_targets(targets, **params):
+    """Finds the replacements to make in each target, without writing anything
+
+    :returns: list of dicts of the path, a hash of its content, the encoding and the changes,
+        for the targets that would change
+    """
+    encoding = locale.getpreferredencoding(False)
+    handler = ReplacementHandler(**params)
+    planned = []
+    for target, regexer in regexer_for_targets(targets):
+        data, text, _ = read_target(target, encoding)
+        changes = find_replacements(regexer, handler, text)
+        if changes:
+            planned.append(
+                dict(
+                    path=target,
+                    sha256=hashlib.sha256(data).hexdigest(),
+                    encoding=encoding,
+                    changes=[list(change) for change in changes],
+                )
+            )
     if handler.missing:
         raise Exception(
             "Failed to complete all expected replacements: %r" % handler.missing
         )
+    return planned
+
+
+def apply_targets(planned):
+    """Makes the planned replacements, if none of the targets have changed since
+
+    Every target is checked before any are written.
+
+    :param planned: as from `plan_targets`
+    :returns: list of the targets that were written
+    """
+    loaded = []
+    for entry in planned:
+        data, text, in_place = read_target(entry["path"], entry["encoding"])
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError("%s has changed since the plan was made" % entry["path"])
+        loaded.append((entry, text, in_place))
+    for entry, text, in_place in loaded:
+        changes = [tuple(change) for change in entry["changes"]]
+        write_changes(entry["path"], text, changes, in_place, entry["encoding"])
+    return [entry["path"] for entry in planned]
 
 
 def regexer_for_targets(targets):
-    """Pairs up target files with their correct regex"""
+    """Pairs up target files with their correct regex
+
+    The built-in regexes are swapped for their equivalent linear time scanners
+    """
     for target in targets:
         path, file_ext = os.path.splitext(target)
-        regexer = config.regexers[file_ext]
+        regexer = scanners.for_extension(file_ext, config.regexers[file_ext])
         yield target, regexer
 
 
-def extract_keypairs(lines, regexer):
-    """Given some lines of text, extract key-value pairs from them"""
+def extract_keypairs(lines, regexer, keys=None, first_wins=False):
+    """Given some lines of text, extract key-value pairs from them
+
+    :param keys: the keys we're looking for. With `first_wins`, we stop reading lines
+                as soon as all of them are found, as no later line can change their values
+    :param first_wins: keep the first value found for each key, rather than the last
+    """
     updates = {}
+    remaining = set(keys) if keys is not None else None
     for line in lines:
         # for consistency we must match the replacer and strip whitespace / newlines
         match = regexer.match(line.strip())
         if not match:
             continue
         k_v = match.groupdict()
-        updates[k_v[Constants.KEY_GROUP]] = k_v[Constants.VALUE_GROUP]
+        key = k_v[Constants.KEY_GROUP]
+        if first_wins:
+            updates.setdefault(key, k_v[Constants.VALUE_GROUP])
+        else:
+            updates[key] = k_v[Constants.VALUE_GROUP]
+        if remaining is not None:
+            remaining.discard(key)
+            if first_wins and not remaining:
+                break
     return updates
 
 
-def read_targets(targets):
-    """Reads generic key-value pairs from input files"""
+def read_lines_backwards(path, encoding, chunk_size=READ_BACKWARDS_CHUNK_SIZE):
+    """The lines of a file (without their line endings), last first
+
+    Equivalent to `reversed(fh.readlines())` on the file opened as text, but the file is
+    read in chunks from the end, so only a chunk and the line spanning its start are held
+    at once.
+    """
+    if "\n".encode(encoding) != b"\n":
+        # lines can't be split on the raw bytes
+        with open(path, encoding=encoding) as fh:
+            lines = fh.read().split("\n")
+        if not lines[-1]:
+            lines.pop()
+        for line in reversed(lines):
+            yield line
+        return
+
+    def split(piece, at_end):
+        # pieces are followed by a "\n" (so may end with the "\r" of a "\r\n") unless at the end
+        text = piece.decode(encoding)
+        if not at_end and text.endswith("\r"):
+            text = text[:-1]
+        lines = text.split("\r")
+        if at_end and not lines[-1]:
+            lines.pop()
+        return reversed(lines)
+
+    with open(path, "rb") as fh:
+        position = fh.seek(0, os.SEEK_END)
+        remainder = b""
+        at_end = True
+        while position:
+            size = min(chunk_size, position)
+            position -= size
+            fh.seek(position)
+            pieces = (fh.read(size) + remainder).split(b"\n")
+            # the first piece may be the end of a line that starts in an earlier chunk
+            remainder = pieces.pop(0)
+            for piece in reversed(pieces):
+                for line in split(piece, at_end):
+                    yield line
+                at_end = False
+        for line in split(remainder, at_end):
+            yield line
+
+
+def read_targets(targets, keys=None):
+    """Reads generic key-value pairs from input files
+
+    :param keys: the keys we need. If given, we stop reading as soon as they have all been found.
+    Where a key is defined more than once, the first or last definition is used (as configured),
+    so we search in the order that finds the winning definitions first.
+    """
+    last_wins = config.KEY_PRECEDENCE != Constants.FIRST_WINS
+    encoding = locale.getpreferredencoding(False)
+    remaining = set(keys) if keys is not None else None
     results = {}
-    for target, regexer in regexer_for_targets(targets):
-        with open(target) as fh:
-            results.update(extract_keypairs(fh.readlines(), regexer))
+    index = key_index.KeyIndex.load() if config.USE_KEY_INDEX else None
+    for target, regexer in regexer_for_targets(
+        reversed(targets) if last_wins else targets
+    ):
+        if index:
+            found = index.keypairs(target, keys=remaining, last_wins=last_wins)
+        else:
+            with contextlib.closing(
+                read_lines_backwards(target, encoding) if last_wins else open(target)
+            ) as lines:
+                found = extract_keypairs(
+                    lines, regexer, keys=remaining, first_wins=True
+                )
+        for key, value in found.items():
+            results.setdefault(key, value)
+        if remaining is not None:
+            remaining.difference_update(found)
+            if not remaining:
+                _LOG.debug("found all keys, without reading further targets")
+                break
+    if index:
+        index.save()
     _LOG.debug("found the following key-value pairs in source: %r", results)
     return results
 
 
 def detect_file_triggers(release_commit):
     """The existence of files matching configured globs will trigger a version bump"""
+    if config.CACHE_TRIGGERS:
+        return detect_file_triggers_cached(release_commit)
+    return find_file_triggers(release_commit)
+
+
+def find_file_triggers(release_commit):
+    """Checks every trigger pattern for files
+
+    :return: set of triggers, set of trigger files
+    """
     all_valid_trigger_files = set()
     triggers = set()
     for pattern, trigger in config.trigger_patterns.items():
-        matches = glob.glob(pattern)
-
-        if matches:
-            valid_news = set(matches)
-            if release_commit:
-                # if we have a specific release commit, we will additionally filter
-                # to ensure that only files that were added since that commit are considered
-                # this allows the project to retain newsfiles for all time, rather than having to delete them
-
-                # fortunately, git filter syntax is compatible with the glob syntax we're already using
-                git_response = (
-                    subprocess.check_output(
-                        [
-                            "git",
-                            "diff",
-                            "--relative",
-                            "--name-status",
-                            release_commit,
-                            "HEAD",
-                            "--diff-filter",
-                            "A",
-                            pattern,
-                        ]
-                    )
-                    .decode("utf8")
-                    .strip()
-                    .splitlines()
-                )
-                file_paths = [path.split()[1].strip() for path in git_response]
-                _LOG.debug("trigger: added since last release: %r", file_paths)
-                valid_news.intersection_update(set(file_paths))
-
-            # perform the additional filtering
-            if valid_news:
-                _LOG.debug(
-                    "trigger: %s bump from %r\n\t%s", trigger, pattern, valid_news
-                )
-                triggers.add(trigger)
-                all_valid_trigger_files.update(valid_news)
-            else:
-                _LOG.debug(
-                    "trigger: no match on %r because files aren't new: %s",
-                    pattern,
-                    matches,
-                )
-        else:
-            _LOG.debug("trigger: no match on %r", pattern)
+        valid_news = get_trigger_files(pattern, release_commit)
+        if valid_news:
+            _LOG.debug("trigger: %s bump from %r\n\t%s", trigger, pattern, valid_news)
+            triggers.add(trigger)
+            all_valid_trigger_files.update(valid_news)
     return triggers, all_valid_trigger_files
 
 
+def get_trigger_dirs():
+    """The directories whose entries decide which files match the trigger patterns
+
+    For a pattern with a glob in its directory, this includes every directory it
+    matches, and those that could contain new matches.
+    """
+    dirs = set()
+    for pattern in config.trigger_patterns:
+        directory = os.path.dirname(pattern)
+        while glob.has_magic(directory):
+            dirs.update(os.path.abspath(match) for match in glob.glob(directory))
+            directory = os.path.dirname(directory)
+        dirs.add(os.path.abspath(directory))
+    return dirs
+
+
+def get_trigger_fingerprint(release_commit):
+    """A key for the trigger detection results, which changes whenever they could
+
+    The results depend on the commits (HEAD and the release commit), the trigger patterns,
+    and the files present: adding or removing a file changes the mtime of its directory.
+
+    :return: the key, and the newest mtime of the directories (None if there are none)
+    """
+    head = vcs.get_backend().head()
+    if head is None:
+        raise ValueError("no commits yet")
+    mtimes = {}
+    for directory in get_trigger_dirs():
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtimes[directory] = None
+    fingerprint = json.dumps(
+        [head, release_commit, sorted(config.trigger_patterns.items()), mtimes],
+        sort_keys=True,
+    )
+    newest = max((mtime for mtime in mtimes.values() if mtime is not None), default=None)
+    return hashlib.sha1(fingerprint.encode("utf8")).hexdigest(), newest
+
+
+def detect_file_triggers_cached(release_commit):
+    """Trigger detection, with the results cached by fingerprint
+
+    As in git (and the key index), a directory modified no earlier than the cache was
+    written is "racy": a file added just after it was read could have left the same
+    mtime, so the results are found again until the cache has been written after it.
+
+    :return: set of triggers, set of trigger files
+    """
+    try:
+        key, newest = get_trigger_fingerprint(release_commit)
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        _LOG.debug("trigger: no fingerprint (no commits yet?), not caching")
+        return find_file_triggers(release_commit)
+    results, written = cache.load_with_mtime(Constants.TRIGGER_CACHE)
+    cached = results.get(key)
+    if cached is not None and newest is not None and newest >= written:
+        _LOG.debug("trigger: cached results %s are racy, finding them again", key)
+        cached = None
+    if cached is not None:
+        _LOG.debug("trigger: using cached results %s", key)
+        return set(cached["triggers"]), set(cached["files"])
+    triggers, trigger_files = find_file_triggers(release_commit)
+    results[key] = {"triggers": sorted(triggers), "files": sorted(trigger_files)}
+    # only recent results are kept (in the order they were added)
+    for stale in list(results)[:-TRIGGER_CACHE_SIZE]:
+        del results[stale]
+    cache.save(Constants.TRIGGER_CACHE, results)
+    return triggers, trigger_files
+
+
+def get_trigger_files(pattern, release_commit):
+    """The files matching a trigger pattern, that are new since the release commit (if given)"""
+    matches = glob.glob(pattern)
+
+    if not matches:
+        _LOG.debug("trigger: no match on %r", pattern)
+        return set()
+
+    valid_news = set(matches)
+    if release_commit:
+        # if we have a specific release commit, we will additionally filter
+        # to ensure that only files that were added since that commit are considered
+        # this allows the project to retain newsfiles for all time, rather than having to delete them
+        file_paths = vcs.get_backend().added_files(release_commit, pattern)
+        _LOG.debug("trigger: added since last release: %r", file_paths)
+        valid_news.intersection_update(set(file_paths))
+
+    if not valid_news:
+        _LOG.debug(
+            "trigger: no match on %r because files aren't new: %s", pattern, matches
+        )
+    return valid_news
+
+
+def detect_significant_file_trigger(release_commit, floor=None):
+    """The most significant file trigger, if it is more significant than the floor
+
+    Only the most significant trigger affects the new version, so patterns are checked
+    from most to least significant, and we stop as soon as the outcome can't change.
+
+    :param floor: a significant figure that is already being bumped (e.g. by --bump)
+    :return: set of at most one trigger
+    """
+    order = list(definitions.SemVerSigFig)
+
+    def significance(item):
+        trigger = item[1]
+        return order.index(trigger) if trigger in order else len(order)
+
+    best = floor
+    triggers = set()
+    for pattern, trigger in sorted(config.trigger_patterns.items(), key=significance):
+        if best and (trigger not in order or not utils.sigfig_gt(trigger, best)):
+            _LOG.debug("trigger: no more significant triggers left to check")
+            break
+        if triggers and trigger not in order:
+            break
+        if get_trigger_files(pattern, release_commit):
+            _LOG.debug("trigger: %s bump from %r", trigger, pattern)
+            triggers = {trigger}
+            if trigger in order:
+                best = trigger
+    return triggers
+
+
 def get_all_triggers(bump, enable_file_triggers, release_commit):
     """Aggregated set of significant figures to bump"""
+    triggers, _ = get_triggers_and_files(bump, enable_file_triggers, release_commit)
+    return triggers
+
+
+def get_triggers_and_files(bump, enable_file_triggers, release_commit):
+    """Aggregated set of significant figures to bump, and the files that triggered them
+
+    :return: set of triggers, set of trigger files (None if file triggers are not enabled)
+    """
     triggers = set()
-    if enable_file_triggers:
-        file_triggers, _ = detect_file_triggers(release_commit)
-        triggers.update(file_triggers)
+    trigger_files = None
     if bump:
         _LOG.debug("trigger: %s bump requested", bump)
         _ = definitions.SemVerSigFig._asdict()[bump]
         triggers.add(bump)
-    return triggers
+    if enable_file_triggers and config.EARLY_EXIT_TRIGGERS:
+        # the files aren't all found, so aren't reported
+        triggers.update(detect_significant_file_trigger(release_commit, floor=bump))
+    elif enable_file_triggers:
+        file_triggers, trigger_files = detect_file_triggers(release_commit)
+        triggers.update(file_triggers)
+    return triggers, trigger_files
 
 
 def get_lock_behaviour(triggers, all_data, lock):
@@ -188,29 +796,100 @@ def get_lock_behaviour(triggers, all_data, lock):
 
 def get_dvcs_info():
     """Gets current repository info from git"""
-    cmd = "git rev-list --count HEAD"
-    commit_count = str(
-        int(subprocess.check_output(shlex.split(cmd)).decode("utf8").strip())
-    )
-    cmd = "git rev-parse HEAD"
-    commit = str(subprocess.check_output(shlex.split(cmd)).decode("utf8").strip())
+    if config.INCREMENTAL_COMMIT_COUNT:
+        commit_count = str(get_incremental_commit_count())
+    else:
+        commit_count = str(get_dvcs_commit_count("HEAD"))
+        if is_shallow_repository():
+            warnings.warn(
+                "Shallow clone: the commit count (%s) only covers the fetched history, so is approximate."
+                % commit_count,
+                UserWarning,
+            )
+    commit = vcs.get_backend().head()
     return {Constants.COMMIT_FIELD: commit, Constants.COMMIT_COUNT_FIELD: commit_count}
 
 
+def get_dvcs_commit_count(revision, since=None):
+    """Counts the commits in a revision (but not in `since`, if given)"""
+    return vcs.get_backend().commit_count(revision, since)
+
+
+def get_incremental_commit_count():
+    """Counts commits from the previous release, rather than across the whole history
+
+    The count at a commit never changes, so counts are cached by commit id, and a run
+    at a commit that's been counted before reuses its count. Otherwise the total is the
+    count at the release plus the commits made since it, which costs time in proportion
+    to the commits made since the release. The release is found with a single bounded
+    tag scan, rather than by checking the ancestry of every tag.
+    """
+    head = vcs.get_backend().head()
+    counts = cache.load(Constants.COMMIT_COUNT_CACHE)
+    if head in counts:
+        _LOG.debug("commit count: using the cached count at %s", head)
+        return counts[head]
+    shallow = is_shallow_repository()
+    if shallow:
+        release = get_dvcs_previous_semver(releases_only=True)
+    else:
+        release = get_dvcs_previous_release_semver_bounded()
+    release_count = None
+    if release:
+        release_commit = vcs.get_backend().resolve(
+            config.TAG_TEMPLATE.format(version=release)
+        )
+        # taken out, to go back in as the most recently used
+        release_count = counts.pop(release_commit, None)
+        if release_count is None and not shallow:
+            release_count = get_dvcs_commit_count(release_commit)
+    if release_count is None:
+        commit_count = get_dvcs_commit_count("HEAD")
+        if shallow:
+            warnings.warn(
+                "Shallow clone: %s, so the commit count (%s) is approximate."
+                % (
+                    "the commit count at release %s isn't cached" % release
+                    if release
+                    else "no previous release was found in the fetched history",
+                    commit_count,
+                ),
+                UserWarning,
+            )
+            return commit_count
+    else:
+        since_release = get_dvcs_commit_count("HEAD", since=release_commit)
+        _LOG.debug(
+            "commit count: %s at release %s, plus %s since",
+            release_count,
+            release,
+            since_release,
+        )
+        commit_count = release_count + since_release
+        counts[release_commit] = release_count
+    counts[head] = commit_count
+    # only recent counts are kept (in the order they were last used)
+    for stale in list(counts)[:-COMMIT_COUNT_CACHE_SIZE]:
+        del counts[stale]
+    cache.save(Constants.COMMIT_COUNT_CACHE, counts)
+    return commit_count
+
+
+def get_tag_regex(as_bytes=False):
+    """Builds a regex from our version template, to detect the version within a tag
+
+    The bytes form matches tags line-by-line within a whole buffer of git output
+    """
+    tag_re = tag_router.template_regex(config.TAG_TEMPLATE)
+    _LOG.debug("regexing with %r", tag_re)
+    if as_bytes:
+        return re.compile(tag_re[:-1].encode("utf8") + b"\r?$", re.MULTILINE)
+    return re.compile(tag_re)
+
+
 def get_all_versions_from_tags(tags):
     """this is like a reverse match from a template"""
-    # build a regex from our version template
-    re_safe_placeholder = r"A_PLACEHOLDER_FOR_THE_VERSION_DETECTOR"
-    re_version_detector = r"(\d+\.\d+\.\d+(-\w+.\d+)?(\+\w+.\d+)?)"
-    tag_re = (
-        "^"
-        + re.escape(
-            config.TAG_TEMPLATE.replace("{version}", re_safe_placeholder)
-        ).replace(re_safe_placeholder, re_version_detector)
-        + "$"
-    )
-    _LOG.debug("regexing with %r", tag_re)
-    tag_re_comp = re.compile(tag_re)
+    tag_re_comp = get_tag_regex()
     matches = []
     for t in tags:
         match = tag_re_comp.match(t)
@@ -221,6 +900,45 @@ def get_all_versions_from_tags(tags):
     return matches
 
 
+def iter_versions_from_tag_output(stream, chunk_size=TAG_OUTPUT_CHUNK_SIZE):
+    """Streams versions out of newline separated tags, as output by git
+
+    Each chunk of complete lines is matched in a single pass over the raw bytes,
+    and only the versions that are found get decoded.
+    """
+    tag_re_comp = get_tag_regex(as_bytes=True)
+    if not tag_re_comp.groups:
+        # the template has no version in it
+        return
+    remainder = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer = remainder + chunk
+        end = buffer.rfind(b"\n") + 1
+        remainder = buffer[end:]
+        for match in tag_re_comp.finditer(buffer, 0, end):
+            yield match.group(1).decode("utf8")
+    for match in tag_re_comp.finditer(remainder):
+        yield match.group(1).decode("utf8")
+
+
+def iter_versions_from_tag_lines(stream):
+    """Streams versions out of newline separated tags, as output by git, a line at a time
+
+    For readers that stop early: no more of the output is read than the lines they use.
+    """
+    tag_re_comp = get_tag_regex(as_bytes=True)
+    if not tag_re_comp.groups:
+        # the template has no version in it
+        return
+    for line in stream:
+        match = tag_re_comp.match(line)
+        if match:
+            yield match.group(1).decode("utf8")
+
+
 def get_dvcs_commit_for_version(version, persist_from):
     """Given a previously tagged release version (and the tag template)
 
@@ -228,23 +946,12 @@ def get_dvcs_commit_for_version(version, persist_from):
     """
     if persist_from == [Constants.FROM_SOURCE]:
         return None
-    try:
-        result = (
-            subprocess.check_output(
-                [
-                    "git",
-                    "rev-parse",
-                    "--verify",
-                    config.TAG_TEMPLATE.format(version=version),
-                ]
-            )
-            .decode("utf8")
-            .strip()
-        )
+    result = vcs.get_backend().resolve(config.TAG_TEMPLATE.format(version=version))
+    if result is None:
+        _LOG.error("failed to discover the commit for the last tagged release")
+    else:
         _LOG.debug("the commit of the last release is %s", result)
-        return result
-    except subprocess.CalledProcessError:
-        _LOG.exception("failed to discover the commit for the last tagged release")
+    return result
 
 
 def get_dvcs_ordered_tag_semvers():
@@ -253,14 +960,16 @@ def get_dvcs_ordered_tag_semvers():
     :returns: ordered list of VersionInfo instances
     :rtype: list(semver.VersionInfo)
     """
+    router = tag_router.get_active()
+    if router and config.TAG_TEMPLATE in router:
+        _LOG.debug("using the shared tag listing for %r", config.TAG_TEMPLATE)
+        return router.versions(config.TAG_TEMPLATE)
     tag_glob = config.TAG_TEMPLATE.replace("{version}", "*")
-    cmd = "git tag --list %s" % tag_glob
-    tags = str(subprocess.check_output(shlex.split(cmd)).decode("utf8").strip())
-    tags = tags.splitlines()
-    _LOG.debug("all tags matching simple pattern %r : %s", tag_glob, tags)
-    matches = get_all_versions_from_tags(tags)
+    _LOG.debug("listing all tags matching simple pattern %r", tag_glob)
+    with vcs.get_backend().tag_stream(tag_glob) as stream:
+        matches = set(iter_versions_from_tag_output(stream))
     ordered_versions = sorted(
-        {v for v in set(utils.from_text_or_none(version) for version in matches) if v}
+        {v for v in (utils.from_text_or_none(version) for version in matches) if v}
     )
     return ordered_versions
 
@@ -287,71 +996,335 @@ def get_dvcs_repo_latest_release_semver():
 
 def get_dvcs_previous_version_semver():
     """Gets the latest version that's an ancestor to the current commit"""
-    ordered_versions = get_dvcs_ordered_tag_semvers()
-    for version in reversed(ordered_versions):  # type: semver.VersionInfo
-        if is_ancestor(version):
-            break
-    else:
-        version = None
+    version = get_dvcs_previous_semver(releases_only=False)
     _LOG.info("previous version found in ancestral tags: %r", version)
     return version
 
 
 def get_dvcs_previous_release_semver():
     """Gets the latest release that's an ancestor to the current commit"""
-    ordered_versions = get_dvcs_ordered_tag_semvers()
-    for version in reversed(ordered_versions):  # type: semver.VersionInfo
-        if utils.is_release(version) and is_ancestor(version):
-            break
+    if config.BOUNDED_TAG_SCAN and not is_shallow_repository():
+        version = get_dvcs_previous_release_semver_bounded()
     else:
-        version = None
+        version = get_dvcs_previous_semver(releases_only=True)
     _LOG.info("previous release found in ancestral tags: %r", version)
     return version
 
 
+def get_dvcs_previous_release_semver_bounded():
+    """Gets the latest release that's an ancestor to the current commit, in a single git call
+
+    git filters the tags to ancestors and orders them, newest first, so we can stop
+    at the first tag that is a release, rather than sorting and checking every tag.
+    Release versions are plain numbers, so git's version order matches SemVer order.
+    """
+    tag_glob = config.TAG_TEMPLATE.replace("{version}", "*")
+    with vcs.get_backend().merged_tag_stream(tag_glob) as stream:
+        for match in iter_versions_from_tag_lines(stream):
+            version = utils.from_text_or_none(match)
+            if version and utils.is_release(version):
+                return version
+
+
+def get_dvcs_previous_semver(releases_only):
+    """Gets the latest version (or release) that's an ancestor to the current commit
+
+    In a shallow clone, tags beyond the fetched history can't be checked (or aren't fetched at all).
+    If one of those might be the answer, the clone is deepened (as configured)
+    until it can be checked, otherwise the result is reported as approximate.
+    """
+    shallow = is_shallow_repository()
+    deepened = 0
+    while True:
+        ordered_versions = get_dvcs_ordered_tag_semvers()
+        if not ordered_versions:
+            # there are no tags to check, whether or not the clone is shallow
+            return None
+        check_ancestor = get_ancestry_check(shallow)
+        unresolved = []
+        for version in reversed(ordered_versions):  # type: semver.VersionInfo
+            if releases_only and not utils.is_release(version):
+                continue
+            found = check_ancestor(version)
+            if found is None:
+                unresolved.append(version)
+            elif found:
+                break
+        else:
+            version = None
+        if not unresolved and (version or not shallow):
+            return version
+        step = min(config.SHALLOW_DEEPEN_STEP, config.SHALLOW_DEEPEN_LIMIT - deepened)
+        if step > 0:
+            try:
+                deepen_shallow_repository(step)
+            except subprocess.CalledProcessError:
+                _LOG.exception("failed to deepen the shallow clone")
+            else:
+                deepened += step
+                shallow = is_shallow_repository()
+                continue
+        warnings.warn(
+            "Shallow clone: tags beyond the fetched history (%s) could not be checked, so the previous %s (%s) "
+            "is approximate. Fetch more history, or configure SHALLOW_DEEPEN_STEP."
+            % (
+                ", ".join(str(v) for v in unresolved) or "not fetched",
+                "release" if releases_only else "version",
+                version,
+            ),
+            UserWarning,
+        )
+        return version
+
+
 def is_ancestor(version):
-    try:
-        # if "--is-ancestor" returns exit code 0, then it is an ancestor and we can stop looking
+    release_tag = config.TAG_TEMPLATE.replace("{version}", str(version))
+    return vcs.get_backend().is_ancestor(release_tag, "HEAD")
+
+
+def get_ancestry_check(shallow=False):
+    """Provides a test for whether the tag of a version is an ancestor to the current commit
+
+    By default each test is a separate git process. With the commit graph enabled,
+    or in a shallow clone, the history of HEAD is loaded once and every test is
+    answered from memory. In a shallow clone the test returns None for tags whose
+    commit isn't in the fetched history of HEAD, as they may be ancestors beyond it:
+    even a commit that has been fetched (e.g. with `git fetch --tags`) may be.
+    """
+    if not (config.USE_COMMIT_GRAPH or shallow):
+        return is_ancestor
+    backend = vcs.get_backend()
+    graph = backend.commit_graph()
+    tag_commits = backend.tag_commits()
+
+    def check_ancestor(version):
         release_tag = config.TAG_TEMPLATE.replace("{version}", str(version))
-        subprocess.check_output(
-            ["git", "merge-base", "--is-ancestor", release_tag, "HEAD"]
-        )
-    except subprocess.CalledProcessError:
-        pass
-    else:
-        return True
+        commit = tag_commits.get(release_tag)
+        # the graph holds exactly the (fetched) commits reachable from HEAD
+        if graph.index_of(commit) is not None:
+            return True
+        return None if shallow else False
+
+    return check_ancestor
+
+
+def is_shallow_repository():
+    """Whether the repository is a shallow clone, with only part of its history"""
+    return vcs.get_backend().is_shallow()
+
+
+def deepen_shallow_repository(commits):
+    """Fetches more history into a shallow clone"""
+    _LOG.info("deepening shallow clone by %s commits", commits)
+    vcs.get_backend().deepen(commits, config.SHALLOW_REMOTE)
 
 
 def add_dvcs_tag(version):
     """Sets a tag on the current commit"""
-    cmd = 'git tag -a %s -m "version %s"' % (
-        config.TAG_TEMPLATE.format(version=version),
-        version,
-    )
-    version = str(subprocess.check_output(shlex.split(cmd)).decode("utf8").strip())
+    tag = config.TAG_TEMPLATE.format(version=version)
+    vcs.create_tag(tag, "version %s" % version)
+    router = tag_router.get_active()
+    if router:
+        # keep the shared tag listing up to date
+        router.add(tag)
+    return tag
+
+
+def get_version_from(source):
+    """Loads the version from a single source"""
+    version = None
+    if source == Constants.FROM_SOURCE:
+        all_data = read_targets(
+            config.targets, keys=set(config._forward_aliases.values())
+        )
+        version = utils.get_semver_from_source(all_data)
+    elif source == Constants.FROM_VCS_PREVIOUS_VERSION:
+        version = get_dvcs_previous_version_semver()
+    elif source == Constants.FROM_VCS_PREVIOUS_RELEASE:
+        version = get_dvcs_previous_release_semver()
+    elif source == Constants.FROM_VCS_LATEST_VERSION:
+        version = get_dvcs_repo_latest_version_semver()
+    elif source == Constants.FROM_VCS_LATEST_RELEASE:
+        version = get_dvcs_repo_latest_release_semver()
     return version
 
 
 def get_current_version(persist_from):
     """Try loading the version from the sources in the order provided to us"""
+    if (
+        config.PARALLEL_PERSIST_FROM
+        and len(persist_from) > 1
+        and not is_shallow_repository()
+    ):
+        return get_current_version_parallel(persist_from)
     version = None
     for source in persist_from:
-        if source == Constants.FROM_SOURCE:
-            all_data = read_targets(config.targets)
-            version = utils.get_semver_from_source(all_data)
-        elif source == Constants.FROM_VCS_PREVIOUS_VERSION:
-            version = get_dvcs_previous_version_semver()
-        elif source == Constants.FROM_VCS_PREVIOUS_RELEASE:
-            version = get_dvcs_previous_release_semver()
-        elif source == Constants.FROM_VCS_LATEST_VERSION:
-            version = get_dvcs_repo_latest_version_semver()
-        elif source == Constants.FROM_VCS_LATEST_RELEASE:
-            version = get_dvcs_repo_latest_release_semver()
+        version = get_version_from(source)
         if version:
             break
     return version
 
 
+def get_current_version_parallel(persist_from):
+    """Loads the version from all the sources at once, and uses the first in order that has one
+
+    Gives the same result as trying them in turn: an error from a source is only raised
+    if every source before it found nothing. Once the result is known, the git processes
+    of the sources still running are killed, so their threads finish straight away
+    rather than holding up the exit.
+    """
+    group = processes.ProcessGroup()
+
+    def load(source):
+        with group.active():
+            return get_version_from(source)
+
+    executor = concurrent.futures.ThreadPoolExecutor(len(persist_from))
+    futures = [executor.submit(load, source) for source in persist_from]
+    try:
+        for source, future in zip(persist_from, futures):
+            version = future.result()
+            if version:
+                _LOG.debug("using the version from %s", source)
+                return version
+        return None
+    finally:
+        group.stop()
+        executor.shutdown(wait=True)
+
+
+def get_last_release_semver(persist_from):
+    """The previous full release, from the tags that match where the current version is persisted"""
+    if (Constants.FROM_VCS_PREVIOUS_VERSION in persist_from) or (
+        Constants.FROM_VCS_PREVIOUS_RELEASE in persist_from
+    ):
+        version = get_dvcs_previous_release_semver()
+    else:
+        version = get_dvcs_repo_latest_release_semver()
+    _LOG.debug("found previous full release: %s", version)
+    return version
+
+
+def get_plan_inputs(persist_from=None, enable_file_triggers=None):
+    """Gathers everything needed to work out a new version, in one pass over the repository
+
+    :param persist_from: where the current version is stored
+    :param enable_file_triggers: whether to detect bumps from file triggers
+    :return: dict of current version, last release, file triggers and commit count
+    """
+    persist_from = persist_from or [Constants.FROM_SOURCE]
+    current_semver = get_current_version(persist_from)
+    release_commit = get_dvcs_commit_for_version(current_semver, persist_from)
+    return dict(
+        current=current_semver,
+        last_release=get_last_release_semver(persist_from),
+        file_triggers=get_all_triggers(None, enable_file_triggers, release_commit),
+        commit_count=get_dvcs_info()[Constants.COMMIT_COUNT_FIELD],
+    )
+
+
+def get_version_matrix(
+    inputs,
+    bumps=None,
+    incr_options=None,
+    commit_count_options=None,
+    set_to=None,
+    lock=False,
+    release=False,
+):
+    """The new version for each combination of options, computed in memory
+
+    Each option defaults to every possible value. The version is worked out as by `main`.
+
+    :param inputs: as from `get_plan_inputs`
+    :param bumps: significant figures to bump (None, for file triggers only)
+    :param incr_options: values of `incr_from_release`
+    :param commit_count_options: values of `commit_count_as` (None, to not use the commit count)
+    :param set_to, lock, release: as for `main`, for every combination
+    :return: list of dicts, one per combination
+    """
+    bumps = list(definitions.SemVerSigFig) if bumps is None else bumps
+    incr_options = [False, True] if incr_options is None else incr_options
+    if commit_count_options is None:
+        commit_count_options = [None] + list(definitions.SemVerSigFig)
+    matrix = []
+    for bump in bumps:
+        triggers = set(inputs["file_triggers"])
+        if bump:
+            triggers.add(bump)
+        for incr_from_release in incr_options:
+            last_release = inputs["last_release"] if incr_from_release else None
+            for commit_count_as in commit_count_options:
+                new_version = get_new_version(
+                    inputs["current"],
+                    last_release,
+                    triggers,
+                    {Constants.COMMIT_COUNT_FIELD: inputs["commit_count"]},
+                    set_to=set_to,
+                    commit_count_as=commit_count_as,
+                    lock=lock,
+                    release=release,
+                )
+                matrix.append(
+                    dict(
+                        bump=bump,
+                        incr_from_release=incr_from_release,
+                        commit_count_as=commit_count_as,
+                        version=str(new_version),
+                    )
+                )
+    return matrix
+
+
+def format_version_matrix(matrix):
+    """Formats a version matrix as a plain text table"""
+    columns = ["bump", "incr_from_release", "commit_count_as", "version"]
+    rows = [columns] + [
+        ["-" if row[column] is None else str(row[column]) for column in columns]
+        for row in matrix
+    ]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def get_new_version(
+    current_semver,
+    last_release_semver,
+    triggers,
+    updates,
+    set_to=None,
+    commit_count_as=None,
+    lock=False,
+    release=False,
+):
+    """The new version: set directly, or bumped by the triggers, then released if asked
+
+    :param updates: the updates so far, which the fields of the new version are added to
+    """
+    new_version = current_semver
+    if set_to:
+        _LOG.debug("setting version directly: %s", set_to)
+        # parse it - validation failure will raise a ValueError
+        new_version = semver.parse_version_info(set_to)
+        if not lock:
+            warnings.warn(
+                "After setting version manually, does it need locking for a CI flow, to avoid an extraneous increment?",
+                UserWarning,
+            )
+    elif triggers:
+        # use triggers if the version is not set directly
+        _LOG.debug("auto-incrementing version (triggers: %s)", triggers)
+        overrides = get_overrides(updates, commit_count_as)
+        # make_new_semver may add to the triggers, so it gets its own copy
+        new_version = utils.make_new_semver(
+            current_semver, last_release_semver, set(triggers), **overrides
+        )
+    return get_version_updates(new_version, release, updates)
+
+
 def get_overrides(updates, commit_count_as):
     overrides = {}
     if commit_count_as:
@@ -380,6 +1353,125 @@ def load_config(config_path):
     return config
 
 
+def load_component_config(config_path, settings):
+    """Loads a component's config over the settings from before any component was loaded
+
+    :param settings: as from `get_settings`, so nothing is kept from another component
+    """
+    set_settings(config, settings)
+    return load_config(config_path)
+
+
+def get_version_updates(new_version, release, updates):
+    """Adds the fields of a new version to the updates
+
+    :param release: marks with a production flag, and drops any prerelease or build
+    :return: the new version (which is the release version, if releasing)
+    """
+    release_record = VersionRecord.from_version(new_version)
+    release_record.finalize()
+    release_string = str(release_record)
+    release_version = release_record.to_version_info()
+    if release:
+        new_version = release_version
+        updates[Constants.RELEASE_FIELD] = config.RELEASED_VALUE
+        updates[Constants.VERSION_FIELD] = release_string
+        updates[Constants.VERSION_STRICT_FIELD] = release_string
+    else:
+        updates[Constants.VERSION_FIELD] = str(new_version)
+        updates[Constants.VERSION_STRICT_FIELD] = release_string
+
+    # write out the individual parts of the version
+    updates.update(new_version._asdict())
+    return new_version
+
+
+def get_source_file_updates(updates, extra_updates):
+    """The key-value pairs to write into the source files"""
+    # only rewrite a field that the user has specified in the configuration
+    source_file_updates = {
+        native: updates[key]
+        for native, key in config.key_aliases.items()
+        if key in updates
+    }
+
+    # finally, add in commandline overrides
+    source_file_updates.update(extra_updates)
+    return source_file_updates
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """Records the time taken by a block of code, in seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+class VersionResult(object):
+    """The outcome of a run of `main`
+
+    Unpacks as `(old, new, updates)`.
+    """
+
+    __slots__ = (
+        "old",
+        "new",
+        "updates",
+        "triggers",
+        "trigger_files",
+        "release_commit",
+        "timings",
+    )
+
+    def __init__(
+        self,
+        old,
+        new,
+        updates,
+        triggers=None,
+        trigger_files=None,
+        release_commit=None,
+        timings=None,
+    ):
+        """New result instance
+
+        :param old: the current version string
+        :param new: the new version string
+        :param updates: the key-value pairs for the source files
+        :param triggers: set of significant figures that triggered the bump
+        :param trigger_files: set of files that triggered it (None if file triggers weren't detected)
+        :param release_commit: commit of the current version, if found in vcs
+        :param timings: dict of seconds spent in each phase
+        """
+        self.old = old
+        self.new = new
+        self.updates = updates
+        self.triggers = triggers or set()
+        self.trigger_files = trigger_files
+        self.release_commit = release_commit
+        self.timings = timings or {}
+
+    def __iter__(self):
+        return iter((self.old, self.new, self.updates))
+
+    def _asdict(self):
+        """The result as plain (json-compatible) types"""
+        return dict(
+            old=self.old,
+            new=self.new,
+            updates=self.updates,
+            triggers=sorted(self.triggers),
+            trigger_files=(
+                None if self.trigger_files is None else sorted(self.trigger_files)
+            ),
+            release_commit=self.release_commit,
+            timings=self.timings,
+        )
+
+
 def main(
     set_to=None,
     commit_count_as=None,
@@ -422,81 +1514,284 @@ def main(
                     (min trigger sigfig)
     :param config_path: path to config file
     :param extra_updates:
-    :return:
+    :return: VersionResult, which unpacks as (old, new, updates)
     """
     updates = {}
+    timings = {}
     persist_to = persist_to or [Constants.TO_SOURCE]
     persist_from = persist_from or [Constants.FROM_SOURCE]
-    load_config(config_path)
+    with timed(timings, "config"):
+        load_config(config_path)
 
     all_data = {}
     last_release_semver = None
-    if incr_from_release:
-        if (Constants.FROM_VCS_PREVIOUS_VERSION in persist_from) or (
-            Constants.FROM_VCS_PREVIOUS_RELEASE in persist_from
-        ):
-            last_release_semver = get_dvcs_previous_release_semver()
-        else:
-            last_release_semver = get_dvcs_repo_latest_release_semver()
-    _LOG.debug("found previous full release: %s", last_release_semver)
-    current_semver = get_current_version(persist_from)
-    release_commit = get_dvcs_commit_for_version(current_semver, persist_from)
-    triggers = get_all_triggers(bump, enable_file_triggers, release_commit)
+    with timed(timings, "versions"):
+        if incr_from_release:
+            last_release_semver = get_last_release_semver(persist_from)
+        current_semver = get_current_version(persist_from)
+        release_commit = get_dvcs_commit_for_version(current_semver, persist_from)
+    with timed(timings, "triggers"):
+        triggers, trigger_files = get_triggers_and_files(
+            bump, enable_file_triggers, release_commit
+        )
     updates.update(get_lock_behaviour(triggers, all_data, lock))
-    updates.update(get_dvcs_info())
+    with timed(timings, "vcs_info"):
+        updates.update(get_dvcs_info())
+
+    new_version = get_new_version(
+        current_semver,
+        last_release_semver,
+        triggers,
+        updates,
+        set_to=set_to,
+        commit_count_as=commit_count_as,
+        lock=lock,
+        release=release,
+    )
+    source_file_updates = get_source_file_updates(updates, extra_updates)
 
-    new_version = current_semver
-    if set_to:
-        _LOG.debug("setting version directly: %s", set_to)
-        # parse it - validation failure will raise a ValueError
-        new_version = semver.parse_version_info(set_to)
-        if not lock:
-            warnings.warn(
-                "After setting version manually, does it need locking for a CI flow, to avoid an extraneous increment?",
-                UserWarning,
-            )
-    elif triggers:
-        # use triggers if the version is not set directly
-        _LOG.debug("auto-incrementing version (triggers: %s)", triggers)
-        overrides = get_overrides(updates, commit_count_as)
-        new_version = utils.make_new_semver(
-            current_semver, last_release_semver, triggers, **overrides
-        )
+    if not dry_run:
+        with timed(timings, "write"):
+            if Constants.TO_SOURCE in persist_to:
+                write_targets(config.targets, **source_file_updates)
 
-    release_string = semver.finalize_version(str(new_version))
-    release_version = semver.parse_version_info(release_string)
-    if release:
-        new_version = release_version
-        updates[Constants.RELEASE_FIELD] = config.RELEASED_VALUE
-        updates[Constants.VERSION_FIELD] = release_string
-        updates[Constants.VERSION_STRICT_FIELD] = release_string
+            if Constants.TO_VCS in persist_to:
+                add_dvcs_tag(updates[Constants.VERSION_FIELD])
     else:
-        updates[Constants.VERSION_FIELD] = str(new_version)
-        updates[Constants.VERSION_STRICT_FIELD] = release_string
+        _LOG.warning("dry run: no changes were made")
 
-    # write out the individual parts of the version
-    updates.update(new_version._asdict())
+    return VersionResult(
+        str(current_semver),
+        str(new_version),
+        source_file_updates,
+        triggers=triggers,
+        trigger_files=trigger_files,
+        release_commit=release_commit,
+        timings=timings,
+    )
 
-    # only rewrite a field that the user has specified in the configuration
-    source_file_updates = {
-        native: updates[key]
-        for native, key in config.key_aliases.items()
-        if key in updates
-    }
 
-    # finally, add in commandline overrides
-    source_file_updates.update(extra_updates)
+def make_plan(config_path=None, persist_to=None, **kwargs):
+    """Works out a run of `main`, recording the writes to make rather than making them
 
-    if not dry_run:
-        if Constants.TO_SOURCE in persist_to:
-            write_targets(config.targets, **source_file_updates)
+    The plan can be applied (e.g. on many build workers) with `apply_plan`,
+    without repeating the work of finding the new version.
 
-        if Constants.TO_VCS in persist_to:
-            add_dvcs_tag(updates[Constants.VERSION_FIELD])
-    else:
-        _LOG.warning("dry run: no changes were made")
+    Only writes to the source files can be planned: a plan is applied wherever it's
+    needed, so creating the tag is left to a normal run.
+
+    :param kwargs: as for `main`
+    :return: dict of the old and new versions, the updates and the planned target writes
+    :raises ValueError: if asked to persist the version to vcs
+    """
+    persist_to = persist_to or [Constants.TO_SOURCE]
+    if Constants.TO_VCS in persist_to:
+        raise ValueError(
+            "a plan can't persist to %s: tags aren't created by apply, "
+            "so tag the release with a normal run" % Constants.TO_VCS
+        )
+    result = main(
+        config_path=config_path, persist_to=persist_to, dry_run=True, **kwargs
+    )
+    planned = []
+    if Constants.TO_SOURCE in persist_to:
+        planned = plan_targets(config.targets, **result.updates)
+    return dict(
+        format=PLAN_FORMAT,
+        old=result.old,
+        new=result.new,
+        updates=result.updates,
+        targets=planned,
+    )
+
+
+def apply_plan(plan):
+    """Writes the targets of a plan, as from `make_plan`
+
+    :returns: list of the targets that were written
+    """
+    if plan.get("format") != PLAN_FORMAT:
+        raise ValueError("unsupported plan format: %r" % plan.get("format"))
+    return apply_targets(plan["targets"])
+
+
+class VersionWatcher(object):
+    """Keeps the targets up to date while the inputs to the version change
+
+    The current version is read once, at the start (or from vcs, whenever refs change).
+    Each change to the inputs recomputes only the affected step: file triggers when a
+    trigger file changes, the vcs information when refs change, and everything when
+    the config changes. Only targets whose content changes are rewritten.
+    """
+
+    CONFIG = "config"
+    TRIGGERS = "triggers"
+    VCS = "vcs"
+    ALL = frozenset((CONFIG, TRIGGERS, VCS))
+
+    # files in the git directory that affect the version (other than refs)
+    GIT_FILES = ("HEAD", "packed-refs", "shallow")
+
+    def __init__(
+        self,
+        config_path,
+        persist_from=None,
+        bump=None,
+        release=None,
+        commit_count_as=None,
+        incr_from_release=None,
+        **extra_updates
+    ):
+        self.config_path = os.path.abspath(config_path)
+        self.persist_from = persist_from or [Constants.FROM_SOURCE]
+        self.bump = bump
+        self.release = release
+        self.commit_count_as = commit_count_as
+        self.incr_from_release = incr_from_release
+        self.extra_updates = extra_updates
+        self.git_dir = os.path.abspath(vcs.find_git_dir(os.getcwd()))
+        self.current_semver = None
+        self.last_release_semver = None
+        self.release_commit = None
+        self.dvcs_info = {}
+        self.triggers = set()
+        self.trigger_files = set()
+
+    def refresh(self, changes=ALL):
+        """Recomputes the steps affected by the given changes, and updates the targets
+
+        :param changes: collection of CONFIG, TRIGGERS and/or VCS
+        :returns: list of the targets that were written
+        """
+        if self.CONFIG in changes:
+            load_config(self.config_path)
+            changes = self.ALL
+        if self.VCS in changes:
+            if self.current_semver is None or self.persist_from != [
+                Constants.FROM_SOURCE
+            ]:
+                self.current_semver = get_current_version(self.persist_from)
+            self.release_commit = get_dvcs_commit_for_version(
+                self.current_semver, self.persist_from
+            )
+            if self.incr_from_release:
+                self.last_release_semver = get_last_release_semver(self.persist_from)
+            self.dvcs_info = get_dvcs_info()
+        if self.TRIGGERS in changes or self.VCS in changes:
+            # file triggers depend on the release commit, as well as the files
+            self.triggers, self.trigger_files = get_triggers_and_files(
+                self.bump, True, self.release_commit
+            )
+        return self.update()
+
+    def update(self):
+        """Writes the version from the current inputs into any targets it changes"""
+        updates = dict(self.dvcs_info)
+        new_version = self.current_semver
+        if self.triggers:
+            overrides = get_overrides(updates, self.commit_count_as)
+            new_version = utils.make_new_semver(
+                self.current_semver,
+                self.last_release_semver,
+                set(self.triggers),
+                **overrides
+            )
+        new_version = get_version_updates(new_version, self.release, updates)
+        written = write_targets(
+            config.targets, **get_source_file_updates(updates, self.extra_updates)
+        )
+        if written:
+            _LOG.info("version %s written to %s", new_version, ", ".join(written))
+        return written
+
+    def get_watched_dirs(self):
+        """The directories containing any of the inputs"""
+        dirs = {os.path.dirname(self.config_path), self.git_dir}
+        dirs.update(get_trigger_dirs())
+        for root, subdirs, _ in os.walk(os.path.join(self.git_dir, "refs")):
+            dirs.add(root)
+        return dirs
+
+    def classify(self, path):
+        """Which input a changed path affects (or None)"""
+        path = os.path.abspath(path)
+        if path == self.config_path:
+            return self.CONFIG
+        if path.startswith(self.git_dir + os.sep):
+            relative = os.path.relpath(path, self.git_dir)
+            if relative.endswith(".lock"):
+                # git writes a lock file then moves it into place, which is the change we want
+                return None
+            if relative in self.GIT_FILES or relative.startswith("refs" + os.sep):
+                return self.VCS
+            return None
+        relative = os.path.relpath(path)
+        for pattern in config.trigger_patterns:
+            if fnmatch.fnmatch(relative, os.path.normpath(pattern)):
+                return self.TRIGGERS
+        return None
 
-    return str(current_semver), str(new_version), source_file_updates
+    def watch(self, inotify, timeout=None):
+        """Waits for a batch of changes, and handles them
+
+        :returns: list of the targets that were written
+        """
+        changes = set()
+        for path, mask in inotify.read_events(timeout):
+            if mask & watch.IN_ISDIR and mask & (watch.IN_CREATE | watch.IN_MOVED_TO):
+                # e.g. a new tag namespace
+                if path.startswith(self.git_dir + os.sep):
+                    inotify.add_watch(path)
+            change = self.classify(path)
+            if change:
+                changes.add(change)
+        if not changes:
+            return []
+        _LOG.debug("inputs changed: %s", ", ".join(sorted(changes)))
+        written = self.refresh(changes)
+        if self.CONFIG in changes:
+            for directory in self.get_watched_dirs() - inotify.paths:
+                inotify.add_watch(directory)
+        return written
+
+    def run(self):
+        """Keeps the targets up to date, until interrupted"""
+        with watch.Inotify() as inotify:
+            self.refresh()
+            for directory in self.get_watched_dirs():
+                inotify.add_watch(directory)
+            _LOG.info("watching %s directories for changes", len(inotify.paths))
+            try:
+                while True:
+                    self.watch(inotify)
+            except KeyboardInterrupt:
+                _LOG.info("stopped watching")
+
+
+def main_many(config_paths, **kwargs):
+    """Runs `main` for several components of a repository, each with its own config
+
+    The tags are listed once, and shared between the components' tag templates.
+    New tags are created together at the end, once every component has succeeded.
+    Each config is loaded over the settings in place when this is called, so a setting
+    a component leaves out isn't taken from the component before it.
+
+    :param config_paths: config file of each component
+    :param kwargs: as for `main`
+    :return: list of VersionResult, one per config
+    """
+    settings = get_settings(config)
+    templates = set()
+    for config_path in config_paths:
+        load_component_config(config_path, settings)
+        templates.add(config.TAG_TEMPLATE)
+    router = tag_router.TagRouter.from_git(templates)
+    results = []
+    with tag_router.active(router), vcs.batched_tags():
+        for config_path in config_paths:
+            set_settings(config, settings)
+            results.append(main(config_path=config_path, **kwargs))
+    return results
 
 
 def parse_other_args(others):
@@ -514,6 +1809,110 @@ def parse_other_args(others):
     return updates
 
 
+def check_extra_updates(updates):
+    """Checks that no extra replacement shares a name with a parameter of the run
+
+    Otherwise it would silently change how the run behaves (e.g. `dry_run=0`)
+
+    :raises ValueError: listing the clashing names
+    """
+    parameters = inspect.signature(main).parameters
+    reserved = {
+        name
+        for name, parameter in parameters.items()
+        if parameter.kind != parameter.VAR_KEYWORD
+    }
+    reserved.add("config_paths")
+    clashes = sorted(reserved.intersection(updates))
+    if clashes:
+        raise ValueError(
+            "extra replacements can't be named after an option of the run: %s"
+            % ", ".join(clashes)
+        )
+
+
+def get_run_inputs(
+    persist_from=None, enable_file_triggers=False, incr_from_release=False
+):
+    """The files and directories a run (with the loaded config) reads from
+
+    :return: set of paths
+    """
+    inputs = set(path for path in config.targets if os.path.exists(path))
+    if enable_file_triggers:
+        for directory in get_trigger_dirs():
+            # if it's missing, it would appear in the nearest directory that isn't
+            while not os.path.exists(directory):
+                directory = os.path.dirname(directory)
+            inputs.add(directory)
+    uses_tags = (
+        incr_from_release
+        or config.INCREMENTAL_COMMIT_COUNT
+        or set(persist_from or [Constants.FROM_SOURCE]) != {Constants.FROM_SOURCE}
+    )
+    try:
+        inputs.update(vcs.RefsBackend().ref_files(tags=uses_tags))
+    except (IOError, OSError):
+        _LOG.debug("not in a git repository: no vcs inputs")
+    return inputs
+
+
+def format_depfile(targets, inputs):
+    """A make rule, without a recipe, for the targets to depend on the inputs
+
+    Targets that are also inputs (e.g. the files written, without a stamp) aren't
+    listed as their own prerequisites, which make would see as a circular dependency.
+    """
+
+    def escape(path):
+        return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+    def relative(path):
+        relative_path = os.path.relpath(path)
+        return path if relative_path.startswith(os.pardir) else relative_path
+
+    outputs = {os.path.abspath(path) for path in targets}
+    inputs = [path for path in inputs if os.path.abspath(path) not in outputs]
+    rule = " ".join(escape(relative(path)) for path in targets) + ":"
+    lines = [rule] + sorted(escape(relative(path)) for path in inputs)
+    return " \\\n  ".join(lines) + "\n"
+
+
+def write_stamp(path, results):
+    """Writes the new version(s): always, so the stamp is newer than every input"""
+    with open(path, "w") as fh:
+        fh.write("".join("%s\n" % result.new for result in results))
+
+
+def load_updates_file(path):
+    """Loads extra replacements from a json or toml file, in a single parse
+
+    :param path: file path, or `-` to read from stdin
+    :return: dict of key to value
+    """
+    if path == "-":
+        text = sys.stdin.read()
+    else:
+        with open(path) as fh:
+            text = fh.read()
+    if path.endswith(".toml"):
+        updates = toml.loads(text)
+    else:
+        try:
+            updates = json.loads(text)
+        except ValueError:
+            if path.endswith(".json"):
+                raise
+            # from stdin, or a file without a recognised extension
+            updates = toml.loads(text)
+    if not isinstance(updates, dict):
+        raise ValueError(
+            "updates file %s must contain a mapping of keys to values" % path
+        )
+    _LOG.debug("loaded %s extra replacements from %s", len(updates), path)
+    return updates
+
+
 def main_from_cli():
     """Main workflow.
 
@@ -532,9 +1931,35 @@ def main_from_cli():
     log_level = logging.WARNING - 10 * args.verbosity
     logging.basicConfig(level=log_level, format="%(module)s %(levelname)8s %(message)s")
 
-    command_line_updates = parse_other_args(others)
-
-    old, new, updates = main(
+    if args.command == "apply":
+        return apply_from_cli(args)
+    if args.command == "index":
+        return index_from_cli(args)
+    if args.command == "check":
+        return check_from_cli(args, args.keys)
+
+    command_line_updates = {}
+    if args.updates_file:
+        command_line_updates.update(load_updates_file(args.updates_file))
+    # individual key=value pairs take precedence over the file
+    command_line_updates.update(parse_other_args(others))
+    check_extra_updates(command_line_updates)
+
+    if args.command == "plan":
+        return plan_from_cli(args, command_line_updates)
+
+    if args.watch:
+        return VersionWatcher(
+            args.config,
+            persist_from=args.persist_from,
+            bump=args.bump,
+            release=args.release,
+            commit_count_as=args.commit_count_as,
+            incr_from_release=args.incr_from_release,
+            **command_line_updates
+        ).run()
+
+    kwargs = dict(
         set_to=args.set,
         commit_count_as=args.commit_count_as,
         lock=args.lock,
@@ -542,24 +1967,172 @@ def main_from_cli():
         bump=args.bump,
         enable_file_triggers=args.file_triggers,
         incr_from_release=args.incr_from_release,
-        config_path=args.config,
         dry_run=args.show,
         persist_from=args.persist_from,
         persist_to=args.persist_to,
+    )
+    config_paths = [args.config] + args.component_config
+    settings = get_settings(config)
+    if args.component_config:
+        results = main_many(config_paths, **kwargs, **command_line_updates)
+    else:
+        results = [main(config_path=args.config, **kwargs, **command_line_updates)]
+
+    # for --depfile: the rule is for the stamp if there is one, otherwise the targets
+    outputs = [args.stamp] if args.stamp else []
+    inputs = set()
+    if args.updates_file and args.updates_file != "-":
+        inputs.add(args.updates_file)
+    for config_path, result in zip(config_paths, results):
+        _LOG.info("previously: %s", result.old)
+        _LOG.info("currently:  %s", result.new)
+        _LOG.debug("updates:\n%s", pprint.pformat(result.updates))
+        _LOG.debug("timings:\n%s", pprint.pformat(result.timings))
+
+        if args.depfile:
+            if args.component_config:
+                load_component_config(config_path, settings)
+            inputs.add(config_path)
+            if not args.stamp:
+                outputs.extend(config.targets)
+            inputs.update(
+                get_run_inputs(
+                    args.persist_from, args.file_triggers, args.incr_from_release
+                )
+            )
+        if args.print_file_triggers and result.trigger_files is None:
+            # file triggers weren't used for the bump, but we still want to list them
+            if args.component_config:
+                load_component_config(config_path, settings)
+            _, result.trigger_files = detect_file_triggers(result.release_commit)
+
+    if args.depfile:
+        with open(args.depfile, "w") as fh:
+            fh.write(format_depfile(outputs, inputs))
+    if args.stamp:
+        write_stamp(args.stamp, results)
+
+    if args.json:
+        if args.component_config:
+            output = [
+                dict(result._asdict(), config=config_path)
+                for config_path, result in zip(config_paths, results)
+            ]
+        else:
+            output = results[0]._asdict()
+        print(json.dumps(output, indent=2, default=str))
+    elif args.print_file_triggers:
+        print("\n".join(sorted(set().union(*(r.trigger_files for r in results)))))
+    elif args.component_config:
+        for config_path, result in zip(config_paths, results):
+            print("%s %s" % (config_path, result.new))
+    else:
+        print(results[0].new)
+
+
+def plan_from_cli(args, command_line_updates=None):
+    """Prints the new version for the given options (or every combination, with --matrix)
+
+    Nothing is written to disk or vcs, except the plan itself (with --plan-file).
+    """
+    if args.plan_file:
+        return write_plan_from_cli(args, command_line_updates or {})
+    load_config(args.config)
+    inputs = get_plan_inputs(args.persist_from, args.file_triggers)
+    options = dict(set_to=args.set, lock=args.lock, release=args.release)
+    if args.matrix:
+        matrix = get_version_matrix(inputs, **options)
+    else:
+        matrix = get_version_matrix(
+            inputs,
+            bumps=[args.bump],
+            incr_options=[bool(args.incr_from_release)],
+            commit_count_options=[args.commit_count_as],
+            **options
+        )
+    if args.json:
+        last_release = inputs["last_release"]
+        print(
+            json.dumps(
+                dict(
+                    current=str(inputs["current"]),
+                    last_release=str(last_release) if last_release else None,
+                    file_triggers=sorted(inputs["file_triggers"]),
+                    commit_count=inputs["commit_count"],
+                    matrix=matrix,
+                ),
+                indent=2,
+            )
+        )
+    else:
+        print(format_version_matrix(matrix))
+
+
+def write_plan_from_cli(args, command_line_updates):
+    """Writes the plan of a run with the given options, for `apply`"""
+    plan = make_plan(
+        config_path=args.config,
+        set_to=args.set,
+        commit_count_as=args.commit_count_as,
+        lock=args.lock,
+        release=args.release,
+        bump=args.bump,
+        enable_file_triggers=args.file_triggers,
+        incr_from_release=args.incr_from_release,
+        persist_from=args.persist_from,
+        persist_to=args.persist_to,
         **command_line_updates
     )
-    _LOG.info("previously: %s", old)
-    _LOG.info("currently:  %s", new)
-    _LOG.debug("updates:\n%s", pprint.pformat(updates))
+    with open(args.plan_file, "w") as fh:
+        json.dump(plan, fh, indent=2, default=str)
+    print(plan["new"])
+
 
-    if args.print_file_triggers:
-        commit = get_dvcs_commit_for_version(
-            persist_from=args.persist_from, version=old
+def apply_from_cli(args):
+    """Applies a plan written by `plan --plan-file`"""
+    with open(args.plan_file) as fh:
+        plan = json.load(fh)
+    written = apply_plan(plan)
+    _LOG.info("wrote %s", ", ".join(written) or "nothing")
+    print(plan["new"])
+
+
+def index_from_cli(args):
+    """Brings the key index up to date"""
+    load_config(args.config)
+    index, read = key_index.build()
+    print("indexed %s files (%s read)" % (len(index.files), read))
+
+
+def check_from_cli(args, keys):
+    """Checks that each key has the same value everywhere it's defined in the tree
+
+    :param keys: the keys to check (default: those in the configured `key_aliases`)
+    """
+    load_config(args.config)
+    index, _ = key_index.build()
+    keys = sorted(keys or config.key_aliases)
+    inconsistent = key_index.find_inconsistencies(index, keys)
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    key: [
+                        dict(path=path, line=line_index + 1, value=value)
+                        for path, line_index, _, _, value in occurrences
+                    ]
+                    for key, occurrences in inconsistent.items()
+                },
+                indent=2,
+            )
         )
-        _, files = detect_file_triggers(commit)
-        print("\n".join(files))
     else:
-        print(new)
+        for key, occurrences in sorted(inconsistent.items()):
+            print("%s has different values:" % key)
+            for path, line_index, _, _, value in occurrences:
+                print("  %s:%s: %s" % (path, line_index + 1, value))
+    if inconsistent:
+        exit(1)
 
 
 __name__ == "__main__" and main_from_cli()
@@ -0,0 +1,47 @@
+"""Persistent caches, kept inside the git directory of the repository
+
+The directory is given by the backend in use, so an in-memory repository has its own.
+"""
+import json
+import logging
+import os
+
+from auto_version import vcs
+
+_LOG = logging.getLogger(__file__)
+
+CACHE_DIR = "auto_version"
+
+
+def get_cache_path(name):
+    """Path of the named cache file, within the backend's cache directory"""
+    return os.path.join(vcs.get_backend().cache_dir(), CACHE_DIR, name + ".json")
+
+
+def load(name):
+    """Loads the named cache, or an empty one if it's missing or unreadable"""
+    return load_with_mtime(name)[0]
+
+
+def load_with_mtime(name):
+    """As `load`, also giving when the cache was written (as st_mtime_ns, None if it's missing)"""
+    path = get_cache_path(name)
+    try:
+        with open(path) as fh:
+            return json.load(fh), os.fstat(fh.fileno()).st_mtime_ns
+    except (IOError, OSError, ValueError):
+        _LOG.debug("no usable cache at %s", path)
+        return {}, None
+
+
+def save(name, data):
+    """Saves the named cache, replacing it in one step so readers never see a partial file"""
+    path = get_cache_path(name)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(temp_path, "w") as fh:
+        json.dump(data, fh)
+    os.replace(temp_path, path)
@@ -1,75 +1,90 @@
 """Load cli options"""
 import argparse
 import os
+import sys
 
 from auto_version import __version__
 from auto_version.config import Constants
 from auto_version.definitions import SemVerSigFig
 
+# commands, which take the same options as a run (the default is to update the version)
+COMMANDS = dict(
+    plan="Shows the new version, without changing anything.",
+    apply="Writes the targets of a plan made with `plan --plan-file`.",
+    index="Brings the index of where keys are defined up to date.",
+    check="Checks that each key has the same value everywhere it's defined.",
+)
 
-def get_cli():
-    """Load cli options"""
-    parser = argparse.ArgumentParser(
-        prog="auto_version",
-        description="auto version v%s: a tool to control version numbers" % __version__,
-    )
-    parser.add_argument(
+
+def add_options(parser, suppress_defaults=False):
+    """Adds the options of a run
+
+    :param suppress_defaults: leave out options that aren't given, so a command's
+        parser doesn't replace the values given before the command
+    """
+
+    def add(*names, **kwargs):
+        if suppress_defaults:
+            kwargs["default"] = argparse.SUPPRESS
+        parser.add_argument(*names, **kwargs)
+
+    add(
         "--show",
         "--dry-run",
         action="store_true",
         help="Don't write anything to disk or vcs.",
     )
-    parser.add_argument(
+    add(
         "--bump",
         choices=SemVerSigFig,
         help="Bumps the specified part of SemVer string. "
         "Use this locally to correctly modify the version file.",
     )
-    parser.add_argument(
+    add(
         "--news",
         "--file-triggers",
         action="store_true",
         dest="file_triggers",
         help="Detects need to bump based on presence of files (as specified in config).",
     )
-    parser.add_argument(
+    add(
         "--incr-from-release",
         action="store_true",
         help="Automatically sets version number based on SCIENCE (see docs). Requires use of VCS tags.",
     )
-    parser.add_argument(
+    add(
         "--print-file-triggers",
         action="store_true",
         help="Prints a newline separated list of files detected as bump triggers.",
     )
-    parser.add_argument(
+    add(
         "--set",
         help="Set the SemVer string. Use this locally to set the project version explicitly.",
     )
-    parser.add_argument(
+    add(
         "--commit-count-as",
         choices=SemVerSigFig,
         help="Use the commit count to set the value of the specified field.",
     )
-    parser.add_argument(
+    add(
         "--lock",
         action="store_true",
         help="Locks the SemVer string. "
         "Lock will remain for another call to autoversion before being cleared.",
     )
-    parser.add_argument(
+    add(
         "--release",
         action="store_true",
         default=False,
         help="Marks as a release build, which flags the build as released.",
     )
-    parser.add_argument(
+    add(
         "--version",
         action="store_true",
         default=False,
         help="Prints the version of auto_version itself (self-version).",
     )
-    parser.add_argument(
+    add(
         "--persist-from",
         choices={
             Constants.FROM_SOURCE,
@@ -82,7 +97,7 @@ def get_cli():
         default=[],
         help="Where the current version is stored. Looks for each source in order. (default: source files)",
     )
-    parser.add_argument(
+    add(
         "--persist-to",
         action="append",
         choices={Constants.TO_SOURCE, Constants.TO_VCS},
@@ -90,16 +105,103 @@ def get_cli():
         help="Where the new version is stored. This could be in multiple places at once. (default: source files)",
     )
     default_config_file_path = os.path.join(os.getcwd(), "pyproject.toml")
-    parser.add_argument(
+    add(
         "--config",
         help="Configuration file path. (default: %s)." % default_config_file_path,
         default=default_config_file_path,
     )
-    parser.add_argument(
+    add(
+        "--component-config",
+        action="append",
+        default=[],
+        help="Configuration file of another component to version in the same run, "
+        "sharing a single listing of the vcs tags. Can be specified multiple times.",
+    )
+    add(
         "-v",
         "--verbosity",
         action="count",
         default=0,
         help="increase output verbosity. " "can be specified multiple times",
     )
-    return parser.parse_known_args()
+    add(
+        "--updates-file",
+        help="A json or toml file of extra key-value pairs to replace (or `-` to read from stdin). "
+        "Any given as KEY=VALUE arguments take precedence.",
+    )
+    add(
+        "--watch",
+        action="store_true",
+        help="Keeps the version in the source files up to date, as file triggers, vcs refs "
+        "or the config change. Runs until interrupted.",
+    )
+    add(
+        "--json",
+        action="store_true",
+        help="Prints the result as json.",
+    )
+    add(
+        "--depfile",
+        help="Writes the files the run read from (config, targets, trigger directories "
+        "and git refs) to this path, as a make depfile for --stamp.",
+    )
+    add(
+        "--stamp",
+        help="Writes the new version to this path after the run, "
+        "as the output for build systems to compare with the --depfile inputs.",
+    )
+
+
+def add_commands(parser):
+    """Adds the commands, each with the options of a run and its own"""
+    subparsers = parser.add_subparsers(dest="command")
+    commands = {}
+    for name, help_text in COMMANDS.items():
+        commands[name] = subparsers.add_parser(
+            name, help=help_text, description=help_text
+        )
+        add_options(commands[name], suppress_defaults=True)
+    commands["plan"].add_argument(
+        "--matrix",
+        action="store_true",
+        help="Shows the new version for every combination of "
+        "--bump, --incr-from-release and --commit-count-as.",
+    )
+    commands["plan"].add_argument(
+        "--plan-file",
+        help="Writes the plan of the run (the new version, and the checked writes "
+        "to make to each target) to this file, for `apply`.",
+    )
+    commands["apply"].add_argument(
+        "--plan-file", required=True, help="The plan to write."
+    )
+    commands["check"].add_argument(
+        "keys",
+        nargs="*",
+        help="The keys to check. (default: those in the configured key_aliases)",
+    )
+
+
+def get_cli(argv=None):
+    """Load cli options
+
+    Arguments that aren't options (e.g. KEY=VALUE extra replacements) are returned
+    separately. A command can follow the options of the run, e.g. `--config x plan`.
+
+    :param argv: arguments (default: from the command line)
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(
+        prog="auto_version",
+        description="auto version v%s: a tool to control version numbers" % __version__,
+    )
+    add_options(parser)
+    # without a command, an extra replacement would be taken for an unknown command
+    if any(arg in COMMANDS for arg in argv):
+        add_commands(parser)
+    args, others = parser.parse_known_args(argv)
+    unknown = [arg for arg in others if arg.startswith("-")]
+    if unknown:
+        parser.error("unrecognized arguments: %s" % " ".join(unknown))
+    args.command = getattr(args, "command", None)
+    return args, others
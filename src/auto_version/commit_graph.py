@@ -0,0 +1,69 @@
+"""The commits reachable from HEAD, for answering many ancestry queries at once
+
+Rather than asking git about each tag in turn (one `git merge-base` process per tag)
+we list the history of HEAD once: a tag is an ancestor of HEAD if its commit is in it.
+Only membership is needed, so just the commit ids are kept, not the parent links.
+"""
+import logging
+
+from auto_version import processes
+
+_LOG = logging.getLogger(__file__)
+
+
+class CommitGraph(object):
+    """The commits reachable from a revision"""
+
+    def __init__(self, shas):
+        """New graph instance
+
+        :param shas: commit ids, in the order `git rev-list` lists them
+        """
+        self.shas = shas
+        self._index = {sha: i for i, sha in enumerate(shas)}
+
+    def __len__(self):
+        return len(self.shas)
+
+    def __contains__(self, sha):
+        return sha in self._index
+
+    @classmethod
+    def parse(cls, lines):
+        """Builds a graph from lines of `git rev-list` output (any parents listed are ignored)"""
+        return cls([line.split()[0] for line in lines if line.strip()])
+
+    @classmethod
+    def from_git(cls, *revs):
+        """Loads all the commits reachable from the given revisions (default: HEAD)"""
+        cmd = ["git", "rev-list"] + list(revs or ["HEAD"])
+        output = processes.check_output(cmd).decode("utf8")
+        graph = cls.parse(output.splitlines())
+        _LOG.debug("loaded commit graph of %s commits", len(graph))
+        return graph
+
+    def index_of(self, sha):
+        """The index of a commit, or None if it is not in the graph"""
+        return self._index.get(sha)
+
+
+def get_tag_commits():
+    """Maps every tag in the repository to the commit it points at
+
+    Annotated tags are peeled, so the result can be used directly with a CommitGraph.
+    """
+    output = processes.check_output(
+        [
+            "git",
+            "for-each-ref",
+            "--format=%(refname:short) %(objectname) %(*objectname)",
+            "refs/tags",
+        ]
+    ).decode("utf8")
+    tags = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            # the peeled object name is only present for annotated tags
+            tags[parts[0]] = parts[-1]
+    return tags
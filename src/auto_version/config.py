@@ -1,4 +1,5 @@
 """Configuration system for the auto_version tool"""
+import copy
 import logging
 import os
 
@@ -32,6 +33,15 @@ class Constants(object):
     TO_SOURCE = "source"
     TO_VCS = "vcs"
 
+    # which definition of a key is used, if it's defined more than once
+    FIRST_WINS = "first"
+    LAST_WINS = "last"
+
+    # names of persistent caches
+    COMMIT_COUNT_CACHE = "commit_counts"
+    TRIGGER_CACHE = "triggers"
+    KEY_INDEX_CACHE = "key_index"
+
     # as used in toml file
     CONFIG_KEY = "AutoVersionConfig"
 
@@ -73,6 +83,20 @@ class AutoVersionConfig(object):
     PRERELEASE_TOKEN = "pre"
     BUILD_TOKEN = "build"
     TAG_TEMPLATE = "release/{version}"
+    KEY_PRECEDENCE = Constants.LAST_WINS  # use the first or last definition of a key in the targets
+    USE_COMMIT_GRAPH = False  # load history once to answer ancestry queries in memory
+    INCREMENTAL_COMMIT_COUNT = False  # count commits from the last release, using cached counts
+    BOUNDED_TAG_SCAN = False  # find the previous release using git's ordering, stopping at the first
+    SHALLOW_REMOTE = "origin"  # where to fetch more history from, in a shallow clone
+    SHALLOW_DEEPEN_STEP = 0  # commits to deepen a shallow clone by, when tags can't be checked
+    SHALLOW_DEEPEN_LIMIT = 1000  # most commits to deepen a shallow clone by, in total
+    VCS_BACKEND = "git"  # `git` (run git commands) or `refs` (read tags from the git directory)
+    EARLY_EXIT_TRIGGERS = False  # only find the most significant file trigger, not every trigger file
+    USE_KEY_INDEX = False  # find keys in the targets using the index from `auto_version index`
+    CACHE_TRIGGERS = False  # reuse file trigger results, until the commits or trigger files change
+    PARALLEL_PERSIST_FROM = False  # try all the `persist_from` sources at once, rather than in turn
+    PARALLEL_SCAN_THRESHOLD = 0  # bytes: scan targets at least this big in parallel (0 to disable)
+    PARALLEL_SCAN_WORKERS = 0  # processes for parallel scanning (0 for one per cpu)
     MIN_NONE_RELEASE_SIGFIG = (
         "prerelease"
     )  # the minimum significant figure to increment is this isn't a release
@@ -91,6 +115,33 @@ class AutoVersionConfig(object):
         return cls._deflate()
 
 
+# the built-in regexers, kept as configured, because they are compiled in place when loaded
+DEFAULT_REGEXERS = dict(AutoVersionConfig.regexers)
+
+
+def get_settings(config):
+    """A copy of the current settings, for `set_settings`"""
+    return {
+        k: copy.deepcopy(v) for k, v in vars(config).items() if not k.startswith("_")
+    }
+
+
+def set_settings(config, settings):
+    """Puts back settings from `get_settings`, dropping any set since
+
+    A config file only sets the keys it has, so this is done before loading
+    another file to stop it keeping the last file's values for the rest.
+    """
+    for k in [k for k in vars(config) if not k.startswith("_") and k not in settings]:
+        delattr(config, k)
+    for k, v in settings.items():
+        setattr(config, k, copy.deepcopy(v))
+
+
+# the settings before any config file is loaded
+DEFAULT_SETTINGS = get_settings(AutoVersionConfig)
+
+
 def get_or_create_config(path, config):
     """Using TOML format, load config from given path, or write out example based on defaults"""
     if os.path.isfile(path):
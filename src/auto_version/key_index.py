@@ -0,0 +1,226 @@
+"""A persistent index of where keys are defined, across the files of the repository
+
+Every file in the tree with an extension we have a regex for is indexed: for each
+line that defines a key, we record the key, the line number, and the span and text
+of its value. Keys are found as when reading the targets (a match at the start of
+each stripped line). The index is kept in the git directory, and a file is only
+read again when its stat data changes (or the regexes change).
+
+As in git, a file modified no earlier than the index was written is "racy": a
+change made just after it was read could have left the same stat data, so it is
+read again until the index has been written after it.
+"""
+import logging
+import os
+
+from auto_version import cache
+from auto_version import scanners
+from auto_version import vcs
+from auto_version.config import AutoVersionConfig as config
+from auto_version.config import Constants
+
+_LOG = logging.getLogger(__file__)
+
+
+def get_stamp(path):
+    """Changes whenever the file is written, or replaced"""
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino]
+
+
+def get_patterns():
+    """The configured regexes, as strings"""
+    return {
+        ext: getattr(regexer, "pattern", regexer)
+        for ext, regexer in config.regexers.items()
+    }
+
+
+def scan_file(path, regexer):
+    """Finds the key definitions in a file
+
+    :returns: list of [key, line index, value start, value end, value], in line order.
+        The value span is within the line (-1, -1 if there's no value)
+    """
+    definitions = []
+    with open(path) as fh:
+        for line_index, line in enumerate(fh):
+            content = line.strip()
+            match = regexer.match(content)
+            if not match:
+                continue
+            start, end = match.span(Constants.VALUE_GROUP)
+            if start >= 0:
+                offset = len(line) - len(line.lstrip())
+                start += offset
+                end += offset
+            definitions.append(
+                [
+                    match.group(Constants.KEY_GROUP),
+                    line_index,
+                    start,
+                    end,
+                    match.group(Constants.VALUE_GROUP),
+                ]
+            )
+    return definitions
+
+
+class KeyIndex(object):
+    """Where each key is defined, by file
+
+    Files are recorded by their path from the top of the working tree, so the same
+    entries are used wherever in the tree we're run from.
+    """
+
+    def __init__(self, patterns, files=None, written=None, root=None):
+        """New index instance
+
+        :param patterns: the regexes the index was built with, by extension
+        :param files: dict of path (from the root) to dict of its stamp and key definitions
+        :param written: when the index was written (as st_mtime_ns), for racy files
+        :param root: the top directory of the working tree (default: the current directory)
+        """
+        self.patterns = patterns
+        self.files = files or {}
+        self.written = written
+        self.root = root or os.getcwd()
+        self.changed = False
+        # the files read by this instance, whose entries are current even if racy
+        self._read = set()
+
+    @classmethod
+    def load(cls):
+        """Loads the index, discarding it if the configured regexes have changed"""
+        data, written = cache.load_with_mtime(Constants.KEY_INDEX_CACHE)
+        patterns = get_patterns()
+        root = vcs.get_backend().root()
+        if data.get("patterns") != patterns:
+            _LOG.debug("key index: regexes have changed, starting afresh")
+            return cls(patterns, root=root)
+        return cls(patterns, data.get("files"), written, root)
+
+    def key(self, path):
+        """The entry for a path (relative to the current directory, or absolute)"""
+        return os.path.normpath(os.path.relpath(os.path.abspath(path), self.root))
+
+    def is_current(self, key, stamp):
+        """Whether the entry of a file can be used, given its stamp now"""
+        entry = self.files.get(key)
+        if entry is None or entry["stamp"] != stamp:
+            return False
+        if key in self._read:
+            return True
+        # racy: modified no earlier than the index was written
+        return self.written is not None and stamp[0] < self.written
+
+    def save(self):
+        if self.changed:
+            cache.save(
+                Constants.KEY_INDEX_CACHE,
+                dict(patterns=self.patterns, files=self.files),
+            )
+            self.changed = False
+
+    def definitions(self, path):
+        """The key definitions in a file, read again only if it has changed"""
+        return self._definitions(self.key(path))
+
+    def _definitions(self, key):
+        path = os.path.join(self.root, key)
+        stamp = get_stamp(path)
+        if not self.is_current(key, stamp):
+            file_ext = os.path.splitext(path)[1]
+            regexer = scanners.for_extension(file_ext, config.regexers[file_ext])
+            self.files[key] = dict(stamp=stamp, keys=scan_file(path, regexer))
+            self._read.add(key)
+            self.changed = True
+        return self.files[key]["keys"]
+
+    def keypairs(self, path, keys=None, last_wins=False):
+        """Key-value pairs of a file, as `extract_keypairs` finds them with `first_wins`
+
+        :param last_wins: search from the end of the file
+        """
+        definitions = self.definitions(path)
+        remaining = set(keys) if keys is not None else None
+        pairs = {}
+        for key, _, _, _, value in reversed(definitions) if last_wins else definitions:
+            pairs.setdefault(key, value)
+            if remaining is not None:
+                remaining.discard(key)
+                if not remaining:
+                    break
+        return pairs
+
+    def defines_any(self, path, keys):
+        """Whether a file defines any of the keys"""
+        return any(definition[0] in keys for definition in self.definitions(path))
+
+    def update(self, keys):
+        """Indexes the files, and forgets any others
+
+        :param keys: paths of the files, from the root
+        :returns: number of files that were read
+        """
+        keys = set(keys)
+        for key in set(self.files) - keys:
+            del self.files[key]
+            self.changed = True
+        read = 0
+        for key in sorted(keys):
+            before = self.files.get(key)
+            self._definitions(key)
+            if self.files[key] is not before:
+                read += 1
+        return read
+
+    def occurrences(self, key):
+        """Every definition of a key
+
+        :returns: list of (path from the root, line index, value start, value end, value)
+        """
+        return [
+            (path, line_index, start, end, value)
+            for path in sorted(self.files)
+            for found, line_index, start, end, value in self.files[path]["keys"]
+            if found == key
+        ]
+
+
+def get_indexable_files(root):
+    """The files in the tree with an extension we have a regex for
+
+    :returns: their paths from the root
+    """
+    return [
+        os.path.normpath(path)
+        for path in vcs.get_backend().list_files()
+        if os.path.splitext(path)[1] in config.regexers
+        and os.path.isfile(os.path.join(root, path))
+    ]
+
+
+def build():
+    """Brings the persistent index up to date with the files in the tree
+
+    :returns: the index, and the number of files that were read
+    """
+    index = KeyIndex.load()
+    read = index.update(get_indexable_files(index.root))
+    index.save()
+    _LOG.debug("key index: %s files, %s read", len(index.files), read)
+    return index, read
+
+
+def find_inconsistencies(index, keys):
+    """Keys that are defined with more than one value across the tree
+
+    :returns: dict of key to its definitions (as from `KeyIndex.occurrences`)
+    """
+    inconsistent = {}
+    for key in keys:
+        occurrences = index.occurrences(key)
+        if len({occurrence[-1] for occurrence in occurrences}) > 1:
+            inconsistent[key] = occurrences
+    return inconsistent
@@ -0,0 +1,115 @@
+"""Runs git in processes that another thread can stop
+
+A thread working within a `ProcessGroup` adds each process it starts to the group.
+Stopping the group (from any thread) kills those processes, and any the thread starts
+afterwards, so work whose result is no longer needed finishes straight away.
+"""
+import contextlib
+import logging
+import subprocess
+import threading
+
+_LOG = logging.getLogger(__file__)
+
+_local = threading.local()
+
+
+class Stopped(Exception):
+    """The work was stopped, as its result isn't needed"""
+
+
+class ProcessGroup(object):
+    """The processes started by the threads working within the group"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.stopped = False
+
+    @contextlib.contextmanager
+    def active(self):
+        """Adds the processes this thread starts within the block to the group"""
+        _local.group = self
+        try:
+            yield self
+        finally:
+            _local.group = None
+
+    def add(self, process):
+        """Adds a process, killing it if the group has been stopped
+
+        :raises Stopped: if the group has been stopped
+        """
+        with self._lock:
+            if not self.stopped:
+                self._processes.add(process)
+                return
+        process.kill()
+        process.communicate()
+        raise Stopped()
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def stop(self):
+        """Kills the processes that are running, and any started from now on"""
+        with self._lock:
+            self.stopped = True
+            processes = list(self._processes)
+        for process in processes:
+            _LOG.debug("stopping %s", process.args)
+            try:
+                process.kill()
+            except OSError:
+                # it has already finished
+                pass
+
+
+def get_group():
+    """The group of the current thread, if any"""
+    return getattr(_local, "group", None)
+
+
+def popen(cmd, **kwargs):
+    """As `subprocess.Popen`, adding the process to the current thread's group"""
+    process = subprocess.Popen(cmd, **kwargs)
+    group = get_group()
+    if group is not None:
+        group.add(process)
+    return process
+
+
+def finished(process):
+    """Removes a process that has finished from the current thread's group
+
+    :raises Stopped: if the group has been stopped, as the process may have been killed
+    """
+    group = get_group()
+    if group is not None:
+        group.discard(process)
+        if group.stopped:
+            raise Stopped()
+
+
+def check_output(cmd, input=None):
+    """As `subprocess.check_output`, in the current thread's group"""
+    process = popen(
+        cmd,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+    )
+    output, _ = process.communicate(input)
+    finished(process)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
+
+
+def check_call(cmd):
+    """As `subprocess.check_call`, in the current thread's group"""
+    process = popen(cmd)
+    process.wait()
+    finished(process)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
@@ -1,7 +1,40 @@
 """Regex substitution handler"""
+import re
+
 from auto_version.config import Constants
 
 
+def key_pattern(keys):
+    """A regex pattern that finds the longest of the keys at each position
+
+    The keys are arranged as a trie, so the regex only follows the keys that share
+    a prefix with the text. That keeps it fast even with hundreds of keys,
+    where a plain alternation would try every key at every position.
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _trie_pattern(trie)
+
+
+def _trie_pattern(node):
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+    if "" in node:
+        # a key ends here, but a longer key is preferred
+        return "(?:%s)?" % pattern
+    return pattern
+
+
 class ReplacementHandler(object):
     """Tool used by regex when performing substitutions
 
@@ -15,6 +48,18 @@ class ReplacementHandler(object):
         """
         self.params = params
         self.missing = set(params.keys())
+        self._key_finder = None
+
+    @property
+    def key_finder(self):
+        """A regex that finds any of our keys
+
+        A line can only be replaced if it contains one of our keys, so this finds
+        the lines worth trying the full replacement regex on
+        """
+        if self._key_finder is None:
+            self._key_finder = re.compile(key_pattern(self.params) or "(?!)")
+        return self._key_finder
 
     def __call__(self, match):
         """Given a regex Match Object, return the entire replacement string
@@ -0,0 +1,360 @@
+"""Linear time scanners for the built-in key-value regexes
+
+Some of the built-in regexes backtrack heavily on long lines (e.g. minified json,
+or C# lines with lots of whitespace). Each scanner here finds exactly the same KEY
+and VALUE spans (and overall match) as its regex, in a single pass over the line.
+They provide the parts of the regex interface we use, so they are drop-in replacements.
+
+Custom regexes (i.e. anything other than the built-in pattern for an extension)
+are used as they are.
+"""
+import re
+
+from auto_version.config import Constants
+from auto_version.config import DEFAULT_REGEXERS
+
+QUOTES = "'\""
+EXCLUDED_VALUE_CHARS = "\r\n\t\f\v\"'"
+EXCLUDED_JSON_VALUE_CHARS = '\r\n\t\f\v",'
+EXCLUDED_YAML_VALUE_CHARS = "'\",[]#"
+YAML_VALUE_CHARS = "-.+\\/:"
+JSON_PLAIN_VALUE = re.compile(r"[^\r\n\t\f\v\",\\]*")
+
+
+def _is_word(char):
+    return char.isalnum() or char == "_"
+
+
+def _is_json_key(char):
+    return char == ":" or _is_word(char)
+
+
+def _is_tab_or_space(char):
+    return char in "\t "
+
+
+def _is_value(char):
+    return char not in EXCLUDED_VALUE_CHARS
+
+
+def _is_json_value(char):
+    return char not in EXCLUDED_JSON_VALUE_CHARS
+
+
+def _is_yaml_value(char):
+    return _is_word(char) or char in YAML_VALUE_CHARS
+
+
+def _is_yaml_value_end(char):
+    return not (char in EXCLUDED_YAML_VALUE_CHARS or char.isspace())
+
+
+def _is_not_space(char):
+    return not char.isspace()
+
+
+def _skip(string, index, accept):
+    """Index of the first character from `index` that isn't accepted"""
+    length = len(string)
+    while index < length and accept(string[index]):
+        index += 1
+    return index
+
+
+def _line_end(string, index):
+    """Equivalent to a trailing `.*`"""
+    end = string.find("\n", index)
+    return len(string) if end < 0 else end
+
+
+def _value_start(string, start, end, accept):
+    """Where a value starts, after some whitespace string[start:end] and an optional quote
+
+    This is the order in which the regex tries: after a quote first, then giving back
+    whitespace one character at a time.
+    """
+    length = len(string)
+    if end + 1 < length and string[end] in QUOTES and accept(string[end + 1]):
+        yield end + 1
+    for index in range(min(end, length - 1), start - 1, -1):
+        if accept(string[index]):
+            yield index
+
+
+class ScanMatch(object):
+    """The parts of a regex Match Object used for key-value replacement"""
+
+    __slots__ = ("string", "_spans", "_end")
+
+    def __init__(self, string, key_span, value_span, end):
+        self.string = string
+        self._spans = {Constants.KEY_GROUP: key_span, Constants.VALUE_GROUP: value_span}
+        self._end = end
+
+    def span(self, group=0):
+        return (0, self._end) if group == 0 else self._spans[group]
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def group(self, group=0):
+        start, end = self.span(group)
+        return None if start < 0 else self.string[start:end]
+
+    def groupdict(self):
+        return {name: self.group(name) for name in self._spans}
+
+
+class Scanner(object):
+    """Base scanner: subclasses provide `_scan`, equivalent to their regex"""
+
+    extension = None
+
+    @property
+    def pattern(self):
+        return DEFAULT_REGEXERS[self.extension]
+
+    def _scan(self, string):
+        """:returns: (key span, value span, match end) or None"""
+        raise NotImplementedError()
+
+    def match(self, string):
+        result = self._scan(string)
+        return ScanMatch(string, *result) if result else None
+
+    def sub(self, repl, string):
+        """Equivalent to `regex.sub` with a callable: our patterns only match at the start"""
+        match = self.match(string)
+        if not match:
+            return string
+        return repl(match) + string[match.end():]
+
+
+class PythonScanner(Scanner):
+    extension = ".py"
+
+    def _scan(self, string):
+        length = len(string)
+        index = _skip(string, 0, str.isspace)
+        if index < length and string[index] in QUOTES:
+            index += 1
+        key_start = index
+        index = _skip(string, index, _is_word)
+        if index == key_start:
+            return None
+        key_end = index
+        if index < length and string[index] in QUOTES:
+            index += 1
+        index = _skip(string, index, str.isspace)
+        if index >= length or string[index] not in "=:":
+            return None
+        space_start = index + 1
+        space_end = _skip(string, space_start, str.isspace)
+        for value_start in _value_start(string, space_start, space_end, _is_value):
+            value_end = end = _skip(string, value_start, _is_value)
+            if end < length and string[end] in QUOTES:
+                end += 1
+            if end < length and string[end] == ",":
+                end += 1
+            return (key_start, key_end), (value_start, value_end), end
+        return None
+
+
+class JsonScanner(Scanner):
+    extension = ".json"
+
+    @staticmethod
+    def _value_end(string, index):
+        """A run of characters, each optionally surrounded by escaped quotes"""
+        length = len(string)
+        while True:
+            plain_end = JSON_PLAIN_VALUE.match(string, index).end()
+            if plain_end > index:
+                # skip straight over the characters that can't be part of an escaped quote
+                index = plain_end
+            elif (
+                string.startswith('\\"', index)
+                and index + 2 < length
+                and _is_json_value(string[index + 2])
+            ):
+                index += 3
+            elif index < length and _is_json_value(string[index]):
+                index += 1
+            else:
+                return index
+            if string.startswith('\\"', index):
+                index += 2
+
+    def _scan(self, string):
+        length = len(string)
+        index = _skip(string, 0, str.isspace)
+        if index < length and string[index] == '"':
+            index += 1
+        key_start = index
+        run_end = _skip(string, index, _is_json_key)
+        if run_end == key_start:
+            return None
+        # the key may contain colons, so the regex gives back the key until a colon follows it
+        key_ends = [run_end] + [
+            i for i in range(run_end - 1, key_start, -1) if string[i] == ":"
+        ]
+        for key_end in key_ends:
+            index = key_end
+            if index < length and string[index] == '"':
+                index += 1
+            index = _skip(string, index, str.isspace)
+            if index >= length or string[index] != ":":
+                continue
+            space_start = index + 1
+            space_end = _skip(string, space_start, _is_tab_or_space)
+            for value_start in _value_start(
+                string, space_start, space_end, _is_json_value
+            ):
+                value_end = end = self._value_end(string, value_start)
+                if end < length and string[end] in QUOTES:
+                    end += 1
+                if end < length and string[end] == ",":
+                    end += 1
+                return (key_start, key_end), (value_start, value_end), end
+        return None
+
+
+class YamlScanner(Scanner):
+    extension = ".yaml"
+
+    def _scan(self, string):
+        length = len(string)
+        index = _skip(string, 0, str.isspace)
+        if index < length and string[index] in QUOTES:
+            index += 1
+        key_start = index
+        index = _skip(string, index, _is_word)
+        if index == key_start:
+            return None
+        key_end = index
+        if index < length and string[index] in QUOTES:
+            index += 1
+        index = _skip(string, index, str.isspace)
+        if index >= length or string[index] != ":":
+            return None
+        value_start = _skip(string, index + 1, str.isspace)
+        if value_start < length and string[value_start] in QUOTES:
+            value_start += 1
+        # a run of value characters, ending in any character that's allowed to end a value
+        run_end = _skip(string, value_start, _is_yaml_value)
+        if run_end < length and _is_yaml_value_end(string[run_end]):
+            value_end = run_end + 1
+        elif run_end > value_start:
+            value_end = run_end
+        else:
+            return None
+        return (
+            (key_start, key_end),
+            (value_start, value_end),
+            _line_end(string, value_end),
+        )
+
+
+class CSharpScanner(Scanner):
+    extension = ".cs"
+
+    def _scan(self, string):
+        length = len(string)
+        # the key is the last word of the leading words and whitespace, followed by `=` or `:`
+        assignment = _skip(string, 0, lambda char: _is_word(char) or char.isspace())
+        if assignment >= length or string[assignment] not in "=:":
+            return None
+        key_end = assignment
+        if (
+            key_end > 1
+            and string[key_end - 1].isspace()
+            and _is_word(string[key_end - 2])
+        ):
+            key_end -= 1
+        key_start = key_end
+        while key_start > 0 and _is_word(string[key_start - 1]):
+            key_start -= 1
+        if key_start == key_end:
+            return None
+        space_start = assignment + 1
+        space_end = _skip(string, space_start, str.isspace)
+        value_ends = {}
+        for value_start in _value_start(string, space_start, space_end, _is_value):
+            # within the whitespace, consecutive starts share the same end
+            value_end = value_ends.get(value_start + 1) or _skip(
+                string, value_start, _is_value
+            )
+            value_ends[value_start] = value_end
+            if value_end < length and string[value_end] in QUOTES:
+                end = _line_end(string, value_end + 1)
+                return (key_start, key_end), (value_start, value_end), end
+        return None
+
+
+class CSProjScanner(Scanner):
+    extension = ".csproj"
+
+    def _scan(self, string):
+        length = len(string)
+        if not string.startswith("<"):
+            return None
+        key_end = _skip(string, 1, _is_word)
+        if key_end == 1 or key_end >= length or string[key_end] != ">":
+            return None
+        value_start = key_end + 1
+        run_end = _skip(string, value_start, _is_not_space)
+        # the value is as long as possible, while still being followed by a closing tag
+        close = string.rfind("</", value_start + 1, run_end)
+        while close >= 0:
+            tag_end = _skip(string, close + 2, _is_word)
+            if tag_end > close + 2 and tag_end < length and string[tag_end] == ">":
+                return (1, key_end), (value_start, close), tag_end + 1
+            close = string.rfind("</", value_start + 1, close + 1)
+        return None
+
+
+class PropertiesScanner(Scanner):
+    extension = ".properties"
+
+    def _scan(self, string):
+        length = len(string)
+        key_start = _skip(string, 0, str.isspace)
+        key_end = _skip(string, key_start, _is_word)
+        if key_end == key_start:
+            return None
+        index = _skip(string, key_end, str.isspace)
+        if index >= length or string[index] != "=":
+            return None
+        value_start = _skip(string, index + 1, _is_tab_or_space)
+        if value_start < length and _is_value(string[value_start]):
+            value_end = _skip(string, value_start, _is_value)
+            return (key_start, key_end), (value_start, value_end), value_end
+        # the value is optional
+        return (key_start, key_end), (-1, -1), value_start
+
+
+SCANNERS = {
+    ".json": JsonScanner(),
+    ".yaml": YamlScanner(),
+    ".yml": YamlScanner(),
+    ".py": PythonScanner(),
+    ".cs": CSharpScanner(),
+    ".csproj": CSProjScanner(),
+    ".properties": PropertiesScanner(),
+}
+
+
+def for_extension(file_ext, regexer):
+    """The scanner equivalent to a regexer, if it's the built-in one for the extension
+
+    :param regexer: configured regex (pattern or string)
+    :returns: a scanner, or the regexer itself
+    """
+    scanner = SCANNERS.get(file_ext)
+    pattern = getattr(regexer, "pattern", regexer)
+    if scanner and pattern == DEFAULT_REGEXERS.get(file_ext):
+        return scanner
+    return regexer
@@ -0,0 +1,117 @@
+"""Shares one listing of the tags between many tag templates
+
+In a repository with several components, each with its own `TAG_TEMPLATE`
+(e.g. `svc-a/release/{version}` and `svc-b/release/{version}`), the tags are listed once
+and partitioned between the templates. The fixed prefix of each template is stored in a
+trie, so each tag is only checked against the templates whose prefix it starts with.
+"""
+import contextlib
+import logging
+import re
+
+import semver
+from auto_version import vcs
+
+_LOG = logging.getLogger(__file__)
+
+# a version, within a tag
+VERSION_DETECTOR = r"(\d+\.\d+\.\d+(-\w+.\d+)?(\+\w+.\d+)?)"
+PLACEHOLDER = "{version}"
+
+_active = []
+
+
+def template_regex(template):
+    """A regex that matches tags made from the template, capturing the version"""
+    re_safe_placeholder = r"A_PLACEHOLDER_FOR_THE_VERSION_DETECTOR"
+    return (
+        "^"
+        + re.escape(template.replace(PLACEHOLDER, re_safe_placeholder)).replace(
+            re_safe_placeholder, VERSION_DETECTOR
+        )
+        + "$"
+    )
+
+
+class TagRouter(object):
+    """Partitions tags between tag templates"""
+
+    def __init__(self, templates):
+        """New router instance
+
+        :param templates: the tag templates to find versions for
+        """
+        self._trie = {}
+        self._regexes = {}
+        self._versions = {}
+        for template in set(templates):
+            self._versions[template] = set()
+            if PLACEHOLDER not in template:
+                # the template has no version in it
+                continue
+            self._regexes[template] = re.compile(template_regex(template))
+            node = self._trie
+            for char in template.partition(PLACEHOLDER)[0]:
+                node = node.setdefault(char, {})
+            node.setdefault("", []).append(template)
+
+    def __contains__(self, template):
+        return template in self._versions
+
+    @classmethod
+    def from_git(cls, templates):
+        """Routes every tag in the repository, from a single listing"""
+        router = cls(templates)
+        router.add_all(vcs.get_backend().list_tags())
+        _LOG.debug("routed tags for %s templates", len(router._versions))
+        return router
+
+    def candidates(self, tag):
+        """The templates whose fixed prefix the tag starts with"""
+        node = self._trie
+        templates = list(node.get("", []))
+        for char in tag:
+            node = node.get(char)
+            if node is None:
+                break
+            templates.extend(node.get("", []))
+        return templates
+
+    def add(self, tag):
+        """Routes a tag to the template(s) it was made from"""
+        for template in self.candidates(tag):
+            match = self._regexes[template].match(tag)
+            if match:
+                self._versions[template].add(match.group(1))
+
+    def add_all(self, tags):
+        for tag in tags:
+            self.add(tag.strip())
+
+    def versions(self, template):
+        """The versions tagged with the given template, in order
+
+        :rtype: list(semver.VersionInfo)
+        """
+        versions = set()
+        for version in self._versions[template]:
+            try:
+                versions.add(semver.parse_version_info(version))
+            except ValueError:
+                _LOG.debug("version string is not semver-compatible: %r", version)
+        return sorted(versions)
+
+
+def get_active():
+    """The router in use, if any"""
+    return _active[-1] if _active else None
+
+
+@contextlib.contextmanager
+def active(router):
+    """Uses the router for tag lookups, within the block"""
+    _active.append(router)
+    try:
+        yield router
+    finally:
+        _active.pop()
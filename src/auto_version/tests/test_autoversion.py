@@ -1,23 +1,51 @@
+import codecs
 import contextlib
 import functools
 import imp
+import io
+import json
+import locale
 import os
+import random
 import re
 import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import warnings
+from unittest import mock
 
 import semver
 import six
 from auto_version import auto_version_tool
+from auto_version import cache
+from auto_version import key_index
+from auto_version import processes
+from auto_version import scanners
 from auto_version import utils
+from auto_version import vcs
+from auto_version import watch
 from auto_version.auto_version_tool import extract_keypairs
 from auto_version.auto_version_tool import get_all_versions_from_tags
 from auto_version.auto_version_tool import main
 from auto_version.auto_version_tool import replace_lines
+from auto_version.auto_version_tool import replace_text
+from auto_version.cli import get_cli
+from auto_version.commit_graph import CommitGraph
 from auto_version.config import AutoVersionConfig as config
 from auto_version.config import Constants
+from auto_version.config import DEFAULT_REGEXERS
+from auto_version.config import DEFAULT_SETTINGS
+from auto_version.config import get_settings
+from auto_version.config import set_settings
 from auto_version.replacement_handler import ReplacementHandler
+from auto_version.replacement_handler import key_pattern
+from auto_version.version_engine import VersionRecord
 
 
 class TestBumps(unittest.TestCase):
@@ -128,6 +156,23 @@ class TestBumps(unittest.TestCase):
         old, new, updates = self.call(UNRELATED_STRING="apple")
         self.assertEqual(updates["UNRELATED_STRING"], "apple")
 
+    def test_result(self):
+        result = self.call(enable_file_triggers=True, dry_run=True)
+        self.assertEqual(("19.99.0", "19.100.0-dev.1"), (result.old, result.new))
+        self.assertEqual({"minor"}, result.triggers)
+        self.assertIn("example.py", result.trigger_files)
+        self.assertIsNone(result.release_commit)
+        self.assertIn("triggers", result.timings)
+        as_dict = result._asdict()
+        self.assertEqual(sorted(result.trigger_files), as_dict["trigger_files"])
+        self.assertEqual(result.updates, as_dict["updates"])
+
+    def test_result_without_file_triggers(self):
+        result = self.call(bump="minor", dry_run=True)
+        self.assertEqual({"minor"}, result.triggers)
+        self.assertIsNone(result.trigger_files)
+        self.assertIsNone(result._asdict()["trigger_files"])
+
 
 class TestMultiFileBumps(unittest.TestCase):
     call = functools.partial(main, config_path="double_target.toml")
@@ -162,6 +207,169 @@ UNRELATED_STRING = "apple"
 ''')
 
 
+class TestEarlyExitTriggers(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, config, "trigger_patterns", config.trigger_patterns)
+        config.trigger_patterns = {
+            "fix/*": "patch",
+            "breaking/*": "major",
+            "feature/*": "minor",
+            "other/*": "minor",
+        }
+        patcher = mock.patch.object(
+            auto_version_tool, "get_trigger_files", side_effect=self.get_trigger_files
+        )
+        self.checked = []
+        self.files = {}
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_trigger_files(self, pattern, release_commit):
+        self.checked.append(pattern)
+        return self.files.get(pattern, set())
+
+    def test_stops_at_most_significant(self):
+        self.files = {"fix/*": {"fix/a"}, "breaking/*": {"breaking/b"}}
+        triggers = auto_version_tool.detect_significant_file_trigger(None)
+        self.assertEqual({"major"}, triggers)
+        self.assertEqual(["breaking/*"], self.checked)
+
+    def test_same_significance_skipped(self):
+        self.files = {"feature/*": {"feature/a"}, "fix/*": {"fix/a"}}
+        triggers = auto_version_tool.detect_significant_file_trigger(None)
+        self.assertEqual({"minor"}, triggers)
+        self.assertEqual(["breaking/*", "feature/*"], self.checked)
+
+    def test_floor(self):
+        self.files = {"feature/*": {"feature/a"}, "fix/*": {"fix/a"}}
+        triggers = auto_version_tool.detect_significant_file_trigger(None, floor="minor")
+        self.assertEqual(set(), triggers)
+        self.assertEqual(["breaking/*"], self.checked)
+        self.checked = []
+        auto_version_tool.detect_significant_file_trigger(None, floor="major")
+        self.assertEqual([], self.checked)
+
+    def test_same_outcome(self):
+        self.addCleanup(setattr, config, "EARLY_EXIT_TRIGGERS", False)
+        current = semver.parse_version_info("1.2.3-dev.1")
+        last_release = semver.parse_version_info("1.2.2")
+        for files in (
+            {},
+            {"fix/*": {"fix/a"}},
+            {"fix/*": {"fix/a"}, "other/*": {"other/a"}},
+            {"breaking/*": {"breaking/a"}, "feature/*": {"feature/a"}},
+        ):
+            self.files = files
+            for bump in (None, "patch", "minor", "major") if files else ("minor",):
+                new_versions = []
+                for early_exit in (False, True):
+                    config.EARLY_EXIT_TRIGGERS = early_exit
+                    triggers, _ = auto_version_tool.get_triggers_and_files(
+                        bump, True, None
+                    )
+                    new_versions.append(
+                        str(utils.make_new_semver(current, last_release, triggers))
+                    )
+                self.assertEqual(new_versions[0], new_versions[1], (files, bump))
+
+
+class TestPlan(unittest.TestCase):
+    call = functools.partial(main, config_path="example.toml", dry_run=True)
+
+    @classmethod
+    def setUpClass(cls):
+        dir = os.path.dirname(__file__)
+        os.chdir(os.path.abspath(dir))
+
+    def setUp(self):
+        auto_version_tool.load_config("example.toml")
+        self.inputs = auto_version_tool.get_plan_inputs()
+
+    def test_inputs(self):
+        self.assertEqual("19.99.0", str(self.inputs["current"]))
+        self.assertEqual(set(), self.inputs["file_triggers"])
+
+    def test_matrix_matches_main(self):
+        matrix = auto_version_tool.get_version_matrix(self.inputs)
+        self.assertEqual(5 * 2 * 6, len(matrix))
+        for row in matrix:
+            if row["commit_count_as"] not in (None, "patch", "build"):
+                continue
+            old, new, updates = self.call(
+                bump=row["bump"],
+                incr_from_release=row["incr_from_release"],
+                commit_count_as=row["commit_count_as"],
+            )
+            self.assertEqual(new, row["version"], row)
+
+    def test_single_plan(self):
+        matrix = auto_version_tool.get_version_matrix(
+            self.inputs,
+            bumps=["minor"],
+            incr_options=[False],
+            commit_count_options=[None],
+        )
+        self.assertEqual(
+            [
+                dict(
+                    bump="minor",
+                    incr_from_release=False,
+                    commit_count_as=None,
+                    version="19.100.0-dev.1",
+                )
+            ],
+            matrix,
+        )
+        table = auto_version_tool.format_version_matrix(matrix).splitlines()
+        self.assertEqual(
+            ["bump", "incr_from_release", "commit_count_as", "version"],
+            table[0].split(),
+        )
+        self.assertEqual(["minor", "False", "-", "19.100.0-dev.1"], table[1].split())
+
+    def test_no_triggers(self):
+        matrix = auto_version_tool.get_version_matrix(self.inputs, bumps=[None])
+        self.assertEqual({"19.99.0"}, {row["version"] for row in matrix})
+
+    def test_run_options_match_main(self):
+        for options in (
+            dict(release=True),
+            dict(set_to="5.0.0", lock=True),
+            dict(set_to="5.0.0-dev.1", lock=True, release=True),
+        ):
+            matrix = auto_version_tool.get_version_matrix(
+                self.inputs,
+                bumps=["minor"],
+                incr_options=[False],
+                commit_count_options=[None],
+                **options
+            )
+            old, new, updates = self.call(bump="minor", **options)
+            self.assertEqual([new], [row["version"] for row in matrix], options)
+        self.assertEqual("5.0.0", new)
+
+    def test_cli_command(self):
+        args, others = get_cli(["plan", "--matrix", "--json", "EXTRA=1"])
+        self.assertEqual("plan", args.command)
+        self.assertTrue(args.matrix and args.json)
+        self.assertEqual(["EXTRA=1"], others)
+        args, others = get_cli(["--bump", "minor"])
+        self.assertIsNone(args.command)
+
+    def test_cli_command_after_options(self):
+        args, others = get_cli(["--config", "x.toml", "--release", "plan", "--matrix"])
+        self.assertEqual(("plan", "x.toml"), (args.command, args.config))
+        self.assertTrue(args.matrix and args.release)
+        args, _ = get_cli(["check", "--config", "x.toml", "VERSION", "NAME"])
+        self.assertEqual(["VERSION", "NAME"], args.keys)
+
+    def test_cli_command_options(self):
+        for argv in (["--matrix"], ["--plan-file", "plan"], ["apply"]):
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit, msg=argv):
+                    get_cli(argv)
+
+
 class TestUtils(unittest.TestCase):
     def test_is_release(self):
         self.assertTrue(utils.is_release(semver.parse_version_info("1.2.3")))
@@ -252,6 +460,67 @@ class TestNewSemVerLogic(unittest.TestCase):
         # the bump is more significant than the previous release, so perform that bump
         self.check("1.2.2", "1.2.3-dev.1", {"minor"}, "1.3.0-dev.1")
 
+    def test_numeric_override(self):
+        # e.g. the commit count, as the patch
+        new = utils.make_new_semver(
+            semver.parse_version_info("1.2.3"), None, {"minor"}, patch="5"
+        )
+        self.assertEqual("1.3.5-dev.1", str(new))
+        self.assertEqual(5, new.patch)
+
+    def test_token_override(self):
+        new = utils.make_new_semver(
+            semver.parse_version_info("1.2.3"), None, {"minor"}, build="5"
+        )
+        self.assertEqual("1.3.0-dev.1+build.5", str(new))
+
+
+class TestVersionEngine(unittest.TestCase):
+    """The native version engine gives the same results as `semver`"""
+
+    versions = [
+        "0.0.0",
+        "1.2.3",
+        "1.2.3-rc.1",
+        "1.2.3-rc.9",
+        "1.2.3-alpha",
+        "1.2.3-alpha.beta.1+build.99",
+        "1.2.3+build.7",
+        "10.20.30-1.x-y-z.00x9+meta-data.010",
+    ]
+
+    def record(self, version):
+        return VersionRecord.from_version(semver.parse_version_info(version))
+
+    def test_round_trip(self):
+        for version in self.versions:
+            self.assertEqual(version, str(self.record(version)))
+            self.assertEqual(
+                semver.parse_version_info(version),
+                self.record(version).to_version_info(),
+            )
+
+    def test_bumps(self):
+        for version in self.versions:
+            for sig_fig in ("major", "minor", "patch"):
+                record = self.record(version)
+                record.bump(sig_fig)
+                expected = getattr(semver, "bump_" + sig_fig)(version)
+                self.assertEqual(expected, str(record))
+            for sig_fig in ("prerelease", "build"):
+                for token in (None, "dev", "rc.4x"):
+                    record = self.record(version)
+                    record.bump(sig_fig, token=token)
+                    expected = getattr(semver, "bump_" + sig_fig)(version, token=token)
+                    self.assertEqual(expected, str(record))
+
+    def test_finalize(self):
+        for version in self.versions:
+            record = self.record(version)
+            record.finalize()
+            self.assertEqual(semver.finalize_version(version), str(record))
+            self.assertTrue(utils.is_release(record))
+
 
 class TestVCSTags(unittest.TestCase):
     call = functools.partial(main, config_path="example.toml")
@@ -357,6 +626,1561 @@ class TestVCSTags(unittest.TestCase):
             dict(major=5, minor=0, patch=0, build=None, prerelease="dev.1"),
         )
 
+    def test_incremental_commit_count(self):
+        expected = auto_version_tool.get_dvcs_info()
+        config.INCREMENTAL_COMMIT_COUNT = True
+        self.addCleanup(setattr, config, "INCREMENTAL_COMMIT_COUNT", False)
+        self.assertEqual(expected, auto_version_tool.get_dvcs_info())
+        # the count at the release commit is now known
+        release_commit = subprocess.check_output(
+            shlex.split("git rev-parse release/4.5.6^{commit}")
+        ).decode("utf8").strip()
+        counts = cache.load(Constants.COMMIT_COUNT_CACHE)
+        self.assertIn(release_commit, counts)
+        # as is the count at HEAD, so the tags aren't scanned again
+        self.assertIn(expected[Constants.COMMIT_FIELD], counts)
+        with mock.patch.object(
+            auto_version_tool, "get_dvcs_previous_release_semver_bounded"
+        ) as scan:
+            self.assertEqual(expected, auto_version_tool.get_dvcs_info())
+        scan.assert_not_called()
+
+    def test_bounded_tag_scan_stops_reading(self):
+        @contextlib.contextmanager
+        def merged_tag_stream(pattern):
+            def lines():
+                yield b"release/4.10.0-dev.1\n"
+                yield b"release/4.9.0\n"
+                raise AssertionError("read too far")
+
+            yield lines()
+
+        backend = mock.Mock(merged_tag_stream=merged_tag_stream)
+        with vcs.active(backend):
+            version = auto_version_tool.get_dvcs_previous_release_semver_bounded()
+        self.assertEqual("4.9.0", str(version))
+
+    def test_bounded_tag_scan_failure(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        # there are no commits, so git can't resolve HEAD
+        subprocess.check_call(["git", "init", "-q"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            with vcs.GitBackend().merged_tag_stream("release/*") as stream:
+                self.assertEqual([], list(stream))
+
+    def test_bounded_tag_scan(self):
+        for tag in ("release/4.10.0-dev.1", "release/4.9.0", "release/4.10.0+build.1"):
+            subprocess.check_call(["git", "tag", tag])
+            self.addCleanup(subprocess.check_call, ["git", "tag", "--delete", tag])
+        expected = auto_version_tool.get_dvcs_previous_release_semver()
+        config.BOUNDED_TAG_SCAN = True
+        self.addCleanup(setattr, config, "BOUNDED_TAG_SCAN", False)
+        self.assertEqual(expected, auto_version_tool.get_dvcs_previous_release_semver())
+        self.assertEqual("4.9.0", str(expected))
+
+    def test_parallel_persist_from(self):
+        combinations = [
+            [Constants.FROM_VCS_PREVIOUS_VERSION, Constants.FROM_SOURCE],
+            [Constants.FROM_VCS_PREVIOUS_RELEASE, Constants.FROM_VCS_LATEST_RELEASE],
+            [Constants.FROM_SOURCE, Constants.FROM_VCS_LATEST_VERSION],
+        ]
+        self.addCleanup(setattr, config, "PARALLEL_PERSIST_FROM", False)
+        for persist_from in combinations:
+            config.PARALLEL_PERSIST_FROM = False
+            expected = auto_version_tool.get_current_version(persist_from)
+            config.PARALLEL_PERSIST_FROM = True
+            self.assertEqual(
+                expected, auto_version_tool.get_current_version(persist_from)
+            )
+
+    def test_tag_router(self):
+        tags = (
+            "svc-a/release/1.2.3",
+            "svc-a/release/1.3.0-dev.1",
+            "svc-b/release/4.0.0",
+        )
+        for tag in tags:
+            subprocess.check_call(["git", "tag", tag])
+            self.addCleanup(subprocess.check_call, ["git", "tag", "--delete", tag])
+        self.addCleanup(setattr, config, "TAG_TEMPLATE", config.TAG_TEMPLATE)
+        templates = [
+            "release/{version}",
+            "svc-a/release/{version}",
+            "svc-b/release/{version}",
+            "svc-b/release/v{version}",
+            "no-version",
+        ]
+        router = auto_version_tool.tag_router.TagRouter.from_git(templates)
+        for template in templates:
+            config.TAG_TEMPLATE = template
+            self.assertEqual(
+                auto_version_tool.get_dvcs_ordered_tag_semvers(),
+                router.versions(template),
+                template,
+            )
+        self.assertEqual(
+            ["1.2.3", "1.3.0-dev.1"],
+            [str(v) for v in router.versions("svc-a/release/{version}")],
+        )
+        self.assertEqual(
+            ["svc-b/release/{version}"], router.candidates("svc-b/release/4.0.0")
+        )
+        self.assertEqual(
+            ["svc-b/release/v{version}", "svc-b/release/{version}"],
+            sorted(router.candidates("svc-b/release/v4.0.0")),
+        )
+
+    def test_shared_tag_listing(self):
+        subprocess.check_call(["git", "tag", "svc-a/release/1.2.3"])
+        self.addCleanup(
+            subprocess.check_call, ["git", "tag", "--delete", "svc-a/release/1.2.3"]
+        )
+        self.addCleanup(setattr, config, "TAG_TEMPLATE", config.TAG_TEMPLATE)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        config_paths = []
+        for name, template in (
+            ("a", "release/{version}"),
+            ("b", "svc-a/release/{version}"),
+        ):
+            path = os.path.join(root, name + ".toml")
+            with open(path, "w") as fh:
+                fh.write(
+                    "[AutoVersionConfig]\n"
+                    "TAG_TEMPLATE = '%s'\n"
+                    "targets = ['example.py']\n"
+                    "[AutoVersionConfig.key_aliases]\n"
+                    "VERSION = 'VERSION_KEY'\n" % template
+                )
+            config_paths.append(path)
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            results = auto_version_tool.main_many(
+                config_paths,
+                persist_from=[Constants.FROM_VCS_LATEST_VERSION],
+                dry_run=True,
+            )
+        self.assertEqual(["4.5.7-dev.1", "1.2.3"], [r.new for r in results])
+        # tags were listed once, rather than for each component
+        listings = [c for c in popen.call_args_list if "--list" in c[0][0]]
+        self.assertEqual(1, len(listings))
+
+
+class TestParallelPersistFrom(unittest.TestCase):
+    """Sources evaluated at once give the same result as evaluating them in turn"""
+
+    results = {
+        "none": (0.05, None),
+        "slow": (0.1, "1.0.0"),
+        "fast": (0, "2.0.0"),
+        "error": (0.05, ValueError("no version here")),
+        "hang": (0, "3.0.0"),
+    }
+
+    def get_version_from(self, source):
+        if source == "hang":
+            # a git source that would take far longer than the others
+            processes.check_output([sys.executable, "-c", "import time; time.sleep(30)"])
+        delay, result = self.results[source]
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_current_version(self, persist_from):
+        patcher = mock.patch.object(
+            auto_version_tool, "get_version_from", side_effect=self.get_version_from
+        )
+        with patcher:
+            return auto_version_tool.get_current_version_parallel(persist_from)
+
+    def test_priority_order(self):
+        self.assertEqual("1.0.0", self.get_current_version(["none", "slow", "fast"]))
+        self.assertEqual("2.0.0", self.get_current_version(["fast", "slow"]))
+        self.assertIsNone(self.get_current_version(["none", "none"]))
+
+    def test_error_priority(self):
+        # an error is only raised if no earlier source found a version
+        self.assertEqual("1.0.0", self.get_current_version(["slow", "error"]))
+        with self.assertRaises(ValueError):
+            self.get_current_version(["none", "error", "fast"])
+
+    def test_later_sources_stopped(self):
+        real_popen = subprocess.Popen
+        started = []
+        running = threading.Event()
+
+        def popen(*args, **kwargs):
+            started.append(real_popen(*args, **kwargs))
+            running.set()
+            return started[-1]
+
+        def get_version_from(source):
+            if source == "fast":
+                # the slow source is under way by the time this one has the answer
+                running.wait(10)
+            return self.get_version_from(source)
+
+        start = time.time()
+        with mock.patch("subprocess.Popen", side_effect=popen), mock.patch.object(
+            auto_version_tool, "get_version_from", side_effect=get_version_from
+        ):
+            version = auto_version_tool.get_current_version_parallel(["fast", "hang"])
+        self.assertEqual("2.0.0", version)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(1, len(started))
+        # it was killed, rather than left running
+        self.assertIsNotNone(started[0].poll())
+
+    def test_stopped_group(self):
+        group = processes.ProcessGroup()
+        group.stop()
+        with group.active(), self.assertRaises(processes.Stopped):
+            processes.check_output(["git", "--version"])
+        self.assertIsNone(processes.get_group())
+
+
+class TestVCSTagsCommitGraph(TestVCSTags):
+    """Repeats the VCS tag tests, answering ancestry queries from the commit graph"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestVCSTagsCommitGraph, cls).setUpClass()
+        config.USE_COMMIT_GRAPH = True
+
+    @classmethod
+    def tearDownClass(cls):
+        config.USE_COMMIT_GRAPH = False
+        super(TestVCSTagsCommitGraph, cls).tearDownClass()
+
+
+class TestCommitGraph(unittest.TestCase):
+    # a -- b -- d -- e
+    #       \       /
+    #        c -----
+    #  f (unrelated root)
+    rev_list = ["e d c", "d b", "c b", "b a", "a", "f"]
+
+    def setUp(self):
+        self.graph = CommitGraph.parse(self.rev_list)
+
+    def test_index(self):
+        self.assertEqual(6, len(self.graph))
+        self.assertEqual(0, self.graph.index_of("e"))
+        self.assertEqual(4, self.graph.index_of("a"))
+        self.assertIn("c", self.graph)
+        self.assertIsNone(self.graph.index_of("unknown"))
+
+    def test_shallow_boundary(self):
+        # parents outside of the listed commits aren't in the graph
+        graph = CommitGraph.parse(["c b", "b a"])
+        self.assertEqual(2, len(graph))
+        self.assertNotIn("a", graph)
+
+
+class TestShallowClone(unittest.TestCase):
+    """Ancestry checks in a shallow clone of a local repository
+
+    history:  c1 -- c2 -- c3 -- c4 -- c5 -- c6
+    tags:           1.0.0             1.1.0-pre.1
+    the clone only has c5 and c6
+    """
+
+    git_env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="test",
+        GIT_AUTHOR_EMAIL="test@example.com",
+        GIT_COMMITTER_NAME="test",
+        GIT_COMMITTER_EMAIL="test@example.com",
+    )
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        upstream = os.path.join(root, "upstream")
+        self.git("init", "-q", upstream)
+        os.chdir(upstream)
+        for i in range(1, 7):
+            with open("file", "w") as fh:
+                fh.write(str(i))
+            self.git("add", "file")
+            self.git("commit", "-q", "-m", "commit %s" % i)
+            if i == 2:
+                self.git("tag", "-a", "release/1.0.0", "-m", "version 1.0.0")
+            if i == 5:
+                self.git("tag", "release/1.1.0-pre.1")
+        clone = os.path.join(root, "clone")
+        self.git("clone", "-q", "--depth", "2", "file://" + upstream, clone)
+        os.chdir(clone)
+        self.addCleanup(setattr, config, "SHALLOW_DEEPEN_STEP", config.SHALLOW_DEEPEN_STEP)
+
+    def test_detects_shallow(self):
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            self.assertTrue(auto_version_tool.is_shallow_repository())
+        # found without starting git
+        popen.assert_not_called()
+
+    def test_version_within_window(self):
+        version = auto_version_tool.get_dvcs_previous_version_semver()
+        self.assertEqual("1.1.0-pre.1", str(version))
+
+    def test_release_outside_window_is_approximate(self):
+        config.SHALLOW_DEEPEN_STEP = 0
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            version = auto_version_tool.get_dvcs_previous_release_semver()
+        self.assertIsNone(version)
+        self.assertTrue(any("approximate" in str(w.message) for w in caught))
+
+    def test_release_outside_window_deepens(self):
+        config.SHALLOW_DEEPEN_STEP = 3
+        version = auto_version_tool.get_dvcs_previous_release_semver()
+        self.assertEqual("1.0.0", str(version))
+
+    def test_tag_on_another_branch(self):
+        # a newer version, tagged on another branch: without the history beyond the
+        # clone, it can't be told apart from an ancestor, so is checked by deepening
+        self.git("checkout", "-q", "-b", "side", "HEAD~1")
+        self.git("commit", "-q", "--allow-empty", "-m", "side")
+        self.git("tag", "release/2.0.0")
+        self.git("checkout", "-q", "-")
+        config.SHALLOW_DEEPEN_STEP = 3
+        version = auto_version_tool.get_dvcs_previous_version_semver()
+        self.assertEqual("1.1.0-pre.1", str(version))
+        self.assertFalse(auto_version_tool.is_shallow_repository())
+
+    def test_fetched_tag_beyond_history(self):
+        # the tagged commit is fetched, but not the history joining it to HEAD
+        self.git("fetch", "-q", "--tags")
+        config.SHALLOW_DEEPEN_STEP = 0
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            version = auto_version_tool.get_dvcs_previous_release_semver()
+        self.assertIsNone(version)
+        messages = [str(w.message) for w in caught if "approximate" in str(w.message)]
+        self.assertEqual(1, len(messages))
+        self.assertIn("fetched history (1.0.0)", messages[0])
+        config.SHALLOW_DEEPEN_STEP = 3
+        version = auto_version_tool.get_dvcs_previous_release_semver()
+        self.assertEqual("1.0.0", str(version))
+
+    def test_no_tags(self):
+        for tag in subprocess.check_output(["git", "tag"]).decode("utf8").split():
+            self.git("tag", "-d", tag)
+        config.SHALLOW_DEEPEN_STEP = 3
+        with warnings.catch_warnings(record=True) as caught, mock.patch.object(
+            auto_version_tool, "deepen_shallow_repository"
+        ) as deepen:
+            warnings.simplefilter("always")
+            self.assertIsNone(auto_version_tool.get_dvcs_previous_release_semver())
+        self.assertEqual([], [str(w.message) for w in caught])
+        deepen.assert_not_called()
+
+    def test_incremental_commit_count_is_approximate(self):
+        config.SHALLOW_DEEPEN_STEP = 0
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertEqual(2, auto_version_tool.get_incremental_commit_count())
+        self.assertTrue(
+            any("commit count (2) is approximate" in str(w.message) for w in caught)
+        )
+        self.assertEqual({}, cache.load(Constants.COMMIT_COUNT_CACHE))
+
+
+class TestMemoryBackend(unittest.TestCase):
+    """Versioning from a repository held in memory
+
+    history:  c1 -- c2 -- c3 -- c4
+                      \
+                       b1
+    tags:     1.0.0  1.1.0  1.2.0-pre.1
+                     (b1: 2.0.0)
+    """
+
+    def setUp(self):
+        for name in ("TAG_TEMPLATE", "BOUNDED_TAG_SCAN", "USE_COMMIT_GRAPH"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        config.TAG_TEMPLATE = "release/{version}"
+        self.repo = vcs.MemoryBackend()
+        self.c1 = self.repo.commit(added=["file"])
+        self.repo.tag("release/1.0.0", message="version 1.0.0")
+        self.c2 = self.repo.commit(added=["news/a.feature"])
+        self.repo.tag("release/1.1.0")
+        self.repo.commit(added=["news/b.feature"], parents=[self.c2])
+        self.repo.tag("release/2.0.0")
+        self.repo.commit(added=["news/c.feature"], parents=[self.c2])
+        self.repo.tag("release/1.2.0-pre.1")
+        self.c4 = self.repo.commit(added=["news/d.bugfix"], removed=["news/a.feature"])
+        backend = vcs.active(self.repo)
+        backend.__enter__()
+        self.addCleanup(backend.__exit__, None, None, None)
+
+    def test_repository(self):
+        self.assertEqual(self.c4, self.repo.head())
+        self.assertEqual(self.c1, self.repo.resolve("release/1.0.0"))
+        self.assertIsNone(self.repo.resolve("release/9.9.9"))
+        self.assertTrue(self.repo.is_ancestor("release/1.1.0"))
+        self.assertFalse(self.repo.is_ancestor("release/2.0.0"))
+        self.assertEqual(4, self.repo.commit_count())
+        self.assertEqual(2, self.repo.commit_count(since="release/1.1.0"))
+        self.assertEqual(
+            ["news/c.feature", "news/d.bugfix"],
+            self.repo.added_files("release/1.1.0", "news/*"),
+        )
+        self.assertEqual(
+            ["release/1.0.0", "release/1.1.0"], self.repo.list_tags("release/1.[01]*")
+        )
+
+    def test_commit_count_cache_is_capped(self):
+        name = Constants.COMMIT_COUNT_CACHE
+        # the release was counted first, then many other commits
+        counts = {self.c2: 2}
+        counts.update(("%040x" % i, i) for i in range(10))
+        cache.save(name, counts)
+        with mock.patch.object(auto_version_tool, "COMMIT_COUNT_CACHE_SIZE", 4):
+            self.assertEqual(4, auto_version_tool.get_incremental_commit_count())
+        # the most recently used are kept, including the release
+        self.assertEqual(
+            ["%040x" % 8, "%040x" % 9, self.c2, self.c4], list(cache.load(name))
+        )
+
+    def test_caches_without_git(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        # not in a repository, so any use of git would fail
+        os.chdir(root)
+        with mock.patch.object(
+            processes, "popen", side_effect=AssertionError("git was run")
+        ):
+            self.assertEqual(4, auto_version_tool.get_incremental_commit_count())
+            self.assertEqual(
+                {self.c2: 2, self.c4: 4}, cache.load(Constants.COMMIT_COUNT_CACHE)
+            )
+            self.assertTrue(
+                cache.get_cache_path("any").startswith(self.repo.cache_dir())
+            )
+            # each repository has its own caches
+            with vcs.active(vcs.MemoryBackend()):
+                self.assertEqual({}, cache.load(Constants.COMMIT_COUNT_CACHE))
+
+    def test_previous_versions(self):
+        for bounded, graph in ((False, False), (True, False), (False, True)):
+            config.BOUNDED_TAG_SCAN = bounded
+            config.USE_COMMIT_GRAPH = graph
+            self.assertEqual(
+                "1.1.0", str(auto_version_tool.get_dvcs_previous_release_semver())
+            )
+            self.assertEqual(
+                "1.2.0-pre.1",
+                str(auto_version_tool.get_dvcs_previous_version_semver()),
+            )
+        self.assertEqual(
+            "2.0.0", str(auto_version_tool.get_dvcs_repo_latest_release_semver())
+        )
+
+    def test_dvcs_info(self):
+        self.assertEqual(
+            {Constants.COMMIT_FIELD: self.c4, Constants.COMMIT_COUNT_FIELD: "4"},
+            auto_version_tool.get_dvcs_info(),
+        )
+
+    def test_add_tag(self):
+        auto_version_tool.add_dvcs_tag("1.2.0")
+        self.assertEqual(self.c4, self.repo.resolve("release/1.2.0"))
+        self.assertEqual("version 1.2.0", self.repo.messages["release/1.2.0"])
+        with self.assertRaises(ValueError):
+            auto_version_tool.add_dvcs_tag("1.2.0")
+
+    def test_batched_tags(self):
+        with self.assertRaises(ValueError):
+            with vcs.batched_tags():
+                auto_version_tool.add_dvcs_tag("1.2.0")
+                auto_version_tool.add_dvcs_tag("1.1.0")
+        self.assertIsNone(self.repo.resolve("release/1.2.0"))
+
+    def test_many_tags(self):
+        for i in range(2000):
+            self.repo.commit(added=["file%s" % i])
+            self.repo.tag("release/2.0.%s-pre.1" % i)
+        # back on a branch from the first commit, none of those are ancestors
+        self.repo.commit(parents=[self.c1])
+        self.repo.tag("release/1.0.1")
+        self.repo.commit()
+        config.BOUNDED_TAG_SCAN = True
+        self.assertEqual(
+            "1.0.1", str(auto_version_tool.get_dvcs_previous_release_semver())
+        )
+        self.assertEqual(
+            "2.0.1999-pre.1", str(auto_version_tool.get_dvcs_repo_latest_version_semver())
+        )
+
+
+class TestRefsBackend(unittest.TestCase):
+    """Reading refs from the git directory gives the same answers as git"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        self.git("init", "-q")
+        for i in range(3):
+            with open("file", "w") as fh:
+                fh.write(str(i))
+            self.git("add", "file")
+            self.git("commit", "-q", "-m", "commit %s" % i)
+            self.git("tag", "-a", "release/1.%s.0" % i, "-m", "version 1.%s.0" % i)
+        self.git("tag", "release/1.2.1-pre.1", "HEAD~1")
+        self.git("tag", "-a", "nested", "-m", "a tag of a tag", "release/1.0.0")
+        os.mkdir("sub")
+        os.chdir("sub")
+
+    def assert_same(self):
+        git = vcs.GitBackend()
+        refs = vcs.RefsBackend()
+        self.assertEqual(git.head(), refs.head())
+        self.assertEqual(git.list_tags(), refs.list_tags())
+        self.assertEqual(git.list_tags("release/*"), refs.list_tags("release/*"))
+        # git only peels one level of a tag of a tag, in `tag_commits`
+        git_tag_commits = git.tag_commits()
+        refs_tag_commits = refs.tag_commits()
+        self.assertEqual(git.resolve("nested"), refs_tag_commits.pop("nested"))
+        del git_tag_commits["nested"]
+        self.assertEqual(git_tag_commits, refs_tag_commits)
+        for ref in git.list_tags() + ["HEAD", "HEAD~1", "missing", git.head()]:
+            self.assertEqual(git.resolve(ref), refs.resolve(ref), ref)
+
+    def test_loose(self):
+        self.assert_same()
+
+    def test_packed_refs(self):
+        self.git("pack-refs", "--all")
+        self.assert_same()
+
+    def test_packed_objects(self):
+        self.git("gc", "-q")
+        # a tag that's only loose, pointing at a packed commit
+        self.git("tag", "-a", "release/2.0.0", "-m", "version 2.0.0")
+        self.assert_same()
+
+    def test_detached(self):
+        self.git("checkout", "-q", "release/1.1.0")
+        self.assert_same()
+
+    def test_configured(self):
+        self.addCleanup(setattr, config, "VCS_BACKEND", config.VCS_BACKEND)
+        config.VCS_BACKEND = "refs"
+        self.assertIsInstance(vcs.get_backend(), vcs.RefsBackend)
+        self.assertEqual(
+            "1.2.0", str(auto_version_tool.get_dvcs_previous_release_semver())
+        )
+        self.assertEqual(
+            "1.2.1-pre.1", str(auto_version_tool.get_dvcs_repo_latest_version_semver())
+        )
+
+
+class TestBatchedTags(unittest.TestCase):
+    """Creating many tags at once"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        self.addCleanup(setattr, config, "TAG_TEMPLATE", config.TAG_TEMPLATE)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        self.git("init", "-q")
+        self.git("commit", "-q", "--allow-empty", "-m", "initial")
+        self.git("tag", "svc-2/release/1.0.0")
+        patcher = mock.patch.dict(os.environ, self.git_env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_tags(self, count):
+        for i in range(count):
+            config.TAG_TEMPLATE = "svc-%s/release/{version}" % i
+            auto_version_tool.add_dvcs_tag("1.0.0")
+
+    def list_tags(self):
+        return subprocess.check_output(
+            [
+                "git",
+                "for-each-ref",
+                "--format=%(refname:short) %(objecttype)",
+                "refs/tags",
+            ]
+        ).decode("utf8")
+
+    def test_batch(self):
+        head = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf8")
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            with vcs.batched_tags():
+                self.add_tags(2)
+                config.TAG_TEMPLATE = "svc-3/release/{version}"
+                auto_version_tool.add_dvcs_tag("2.0.0")
+                self.assertNotIn("svc-0", self.list_tags())
+                popen.reset_mock()
+        # HEAD, the tagger, one for each tag object and the refs
+        self.assertEqual(6, popen.call_count)
+        self.assertEqual(
+            "svc-0/release/1.0.0 tag\n"
+            "svc-1/release/1.0.0 tag\n"
+            "svc-2/release/1.0.0 commit\n"
+            "svc-3/release/2.0.0 tag\n",
+            self.list_tags(),
+        )
+        for tag, message in (
+            ("svc-0/release/1.0.0", "version 1.0.0"),
+            ("svc-3/release/2.0.0", "version 2.0.0"),
+        ):
+            content = subprocess.check_output(["git", "cat-file", "tag", tag])
+            self.assertIn(("object %s" % head).encode("utf8"), content)
+            self.assertTrue(content.endswith(("\n\n%s\n" % message).encode("utf8")))
+        # the same as tags made by git itself
+        subprocess.check_output(["git", "fsck", "--strict", "--no-progress"])
+
+    def test_all_or_nothing(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            with vcs.batched_tags():
+                self.add_tags(4)
+        self.assertEqual("svc-2/release/1.0.0 commit\n", self.list_tags())
+
+    def test_malformed_tag_object(self):
+        malformed = vcs.TAG_OBJECT.replace("type commit", "type tree")
+        with mock.patch.object(vcs, "TAG_OBJECT", malformed):
+            with self.assertRaises(subprocess.CalledProcessError):
+                with vcs.batched_tags():
+                    self.add_tags(2)
+        self.assertEqual("svc-2/release/1.0.0 commit\n", self.list_tags())
+
+    def test_failed_run(self):
+        with self.assertRaises(RuntimeError):
+            with vcs.batched_tags():
+                self.add_tags(1)
+                raise RuntimeError("failed")
+        self.assertEqual("svc-2/release/1.0.0 commit\n", self.list_tags())
+
+
+class TestComponentConfigs(unittest.TestCase):
+    """Versioning several components, each with its own config"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        self.addCleanup(set_settings, config, get_settings(config))
+        set_settings(config, DEFAULT_SETTINGS)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        with open("b.toml", "w") as fh:
+            fh.write(
+                "[AutoVersionConfig]\n"
+                "TAG_TEMPLATE = 'b/release/{version}'\n"
+                "targets = ['b.py']\n"
+                "[AutoVersionConfig.key_aliases]\n"
+                "bv = 'VERSION_KEY'\n"
+            )
+        # leaves out the tag template and key aliases
+        with open("a.toml", "w") as fh:
+            fh.write("[AutoVersionConfig]\ntargets = ['a.py']\n")
+        with open("b.py", "w") as fh:
+            fh.write('__version__ = "1.2.3"\nbv = "1.2.3"\n')
+        with open("a.py", "w") as fh:
+            fh.write(
+                'bv = "1.2.3"\n'
+                '__version__ = "1.2.3"\n'
+                '__strict_version__ = "1.2.3"\n'
+                "PRODUCTION = False\n"
+                "MAJOR = 1\n"
+                "MINOR = 2\n"
+                "PATCH = 3\n"
+                "VERSION_LOCK = False\n"
+                "COMMIT_COUNT = 0\n"
+                'COMMIT = "none"\n'
+            )
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        patcher = mock.patch.dict(os.environ, self.git_env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read(self, path):
+        with open(path) as fh:
+            return fh.read()
+
+    def test_settings_not_kept(self):
+        results = auto_version_tool.main_many(
+            ["b.toml", "a.toml"],
+            bump="minor",
+            persist_to=[Constants.TO_SOURCE, Constants.TO_VCS],
+        )
+        self.assertEqual(["1.3.0-pre.1", "1.3.0-pre.1"], [r.new for r in results])
+        self.assertEqual(
+            '__version__ = "1.2.3"\nbv = "1.3.0-pre.1"\n', self.read("b.py")
+        )
+        # the default aliases and tag template, not those of b
+        self.assertTrue(
+            self.read("a.py").startswith('bv = "1.2.3"\n__version__ = "1.3.0-pre.1"\n')
+        )
+        tags = subprocess.check_output(["git", "tag", "--list"]).decode("utf8")
+        self.assertEqual("b/release/1.3.0-pre.1\nrelease/1.3.0-pre.1\n", tags)
+
+
+class TestWatch(unittest.TestCase):
+    """Keeping the targets of a small repository up to date"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("targets", "key_aliases", "trigger_patterns", "PRERELEASE_TOKEN"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        os.mkdir("news")
+        with open("config.toml", "w") as fh:
+            fh.write(
+                "[AutoVersionConfig]\n"
+                "PRERELEASE_TOKEN = 'dev'\n"
+                "targets = ['version.py']\n"
+                "[AutoVersionConfig.key_aliases]\n"
+                "VERSION = 'VERSION_KEY'\n"
+                "[AutoVersionConfig.trigger_patterns]\n"
+                "'news/*.feature' = 'minor'\n"
+            )
+        with open("version.py", "w") as fh:
+            fh.write('VERSION = "1.2.3"\n')
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        self.watcher = auto_version_tool.VersionWatcher("config.toml")
+
+    def read_version(self):
+        with open("version.py") as fh:
+            return fh.read()
+
+    def add_news(self):
+        with open(os.path.join("news", "thing.feature"), "w") as fh:
+            fh.write("a new thing")
+
+    def test_refresh_only_writes_changes(self):
+        self.assertEqual([], self.watcher.refresh())
+        self.add_news()
+        self.assertEqual(["version.py"], self.watcher.refresh({"triggers"}))
+        self.assertEqual('VERSION = "1.3.0-dev.1"\n', self.read_version())
+        # the current version was read at the start, so there's no further bump
+        self.assertEqual([], self.watcher.refresh({"triggers"}))
+        os.remove(os.path.join("news", "thing.feature"))
+        self.assertEqual(["version.py"], self.watcher.refresh({"triggers"}))
+        self.assertEqual('VERSION = "1.2.3"\n', self.read_version())
+
+    def test_classify(self):
+        self.watcher.refresh()
+        classify = self.watcher.classify
+        self.assertEqual("config", classify("config.toml"))
+        self.assertEqual("triggers", classify(os.path.join("news", "a.feature")))
+        self.assertIsNone(classify(os.path.join("news", "a.txt")))
+        self.assertIsNone(classify("version.py"))
+        self.assertEqual("vcs", classify(os.path.join(".git", "HEAD")))
+        self.assertEqual("vcs", classify(os.path.join(".git", "refs", "tags", "v1")))
+        self.assertIsNone(classify(os.path.join(".git", "refs", "tags", "v1.lock")))
+        self.assertIsNone(classify(os.path.join(".git", "index")))
+
+    @unittest.skipUnless(watch.is_supported(), "inotify is not available")
+    def test_watch_events(self):
+        with watch.Inotify() as inotify:
+            self.watcher.refresh()
+            for directory in self.watcher.get_watched_dirs():
+                inotify.add_watch(directory)
+            self.add_news()
+            self.assertEqual(["version.py"], self.watcher.watch(inotify, timeout=5))
+            self.assertEqual('VERSION = "1.3.0-dev.1"\n', self.read_version())
+            # our own write is seen as a change, but the version is already up to date
+            self.assertEqual([], self.watcher.watch(inotify, timeout=0.1))
+            self.git("tag", "release/1.0.0")
+            inotify.read_events(timeout=5)
+            self.assertIn(
+                os.path.abspath(os.path.join(".git", "refs", "tags")), inotify.paths
+            )
+
+
+class TestTriggerCache(unittest.TestCase):
+    """Reusing file trigger results between runs"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("trigger_patterns", "CACHE_TRIGGERS"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        config.trigger_patterns = {"news/*.feature": "minor", "news/*.bugfix": "patch"}
+        config.CACHE_TRIGGERS = True
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        os.mkdir("news")
+        self.write("news/old.bugfix")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        patcher = mock.patch.object(
+            auto_version_tool,
+            "find_file_triggers",
+            wraps=auto_version_tool.find_file_triggers,
+        )
+        self.find = patcher.start()
+        self.addCleanup(patcher.stop)
+        # the mtime is only as fine-grained as the filesystem clock, so set it apart
+        os.utime("news", (1, 1))
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            fh.write("news")
+
+    def detect(self, release_commit=None):
+        return auto_version_tool.detect_file_triggers(release_commit)
+
+    def test_reused(self):
+        expected = ({"patch"}, {os.path.join("news", "old.bugfix")})
+        self.assertEqual(expected, self.detect())
+        self.assertEqual(expected, self.detect())
+        self.assertEqual(1, self.find.call_count)
+        # a different release commit gives a different result
+        self.detect("HEAD")
+        self.assertEqual(2, self.find.call_count)
+
+    def test_files_added_and_removed(self):
+        self.detect()
+        self.write(os.path.join("news", "new.feature"))
+        triggers, files = self.detect()
+        self.assertEqual({"minor", "patch"}, triggers)
+        self.assertIn(os.path.join("news", "new.feature"), files)
+        self.assertEqual(2, self.find.call_count)
+        os.utime("news", (2, 2))
+        self.detect()
+        os.remove(os.path.join("news", "new.feature"))
+        self.assertEqual({"patch"}, self.detect()[0])
+        self.assertEqual(4, self.find.call_count)
+
+    def test_new_commit(self):
+        initial = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf8")
+        self.write(os.path.join("news", "new.feature"))
+        os.utime("news", (2, 2))
+        # the new file isn't committed, so it's not new since the release commit
+        self.assertEqual(set(), self.detect(initial.strip())[0])
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "news")
+        # a commit is a change, even though the files and their mtimes are the same
+        self.assertEqual({"minor"}, self.detect(initial.strip())[0])
+        self.assertEqual(2, self.find.call_count)
+
+    def test_config_change(self):
+        self.detect()
+        config.trigger_patterns = {"news/*.bugfix": "minor"}
+        self.assertEqual({"minor"}, self.detect()[0])
+        self.assertEqual(2, self.find.call_count)
+
+    def test_racy(self):
+        # modified no earlier than the cache was written, so can't be trusted
+        future = time.time_ns() + 60 * 10 ** 9
+        os.utime("news", ns=(future, future))
+        self.detect()
+        self.detect()
+        self.assertEqual(2, self.find.call_count)
+
+    def test_disabled(self):
+        config.CACHE_TRIGGERS = False
+        self.detect()
+        self.detect()
+        self.assertEqual(2, self.find.call_count)
+
+
+class TestDepfile(unittest.TestCase):
+    """Declaring the inputs of a run to a build system"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("targets", "key_aliases", "trigger_patterns", "TAG_TEMPLATE"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        os.mkdir("news")
+        with open("config.toml", "w") as fh:
+            fh.write(
+                "[AutoVersionConfig]\n"
+                "TAG_TEMPLATE = 'release/{version}'\n"
+                "targets = ['version.py']\n"
+                "[AutoVersionConfig.key_aliases]\n"
+                "VERSION = 'VERSION_KEY'\n"
+                "[AutoVersionConfig.trigger_patterns]\n"
+                "'news/*.feature' = 'minor'\n"
+                "'docs/news/*.bugfix' = 'patch'\n"
+            )
+        with open("version.py", "w") as fh:
+            fh.write('VERSION = "1.2.3"\n')
+        self.git("init", "-q", "-b", "main")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        self.git("tag", "release/1.2.3")
+
+    def run_cli(self, *argv):
+        argv = ("auto_version", "--config", "config.toml") + argv
+        with mock.patch("sys.argv", list(argv)), contextlib.redirect_stdout(
+            io.StringIO()
+        ):
+            auto_version_tool.main_from_cli()
+
+    def read(self, path):
+        with open(path) as fh:
+            return fh.read()
+
+    def test_inputs(self):
+        self.run_cli("--news", "--depfile", "deps.d", "--stamp", "version.stamp")
+        git_dir = os.path.join(".git", "")
+        self.assertEqual(
+            "version.stamp: \\\n"
+            # docs/news is missing, so would be created here
+            "  . \\\n"
+            "  %(git)sHEAD \\\n"
+            "  %(git)srefs%(sep)sheads \\\n"
+            "  %(git)srefs%(sep)sheads%(sep)smain \\\n"
+            "  config.toml \\\n"
+            "  news \\\n"
+            "  version.py\n" % dict(git=git_dir, sep=os.sep),
+            self.read("deps.d"),
+        )
+        self.assertEqual("1.2.3\n", self.read("version.stamp"))
+
+    def test_tags(self):
+        self.run_cli(
+            "--persist-from", "vcs-global-release", "--show", "--depfile", "deps.d"
+        )
+        depfile = self.read("deps.d")
+        self.assertTrue(depfile.startswith("version.py: \\\n"))
+        # the target isn't its own prerequisite
+        self.assertNotIn("version.py", depfile.split(":", 1)[1])
+        self.assertIn(os.path.join(".git", "refs", "tags", "release"), depfile)
+        self.assertNotIn("news", depfile)
+        self.git("pack-refs", "--all")
+        self.run_cli("--persist-from", "vcs-global-release", "--depfile", "deps.d")
+        self.assertIn(os.path.join(".git", "packed-refs"), self.read("deps.d"))
+
+    def test_no_depfile(self):
+        self.run_cli("--stamp", "version.stamp", "--bump", "minor", "--release")
+        self.assertEqual("1.3.0\n", self.read("version.stamp"))
+        self.assertFalse(os.path.exists("deps.d"))
+
+    def test_format(self):
+        self.assertEqual(
+            "out\\ file: \\\n  $$HOME \\\n  a\\#b\n",
+            auto_version_tool.format_depfile(["out file"], {"a#b", "$HOME"}),
+        )
+        self.assertEqual(
+            "a: \\\n  b\n",
+            auto_version_tool.format_depfile(["a"], {"b", os.path.abspath("a")}),
+        )
+
+
+class TestPlanApply(unittest.TestCase):
+    """Working out the writes once, and applying them elsewhere"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("targets", "key_aliases", "PRERELEASE_TOKEN"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        with open("config.toml", "w") as fh:
+            fh.write(
+                "[AutoVersionConfig]\n"
+                "PRERELEASE_TOKEN = 'dev'\n"
+                "targets = ['version.py', 'package.json', 'other.py']\n"
+                "[AutoVersionConfig.key_aliases]\n"
+                "VERSION = 'VERSION_KEY'\n"
+                "version = 'VERSION_KEY'\n"
+            )
+        self.write("version.py", 'VERSION = "1.2.3"\r\nBUILD = "none"\r\n')
+        self.write("package.json", '{\n  "version": "1.2.3"\n}\n')
+        self.write("other.py", 'NAME = "other"\n')
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        self.kwargs = dict(config_path="config.toml", bump="minor", BUILD="b1")
+
+    def write(self, path, text):
+        with open(path, "w", newline="") as fh:
+            fh.write(text)
+
+    def read_all(self):
+        contents = {}
+        for path in ("version.py", "package.json", "other.py"):
+            with open(path, "rb") as fh:
+                contents[path] = fh.read()
+        return contents
+
+    def test_same_as_main(self):
+        original = self.read_all()
+        plan = json.loads(json.dumps(auto_version_tool.make_plan(**self.kwargs)))
+        self.assertEqual(original, self.read_all())
+        self.assertEqual(("1.2.3", "1.3.0-dev.1"), (plan["old"], plan["new"]))
+        # unchanged targets aren't in the plan
+        self.assertEqual(
+            ["version.py", "package.json"], [t["path"] for t in plan["targets"]]
+        )
+        self.assertEqual(
+            ["version.py", "package.json"], auto_version_tool.apply_plan(plan)
+        )
+        applied = self.read_all()
+        for path, content in original.items():
+            self.write(path, content.decode("utf8"))
+        auto_version_tool.main(**self.kwargs)
+        self.assertEqual(self.read_all(), applied)
+        self.assertIn(b'VERSION = "1.3.0-dev.1"', applied["version.py"])
+
+    def test_changed_target(self):
+        plan = auto_version_tool.make_plan(**self.kwargs)
+        original = self.read_all()
+        self.write("package.json", '{\n  "version": "1.2.4"\n}\n')
+        with self.assertRaises(ValueError):
+            auto_version_tool.apply_plan(plan)
+        # nothing was written
+        self.assertEqual(original["version.py"], self.read_all()["version.py"])
+
+    def test_format(self):
+        plan = auto_version_tool.make_plan(**self.kwargs)
+        plan["format"] = 0
+        with self.assertRaises(ValueError):
+            auto_version_tool.apply_plan(plan)
+
+    def test_persist_to_vcs(self):
+        with self.assertRaisesRegex(ValueError, "can't persist to vcs"):
+            auto_version_tool.make_plan(
+                persist_to=[Constants.TO_SOURCE, Constants.TO_VCS], **self.kwargs
+            )
+
+    def test_cli(self):
+        def run_cli(*argv):
+            argv = ("auto_version",) + argv
+            with mock.patch("sys.argv", list(argv)), contextlib.redirect_stdout(
+                io.StringIO()
+            ) as stdout:
+                auto_version_tool.main_from_cli()
+            return stdout.getvalue()
+
+        original = self.read_all()
+        output = run_cli(
+            "plan", "--config", "config.toml", "--bump", "minor", "--plan-file", "plan"
+        )
+        self.assertEqual("1.3.0-dev.1\n", output)
+        self.assertEqual(original, self.read_all())
+        self.assertEqual("1.3.0-dev.1\n", run_cli("apply", "--plan-file", "plan"))
+        self.assertIn(b'"version": "1.3.0-dev.1"', self.read_all()["package.json"])
+
+
+class TestKeyIndex(unittest.TestCase):
+    """The persistent index of where keys are defined"""
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("targets", "key_aliases", "USE_KEY_INDEX"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        with open("config.toml", "w") as fh:
+            fh.write(
+                "[AutoVersionConfig]\n"
+                "targets = ['version.py', 'other.py', 'package.json']\n"
+                "[AutoVersionConfig.key_aliases]\n"
+                "VERSION = 'VERSION_KEY'\n"
+                "version = 'VERSION_KEY'\n"
+            )
+        self.write("version.py", 'VERSION = "1.2.3"\nBUILD = "none"\n')
+        self.write("other.py", 'NAME = "other"\n')
+        self.write("package.json", '{\n  "version": "1.2.3"\n}\n')
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        auto_version_tool.load_config("config.toml")
+
+    def write(self, path, text):
+        with open(path, "w") as fh:
+            fh.write(text)
+        # well before the index is written, so it isn't racy
+        past = time.time_ns() - 10 ** 10
+        os.utime(path, ns=(past, past))
+
+    def test_incremental(self):
+        index, read = key_index.build()
+        self.assertEqual(3, read)
+        self.assertEqual(
+            [("version.py", 0, 11, 16, "1.2.3")], index.occurrences("VERSION")
+        )
+        self.assertEqual((3, 0), (len(index.files), key_index.build()[1]))
+        self.write("other.py", 'NAME = "renamed"\nVERSION = "1.2.3"\n')
+        index, read = key_index.build()
+        self.assertEqual(1, read)
+        self.assertEqual(2, len(index.occurrences("VERSION")))
+        os.remove("other.py")
+        index, read = key_index.build()
+        self.assertEqual((0, 2), (read, len(index.files)))
+
+    def test_same_length_edit(self):
+        key_index.build()
+        stat = os.stat("other.py")
+        # replaced (as editors do) with the same size and modification time
+        self.write("other.tmp", 'NAME = "rehto"\n')
+        os.utime("other.tmp", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace("other.tmp", "other.py")
+        index, read = key_index.build()
+        self.assertEqual(1, read)
+        self.assertEqual({"NAME": "rehto"}, index.keypairs("other.py"))
+
+    def test_racy(self):
+        future = time.time_ns() + 60 * 10 ** 9
+        os.utime("other.py", ns=(future, future))
+        self.assertEqual(3, key_index.build()[1])
+        # modified no earlier than the index was written, so it's read again
+        index, read = key_index.build()
+        self.assertEqual(1, read)
+        # but only once in a run
+        self.assertEqual(0, index.update(index.files))
+
+    def test_subdirectory(self):
+        self.assertEqual(3, key_index.build()[1])
+        os.mkdir("sub")
+        self.write(os.path.join("sub", "inner.py"), 'VERSION = "1.2.3"\n')
+        os.chdir("sub")
+        # the whole tree is indexed, from the root, wherever we're run from
+        index, read = key_index.build()
+        self.assertEqual((1, 4), (read, len(index.files)))
+        self.assertEqual({"VERSION": "1.2.3"}, index.keypairs("inner.py"))
+        self.assertEqual(
+            {"VERSION": "1.2.3", "BUILD": "none"},
+            index.keypairs(os.path.join("..", "version.py")),
+        )
+        self.assertEqual(
+            ["sub/inner.py", "version.py"],
+            [occurrence[0] for occurrence in index.occurrences("VERSION")],
+        )
+        os.chdir("..")
+        self.assertEqual((4, 0), (len(index.files), key_index.build()[1]))
+
+    def test_same_results(self):
+        targets = config.targets
+        for keys in (None, ["VERSION"], ["NAME", "version"]):
+            config.USE_KEY_INDEX = False
+            expected = auto_version_tool.read_targets(targets, keys=keys)
+            config.USE_KEY_INDEX = True
+            self.assertEqual(expected, auto_version_tool.read_targets(targets, keys))
+
+    def test_write_skips_targets(self):
+        config.USE_KEY_INDEX = True
+        with mock.patch.object(
+            auto_version_tool, "read_target", wraps=auto_version_tool.read_target
+        ) as read_target:
+            written = auto_version_tool.write_targets(
+                config.targets, VERSION="1.3.0", version="1.3.0"
+            )
+        self.assertEqual(["version.py", "package.json"], written)
+        self.assertNotIn("other.py", [c[0][0] for c in read_target.call_args_list])
+        with open("version.py") as fh:
+            self.assertEqual('VERSION = "1.3.0"\nBUILD = "none"\n', fh.read())
+
+    def test_write_uses_recorded_spans(self):
+        config.USE_KEY_INDEX = True
+        self.write("version.py", 'VERSION = "1.2.3"\nBUILD = "none"\n' * 3)
+        key_index.build()
+        with mock.patch.object(
+            auto_version_tool,
+            "find_replacements",
+            wraps=auto_version_tool.find_replacements,
+        ) as find_replacements:
+            written = auto_version_tool.write_targets(
+                config.targets, VERSION="1.3.0", version="1.10.0"
+            )
+        self.assertEqual(["version.py", "package.json"], written)
+        find_replacements.assert_not_called()
+        with open("version.py") as fh:
+            self.assertEqual('VERSION = "1.3.0"\nBUILD = "none"\n' * 3, fh.read())
+        with open("package.json") as fh:
+            self.assertEqual('{\n  "version": "1.10.0"\n}\n', fh.read())
+
+    def test_recorded_span_out_of_date(self):
+        find = auto_version_tool.find_indexed_replacements
+        handler = ReplacementHandler(VERSION="1.3.0")
+        definitions = [["VERSION", 1, 11, 16, "1.2.3"]]
+        self.assertEqual(
+            [(6, 23, 'VERSION = "1.3.0"')],
+            find(handler, 'A = 1\nVERSION = "1.2.3"\n', definitions),
+        )
+        # the value isn't where it was recorded
+        self.assertIsNone(find(handler, 'A = 1\n\nVERSION = "1.2.3"\n', definitions))
+        self.assertIsNone(find(handler, "A = 1\n", definitions))
+
+    def test_check(self):
+        def run_cli(*argv):
+            argv = ("auto_version",) + argv
+            code = 0
+            with mock.patch("sys.argv", list(argv)), contextlib.redirect_stdout(
+                io.StringIO()
+            ) as stdout:
+                try:
+                    auto_version_tool.main_from_cli()
+                except SystemExit as e:
+                    code = e.code
+            return code, stdout.getvalue()
+
+        self.assertEqual((0, ""), run_cli("check", "--config", "config.toml"))
+        self.write("other.py", 'VERSION = "1.2.4"\n')
+        code, output = run_cli("check", "--config", "config.toml", "VERSION")
+        self.assertEqual(1, code)
+        self.assertIn("other.py:1: 1.2.4", output)
+        code, output = run_cli("check", "--config", "config.toml", "--json")
+        self.assertEqual(
+            {
+                "VERSION": [
+                    {"path": "other.py", "line": 1, "value": "1.2.4"},
+                    {"path": "version.py", "line": 1, "value": "1.2.3"},
+                ]
+            },
+            json.loads(output),
+        )
+        self.assertEqual(
+            (0, "indexed 3 files (0 read)\n"),
+            run_cli("index", "--config", "config.toml"),
+        )
+
+
+class TestUpdatesFile(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.root = root
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return path
+
+    def test_json(self):
+        path = self.write("updates.json", '{"A_SHA": "abc123", "COUNT": 3}')
+        self.assertEqual(
+            {"A_SHA": "abc123", "COUNT": 3}, auto_version_tool.load_updates_file(path)
+        )
+
+    def test_toml(self):
+        path = self.write("updates.toml", 'A_SHA = "abc123"\nCOUNT = 3\n')
+        self.assertEqual(
+            {"A_SHA": "abc123", "COUNT": 3}, auto_version_tool.load_updates_file(path)
+        )
+
+    def test_stdin(self):
+        for content in ('{"A_SHA": "abc123"}', 'A_SHA = "abc123"'):
+            with mock.patch("sys.stdin", io.StringIO(content)):
+                self.assertEqual(
+                    {"A_SHA": "abc123"}, auto_version_tool.load_updates_file("-")
+                )
+
+    def test_not_a_mapping(self):
+        path = self.write("updates.json", '["A_SHA"]')
+        with self.assertRaises(ValueError):
+            auto_version_tool.load_updates_file(path)
+
+    def test_option_names_rejected(self):
+        path = self.write("updates.json", '{"A_SHA": "abc123", "dry_run": false}')
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.root)
+        for argv, name in (
+            (["--updates-file", path], "dry_run"),
+            (["release=1"], "release"),
+        ):
+            with mock.patch("sys.argv", ["auto_version"] + argv):
+                with self.assertRaisesRegex(
+                    ValueError, "option of the run: %s$" % name
+                ):
+                    auto_version_tool.main_from_cli()
+
+    def test_many_keys(self):
+        params = {"COMPONENT_%s_SHA" % i: "sha%s" % i for i in range(300)}
+        text = "".join('%s = "old"\n' % key for key in sorted(params))
+        handler = ReplacementHandler(**params)
+        replaced = replace_text(re.compile(DEFAULT_REGEXERS[".py"]), handler, text)
+        self.assertEqual(
+            "".join('%s = "%s"\n' % (key, params[key]) for key in sorted(params)),
+            replaced,
+        )
+        self.assertEqual(set(), handler.missing)
+
+    def test_key_pattern(self):
+        # the trie finds the same keys as a longest-first alternation
+        rng = random.Random(0)
+        for _ in range(200):
+            keys = {
+                "".join(rng.choice("ab_") for _ in range(rng.randint(1, 5)))
+                for _ in range(rng.randint(1, 8))
+            }
+            text = "".join(rng.choice("ab_ =") for _ in range(rng.randint(0, 40)))
+            alternation = re.compile(
+                "|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+            )
+            trie = re.compile(key_pattern(keys))
+            self.assertEqual(
+                [m.span() for m in alternation.finditer(text)],
+                [m.span() for m in trie.finditer(text)],
+                (keys, text),
+            )
+
+
+class TestWriteTargets(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        self.addCleanup(setattr, config, "regexers", config.regexers)
+        auto_version_tool.load_config(
+            os.path.join(os.path.dirname(__file__), "example.toml")
+        )
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+
+    def write(self, content, mode="w"):
+        with open("version.py", mode) as fh:
+            fh.write(content)
+        os.chmod("version.py", 0o640)
+
+    def read(self):
+        with open("version.py", "rb") as fh:
+            return fh.read()
+
+    def check_in_place(self, header):
+        self.write(header + 'VERSION = "1.2.3"\nOTHER = "x"\nVERSION_AGAIN = "1.2.3"\n')
+        inode = os.stat("version.py").st_ino
+        with mock.patch("os.pwrite", wraps=os.pwrite) as pwrite:
+            written = auto_version_tool.write_targets(
+                ["version.py"], VERSION="1.2.4", VERSION_AGAIN="1.2.9"
+            )
+        self.assertEqual(["version.py"], written)
+        self.assertEqual(inode, os.stat("version.py").st_ino)
+        self.assertEqual([b"4", b"9"], [call[0][1] for call in pwrite.call_args_list])
+        expected = header + 'VERSION = "1.2.4"\nOTHER = "x"\nVERSION_AGAIN = "1.2.9"\n'
+        self.assertEqual(
+            expected.encode(locale.getpreferredencoding(False)), self.read()
+        )
+
+    def test_same_length_in_place(self):
+        self.check_in_place("# version\n")
+
+    @unittest.skipUnless(
+        codecs.lookup(locale.getpreferredencoding(False)).name == "utf-8",
+        "needs a utf-8 locale",
+    )
+    def test_multibyte_in_place(self):
+        self.check_in_place("# vérsion ü\n")
+
+    def test_length_change_rewrites(self):
+        self.write('VERSION = "1.2.3"\nOTHER = "x"\n')
+        with mock.patch("os.pwrite") as pwrite:
+            auto_version_tool.write_targets(["version.py"], VERSION="1.2.10")
+        self.assertFalse(pwrite.called)
+        self.assertEqual(b'VERSION = "1.2.10"\nOTHER = "x"\n', self.read())
+        self.assertEqual(0o640, os.stat("version.py").st_mode & 0o777)
+        self.assertEqual(["version.py"], os.listdir("."))
+
+    def test_crlf_rewrites(self):
+        self.write(b'VERSION = "1.2.3"\r\nOTHER = "x"\r\n', mode="wb")
+        with mock.patch("os.pwrite") as pwrite:
+            auto_version_tool.write_targets(["version.py"], VERSION="1.2.4")
+        self.assertFalse(pwrite.called)
+        self.assertEqual(b'VERSION = "1.2.4"\nOTHER = "x"\n', self.read())
+
+    def test_unchanged_not_written(self):
+        self.write('VERSION = "1.2.3"\n')
+        with mock.patch("os.pwrite") as pwrite:
+            written = auto_version_tool.write_targets(["version.py"], VERSION="1.2.3")
+        self.assertEqual([], written)
+        self.assertFalse(pwrite.called)
+
+
+class TestParallelScan(unittest.TestCase):
+    """Huge targets, scanned in chunks in parallel, give the same result as a single scan"""
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("regexers", "PARALLEL_SCAN_THRESHOLD", "PARALLEL_SCAN_WORKERS"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        auto_version_tool.load_config(
+            os.path.join(os.path.dirname(__file__), "example.toml")
+        )
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        patcher = mock.patch.object(
+            auto_version_tool, "PARALLEL_SCAN_MIN_CHUNK_SIZE", 64
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        config.PARALLEL_SCAN_WORKERS = 2
+        lines = []
+        for i in range(200):
+            lines.append("component.%s.name = thing %s" % (i, i))
+            if i % 7 == 0:
+                lines.append("VERSION = 1.2.3")
+            if i % 50 == 0:
+                lines.append("COMMIT = abcdef")
+        self.content = "\n".join(lines) + "\n"
+
+    def write_targets(self, threshold, **params):
+        with open("catalog.properties", "w") as fh:
+            fh.write(self.content)
+        config.PARALLEL_SCAN_THRESHOLD = threshold
+        missing = None
+        try:
+            auto_version_tool.write_targets(["catalog.properties"], **params)
+        except Exception as e:
+            missing = str(e)
+        with open("catalog.properties") as fh:
+            return fh.read(), missing
+
+    def check(self, **params):
+        serial = self.write_targets(0, **params)
+        parallel = self.write_targets(1, **params)
+        self.assertEqual(serial, parallel)
+        return parallel
+
+    def test_same_length(self):
+        with mock.patch("os.pwrite", wraps=os.pwrite) as pwrite:
+            text, missing = self.check(VERSION="1.2.4")
+        self.assertIsNone(missing)
+        self.assertEqual(self.content.count("1.2.3"), text.count("1.2.4"))
+        self.assertEqual({b"4"}, {call[0][1] for call in pwrite.call_args_list})
+
+    def test_length_change(self):
+        text, missing = self.check(VERSION="1.20.0", COMMIT="0123456789")
+        self.assertIsNone(missing)
+        self.assertNotIn("1.2.3", text)
+        self.assertEqual(self.content.count("abcdef"), text.count("0123456789"))
+
+    def test_missing(self):
+        text, missing = self.check(VERSION="1.2.4", NOT_THERE="x")
+        self.assertIn("NOT_THERE", missing)
+        self.assertNotIn("VERSION", missing)
+
+    def test_chunks(self):
+        data = b"a\nbb\nccc\n\nd"
+        chunks = auto_version_tool.get_chunks(data, 3)
+        self.assertEqual(data, b"".join(data[start:end] for start, end in chunks))
+        self.assertTrue(all(data[end - 1:end] == b"\n" for _, end in chunks[:-1]))
+
+
+class TestReadTargets(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        with open("first.py", "w") as fh:
+            fh.write('VERSION = "1.0.0"\nLOCK = False\nVERSION = "1.0.1"\n')
+        with open("second.py", "w") as fh:
+            fh.write('VERSION = "2.0.0"\nRELEASE = True\n')
+        self.addCleanup(setattr, config, "KEY_PRECEDENCE", config.KEY_PRECEDENCE)
+
+    def test_last_wins(self):
+        config.KEY_PRECEDENCE = Constants.LAST_WINS
+        targets = ["first.py", "second.py"]
+        everything = {"VERSION": "2.0.0", "LOCK": "False", "RELEASE": "True"}
+        self.assertEqual(everything, auto_version_tool.read_targets(targets))
+        # once the later target defines every key we need, the earlier one isn't read
+        self.assertEqual(
+            {"VERSION": "2.0.0", "RELEASE": "True"},
+            auto_version_tool.read_targets(targets, keys={"VERSION"}),
+        )
+        # the last definition is found first, searching from the end
+        self.assertEqual(
+            {"VERSION": "1.0.1"},
+            auto_version_tool.read_targets(["first.py"], keys={"VERSION"}),
+        )
+
+    def test_first_wins(self):
+        config.KEY_PRECEDENCE = Constants.FIRST_WINS
+        targets = ["first.py", "second.py"]
+        everything = {"VERSION": "1.0.0", "LOCK": "False", "RELEASE": "True"}
+        self.assertEqual(everything, auto_version_tool.read_targets(targets))
+        self.assertEqual(
+            {"VERSION": "1.0.0"},
+            auto_version_tool.read_targets(targets, keys={"VERSION"}),
+        )
+
+    def test_stops_reading_lines(self):
+        def lines():
+            yield 'VERSION = "1.0.0"'
+            yield 'LOCK = False'
+            raise AssertionError("read too far")
+
+        regexer = scanners.SCANNERS[".py"]
+        found = extract_keypairs(lines(), regexer, keys={"VERSION", "LOCK"}, first_wins=True)
+        self.assertEqual({"VERSION": "1.0.0", "LOCK": "False"}, found)
+
+    def test_read_lines_backwards(self):
+        body = 'A = "\u00e9t\u00e9"\r\nB = 1\rC = 2\n\r\nD = "%s"\nE = 3' % ("x" * 10)
+        for text in (body, body + "\n", body + "\r", body + "\r\n", "", "\n"):
+            # utf-16 can't be split on the raw bytes, so is read whole
+            for encoding in ("utf8", "utf-16"):
+                with open("mixed.py", "w", encoding=encoding, newline="") as fh:
+                    fh.write(text)
+                with open("mixed.py", encoding=encoding) as fh:
+                    expected = [line.rstrip("\n") for line in reversed(fh.readlines())]
+                for chunk_size in (1, 2, 3, 7, 1 << 16):
+                    lines = auto_version_tool.read_lines_backwards(
+                        "mixed.py", encoding, chunk_size=chunk_size
+                    )
+                    self.assertEqual(expected, list(lines), (text, chunk_size))
+
 
 class TestTagReplacements(unittest.TestCase):
     some_tags = [
@@ -381,6 +2205,18 @@ class TestTagReplacements(unittest.TestCase):
     def eval(self, template, tags, expect):
         config.TAG_TEMPLATE = template
         self.assertEqual(get_all_versions_from_tags(tags), expect)
+        # the same versions are found when streaming git output, however it's chunked
+        output = "\n".join(tags).encode("utf8")
+        for chunk_size in (1, 7, len(output)):
+            with self.subTest(chunk_size=chunk_size) if six.PY3 else Noop():
+                streamed = auto_version_tool.iter_versions_from_tag_output(
+                    io.BytesIO(output), chunk_size=chunk_size
+                )
+                self.assertEqual(list(streamed), expect)
+        lines = io.BytesIO(output.replace(b"\n", b"\r\n"))
+        self.assertEqual(
+            list(auto_version_tool.iter_versions_from_tag_lines(lines)), expect
+        )
 
     def test_empty_tag(self):
         self.eval("", self.some_tags, [])
@@ -465,6 +2301,28 @@ class BaseReplaceCheck(unittest.TestCase):
                     [line],
                 )
                 self.assertEqual([replaced], extracted)
+                extracted = replace_text(
+                    self.regexer,
+                    ReplacementHandler(**{self.key: self.value_replaced}),
+                    line,
+                )
+                self.assertEqual(replaced, extracted)
+
+    def test_replace_whole_text(self):
+        """replacing a whole buffer gives the same result as replacing line by line"""
+        if self.regexer is None:
+            return
+        lines = self.lines + list(self.explicit_replacement) + self.non_matching
+        lines = [line if line.endswith("\n") else line + "\n" for line in lines]
+        lines.append("unrelated = 1\n")
+        params = {self.key: self.value_replaced, "unrelated_too": "x"}
+        by_line = ReplacementHandler(**params)
+        whole = ReplacementHandler(**params)
+        self.assertEqual(
+            "".join(replace_lines(self.regexer, by_line, lines)),
+            replace_text(self.regexer, whole, "".join(lines)),
+        )
+        self.assertEqual(by_line.missing, whole.missing)
 
 
 class PythonRegexTest(BaseReplaceCheck):
@@ -536,3 +2394,190 @@ class YamlRegexTest(BaseReplaceCheck):
         "    CTEST_ARGS: -L node_cpu\r\n": "    CTEST_ARGS: -L node_cpu\r\n",
     }
     non_matching = ["""entrypoint: [""]\r\n"""]  # don't match on empty arrays
+
+
+class PythonScannerTest(PythonRegexTest):
+    regexer = scanners.SCANNERS[".py"]
+
+
+class JSONScannerTest(JSONRegexTest):
+    regexer = scanners.SCANNERS[".json"]
+
+
+class JSONBoolScannerTest(JSONBoolRegexTest):
+    regexer = scanners.SCANNERS[".json"]
+
+
+class PropertiesScannerTest(PropertiesRegexTest):
+    regexer = scanners.SCANNERS[".properties"]
+
+
+class CSharpScannerTest(CSharpRegexTest):
+    regexer = scanners.SCANNERS[".cs"]
+
+
+class XMLScannerTest(XMLRegexTest):
+    regexer = scanners.SCANNERS[".csproj"]
+
+
+class YamlScannerTest(YamlRegexTest):
+    regexer = scanners.SCANNERS[".yaml"]
+
+
+class TestScannerEquivalence(unittest.TestCase):
+    """Scanners must find exactly what their regex finds"""
+
+    alphabet = 'a_1 \t\n"\',:=\\<>/#[]-.+*\r\f\xa0\xe9'
+    prefixes = ["key", '"key"', "a b key", "<key>", "  k:e"]
+    separators = ["=", ":", " = ", ": ", '": "', " :\t"]
+
+    @staticmethod
+    def summary(match):
+        if match:
+            return match.span("KEY"), match.span("VALUE"), match.end(), match.groupdict()
+
+    def test_random_lines(self):
+        rng = random.Random(0)
+
+        def replace(match):
+            return "<%s>" % match.group("KEY")
+
+        for file_ext, scanner in scanners.SCANNERS.items():
+            regexer = re.compile(DEFAULT_REGEXERS[file_ext])
+            for _ in range(3000):
+                line = "".join(rng.choice(self.alphabet) for _ in range(rng.randint(0, 14)))
+                if rng.random() < 0.5:
+                    line = rng.choice(self.prefixes) + rng.choice(self.separators) + line
+                self.assertEqual(
+                    self.summary(regexer.match(line)),
+                    self.summary(scanner.match(line)),
+                    (file_ext, line),
+                )
+                self.assertEqual(regexer.sub(replace, line), scanner.sub(replace, line))
+
+    def test_no_backtracking(self):
+        # the regex for this line would take exponential time to fail
+        line = "a  " * 200 + "b"
+        self.assertIsNone(scanners.SCANNERS[".cs"].match(line))
+
+    def test_custom_regex_kept(self):
+        custom = re.compile(r"^(?P<KEY>\w+)~(?P<VALUE>\w+)")
+        self.assertIs(custom, scanners.for_extension(".py", custom))
+        self.assertIs(custom, scanners.for_extension(".custom", custom))
+        builtin = re.compile(DEFAULT_REGEXERS[".py"])
+        self.assertIs(scanners.SCANNERS[".py"], scanners.for_extension(".py", builtin))
+
+
+class TestMemoryBudgets(unittest.TestCase):
+    """Peak memory allocated on large inputs, as traced by tracemalloc
+
+    Each budget is a fixed allowance in bytes, plus an allowance per unit of input that
+    has to be held: the bytes of a target being rewritten, a trigger file that's found, or
+    a version that's returned. The inputs are big enough that holding a whole target, or
+    every tag, in memory where it isn't needed goes over budget.
+    """
+
+    # (bytes, bytes per unit of input)
+    BUDGETS = {
+        "read_targets": (512 << 10, 0),
+        "write_targets": (256 << 10, 2.5),
+        "detect_file_triggers": (256 << 10, 400),
+        "get_dvcs_ordered_tag_semvers": (512 << 10, 1024),
+    }
+    TARGET_LINES = 50000
+    TRIGGER_FILES = 2000
+    NIGHTLY_TAGS = 20000
+    RELEASE_TAGS = 100
+
+    git_env = TestShallowClone.git_env
+
+    def git(self, *args):
+        subprocess.check_call(("git",) + args, env=self.git_env)
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        for name in ("targets", "KEY_PRECEDENCE", "trigger_patterns", "TAG_TEMPLATE"):
+            self.addCleanup(setattr, config, name, getattr(config, name))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.chdir(root)
+        self.git("init", "-q")
+        self.git("commit", "-q", "--allow-empty", "-m", "initial")
+        with open("version.py", "w") as fh:
+            fh.write('VERSION = "1.2.3"\n')
+            for line in range(self.TARGET_LINES):
+                fh.write("# line %s of a large generated file\n" % line)
+            fh.write('BUILD = "b1"\n')
+        config.targets = ["version.py"]
+
+    def assertWithinBudget(self, name, units, func, *args, **kwargs):
+        fixed, per_unit = self.BUDGETS[name]
+        budget = fixed + per_unit * units
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLessEqual(
+            peak, budget, "%s: peak of %s bytes is over budget" % (name, peak)
+        )
+        return result
+
+    def test_read_targets(self):
+        for precedence in (Constants.FIRST_WINS, Constants.LAST_WINS):
+            config.KEY_PRECEDENCE = precedence
+            self.assertEqual(
+                {"VERSION": "1.2.3", "BUILD": "b1"},
+                self.assertWithinBudget(
+                    "read_targets", 0, auto_version_tool.read_targets, config.targets
+                ),
+            )
+
+    def test_write_targets(self):
+        size = os.path.getsize("version.py")
+        written = self.assertWithinBudget(
+            "write_targets",
+            size,
+            auto_version_tool.write_targets,
+            config.targets,
+            VERSION="1.3.0",
+        )
+        self.assertEqual(["version.py"], written)
+        self.assertEqual(size, os.path.getsize("version.py"))
+
+    def test_detect_file_triggers(self):
+        config.trigger_patterns = {"news/*.feature": "minor", "news/*.bugfix": "patch"}
+        release_commit = vcs.get_backend().head()
+        os.mkdir("news")
+        for number in range(self.TRIGGER_FILES):
+            open(os.path.join("news", "%s.feature" % number), "w").close()
+        self.git("add", "news")
+        self.git("commit", "-q", "-m", "news")
+        for commit in (None, release_commit):
+            triggers, files = self.assertWithinBudget(
+                "detect_file_triggers",
+                self.TRIGGER_FILES,
+                auto_version_tool.detect_file_triggers,
+                commit,
+            )
+            self.assertEqual(({"minor"}, self.TRIGGER_FILES), (triggers, len(files)))
+
+    def test_get_dvcs_ordered_tag_semvers(self):
+        config.TAG_TEMPLATE = "release/{version}"
+        head = vcs.get_backend().head()
+        # these match the glob that git lists tags with, but have no version
+        tags = ["release/nightly-%s" % number for number in range(self.NIGHTLY_TAGS)]
+        tags += ["release/1.0.%s" % number for number in range(self.RELEASE_TAGS)]
+        # written as packed refs, as creating this many loose refs is slow
+        with open(os.path.join(".git", "packed-refs"), "w") as fh:
+            fh.write("# pack-refs with: peeled fully-peeled sorted \n")
+            for tag in sorted(tags):
+                fh.write("%s refs/tags/%s\n" % (head, tag))
+        versions = self.assertWithinBudget(
+            "get_dvcs_ordered_tag_semvers",
+            self.RELEASE_TAGS,
+            auto_version_tool.get_dvcs_ordered_tag_semvers,
+        )
+        self.assertEqual(self.RELEASE_TAGS, len(versions))
+        self.assertEqual("1.0.99", str(versions[-1]))
@@ -5,6 +5,7 @@ import semver
 from auto_version.config import AutoVersionConfig as config
 from auto_version.config import Constants
 from auto_version.definitions import SemVerSigFig
+from auto_version.version_engine import VersionRecord
 
 _LOG = logging.getLogger(__file__)
 
@@ -120,7 +121,7 @@ def make_new_semver(current_semver, last_release_semver, all_triggers, **overrid
     :param overrides: explicit values for some or all of the sigfigs
     :return:
     """
-    version_string = str(current_semver)
+    version = VersionRecord.from_version(current_semver)
 
     # if the current version isn't a full release
     if not is_release(current_semver) and last_release_semver:
@@ -142,23 +143,21 @@ def make_new_semver(current_semver, last_release_semver, all_triggers, **overrid
 
     if bump_sigfig:
         # perform an increment using the most-significant trigger
-        version_string = getattr(semver, "bump_" + bump_sigfig)(
-            str(current_semver), **get_token_args(bump_sigfig)
-        )
+        version.bump(bump_sigfig, **get_token_args(bump_sigfig))
 
         if sigfig_gt(bump_sigfig, SemVerSigFig.prerelease):
             # if we *didnt* increment sub-patch already, then we should do so
             # this provides the "devmode template" as previously
             # and ensures a simple 'bump' doesn't look like a full release
-            version_string = semver.bump_prerelease(
-                version_string, token=config.PRERELEASE_TOKEN
-            )
+            version.bump_prerelease(token=config.PRERELEASE_TOKEN)
 
     # perform any explicit setting of sigfigs
-    version_info = semver.parse_version_info(version_string)
     for k, v in overrides.items():
         token_args = get_token_args(k)
-        prefix = list(token_args.values()).pop() + "." if token_args else ""
-        setattr(version_info, "_" + k, prefix + str(v))
+        if token_args:
+            setattr(version, k, list(token_args.values()).pop() + "." + str(v))
+        else:
+            # major, minor and patch stay numeric, so the version can still be formatted
+            setattr(version, k, int(v))
 
-    return version_info
+    return version.to_version_info()
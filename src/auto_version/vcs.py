@@ -0,0 +1,600 @@
+"""Version control backends: everything we need to know from (or do to) the repository
+
+- `GitBackend`: runs git commands (the default)
+- `RefsBackend`: reads HEAD, the refs and tag objects directly from the git directory,
+  so listing and resolving tags costs no processes. Anything else is left to git.
+- `MemoryBackend`: a repository held entirely in memory, for fast hermetic tests
+  and benchmarks of large tag and commit histories
+
+The backend is chosen with `VCS_BACKEND`, or set for a block of code with `active`.
+"""
+import contextlib
+import fnmatch
+import hashlib
+import io
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import zlib
+
+from auto_version import processes
+from auto_version.commit_graph import CommitGraph
+from auto_version.commit_graph import get_tag_commits
+from auto_version.config import AutoVersionConfig as config
+
+_LOG = logging.getLogger(__file__)
+
+TAGS_PREFIX = "refs/tags/"
+SHA_REGEX = re.compile(r"^[0-9a-f]{40}$")
+VERSION_PARTS = re.compile(r"(\d+)")
+TAG_OBJECT = "object %s\ntype commit\ntag %s\ntagger %s\n\n%s\n"
+
+_active = []
+_batches = []
+
+
+def version_sort_key(tag):
+    """Orders tags as `git --sort=version:refname` does, for numbered tags"""
+    return [int(part) if part.isdigit() else part for part in VERSION_PARTS.split(tag)]
+
+
+class Backend(object):
+    """The operations on a repository, as used by auto_version
+
+    Refs are anything a backend can resolve: "HEAD", tag names or commit ids.
+    """
+
+    def head(self):
+        """The commit id of HEAD (or None, if there are no commits)"""
+        return self.resolve("HEAD")
+
+    def resolve(self, ref):
+        """The commit id a ref points at (tags are peeled), or None if it doesn't exist"""
+        raise NotImplementedError()
+
+    def is_ancestor(self, ancestor, descendant="HEAD"):
+        """Whether a ref is reachable from another"""
+        raise NotImplementedError()
+
+    def commit_count(self, revision="HEAD", since=None):
+        """Counts the commits reachable from a ref (but not from `since`, if given)"""
+        raise NotImplementedError()
+
+    def added_files(self, since, pattern):
+        """Paths matching a glob, which were added between a ref and HEAD"""
+        raise NotImplementedError()
+
+    def list_tags(self, pattern="*"):
+        """Names of the tags matching a glob"""
+        raise NotImplementedError()
+
+    def root(self):
+        """The top directory of the working tree"""
+        raise NotImplementedError()
+
+    def cache_dir(self):
+        """Where the persistent caches are kept (for git, the git directory)"""
+        raise NotImplementedError()
+
+    def list_files(self):
+        """Paths of the files in the tree (that aren't ignored), relative to `root`"""
+        raise NotImplementedError()
+
+    def create_tag(self, tag, message):
+        """Creates an annotated tag on HEAD"""
+        raise NotImplementedError()
+
+    def create_tags(self, tags):
+        """Creates annotated tags on HEAD
+
+        :param tags: list of (tag, message)
+        """
+        for tag, message in tags:
+            self.create_tag(tag, message)
+
+    def tag_commits(self):
+        """Maps every tag to the commit it points at"""
+        return {tag: self.resolve(tag) for tag in self.list_tags()}
+
+    def commit_graph(self):
+        """The graph of the commits reachable from HEAD"""
+        raise NotImplementedError()
+
+    def is_shallow(self):
+        """Whether only part of the history is available"""
+        return False
+
+    def deepen(self, commits, remote):
+        """Fetches more history, in a shallow repository"""
+        raise NotImplementedError()
+
+    @contextlib.contextmanager
+    def tag_stream(self, pattern):
+        """Newline separated names of the tags matching a glob, as a binary stream"""
+        yield io.BytesIO("\n".join(self.list_tags(pattern)).encode("utf8"))
+
+    @contextlib.contextmanager
+    def merged_tag_stream(self, pattern):
+        """As `tag_stream`, but only tags reachable from HEAD, highest version first
+
+        Read a line at a time, so the reader can stop once it has what it needs.
+        """
+        tags = [tag for tag in self.list_tags(pattern) if self.is_ancestor(tag)]
+        tags.sort(key=version_sort_key, reverse=True)
+        yield io.BytesIO("\n".join(tags).encode("utf8"))
+
+
+class GitBackend(Backend):
+    """Runs git commands"""
+
+    def _output(self, *args):
+        return processes.check_output(("git",) + args).decode("utf8").strip()
+
+    def resolve(self, ref):
+        try:
+            return self._output("rev-parse", "--verify", "--quiet", ref + "^{commit}")
+        except subprocess.CalledProcessError:
+            return None
+
+    def is_ancestor(self, ancestor, descendant="HEAD"):
+        try:
+            # if "--is-ancestor" returns exit code 0, then it is an ancestor
+            self._output("merge-base", "--is-ancestor", ancestor, descendant)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def commit_count(self, revision="HEAD", since=None):
+        if since:
+            revision = "%s..%s" % (since, revision)
+        return int(self._output("rev-list", "--count", revision))
+
+    def added_files(self, since, pattern):
+        # fortunately, git filter syntax is compatible with the glob syntax we're already using
+        lines = self._output(
+            "diff",
+            "--relative",
+            "--name-status",
+            since,
+            "HEAD",
+            "--diff-filter",
+            "A",
+            pattern,
+        ).splitlines()
+        return [line.split()[1].strip() for line in lines]
+
+    def list_tags(self, pattern="*"):
+        return self._output("tag", "--list", pattern).splitlines()
+
+    def root(self):
+        return find_work_tree(os.getcwd())
+
+    def cache_dir(self):
+        return find_git_dir(os.getcwd())
+
+    def list_files(self):
+        output = processes.check_output(
+            [
+                "git",
+                "ls-files",
+                "-z",
+                "--cached",
+                "--others",
+                "--exclude-standard",
+                "--full-name",
+                "--",
+                ":/",
+            ]
+        ).decode("utf8")
+        return sorted(set(path for path in output.split("\0") if path))
+
+    def create_tag(self, tag, message):
+        self._output("tag", "-a", tag, "-m", message)
+
+    def create_tags(self, tags):
+        """Creates the tag objects, then all the refs in one transaction
+
+        `git mktag` checks each tag object is well formed before writing it.
+        If any of the refs can't be created (e.g. the tag already exists) none of them are.
+        """
+        head = self.head()
+        tagger = self._output("var", "GIT_COMMITTER_IDENT")
+        shas = [
+            processes.check_output(
+                ["git", "mktag"],
+                input=(TAG_OBJECT % (head, tag, tagger, message)).encode("utf8"),
+            ).strip()
+            for tag, message in tags
+        ]
+        commands = "".join(
+            "create %s%s %s\n" % (TAGS_PREFIX, tag, sha.decode("ascii"))
+            for (tag, _), sha in zip(tags, shas)
+        )
+        processes.check_output(
+            ["git", "update-ref", "--stdin"], input=commands.encode("utf8")
+        )
+        _LOG.debug("created %s tags", len(tags))
+
+    def tag_commits(self):
+        return get_tag_commits()
+
+    def commit_graph(self):
+        return CommitGraph.from_git()
+
+    def is_shallow(self):
+        # found without git, as it's checked on every run
+        common_dir = find_common_dir(find_git_dir(os.getcwd()))
+        return os.path.exists(os.path.join(common_dir, "shallow"))
+
+    def deepen(self, commits, remote):
+        processes.check_call(
+            ["git", "fetch", "--quiet", "--deepen=%s" % commits, remote]
+        )
+
+    @contextlib.contextmanager
+    def tag_stream(self, pattern):
+        cmd = ["git", "tag", "--list", pattern]
+        process = processes.popen(cmd, stdout=subprocess.PIPE)
+        try:
+            with process.stdout:
+                yield process.stdout
+        finally:
+            returncode = process.wait()
+            processes.finished(process)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    @contextlib.contextmanager
+    def merged_tag_stream(self, pattern):
+        # git filters the tags to ancestors and orders them, so readers can stop early
+        cmd = [
+            "git",
+            "for-each-ref",
+            "--merged",
+            "HEAD",
+            "--sort=-version:refname",
+            "--format=%(refname:short)",
+            TAGS_PREFIX + pattern,
+        ]
+        process = processes.popen(cmd, stdout=subprocess.PIPE)
+        read_to_end = []
+
+        def lines():
+            for line in process.stdout:
+                yield line
+            read_to_end.append(True)
+
+        try:
+            yield lines()
+        finally:
+            process.stdout.close()
+            if not read_to_end and process.poll() is None:
+                # the reader has what it needs, so there's no need for git to finish
+                process.terminate()
+            returncode = process.wait()
+            processes.finished(process)
+        # otherwise a failure (e.g. a bad ref) would look like there being no tags
+        if read_to_end and returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+class RefsBackend(GitBackend):
+    """Reads the refs (and tag objects) from the git directory, and runs git for the rest
+
+    Objects that have been packed can't be read, so resolving a tag that points at one
+    falls back to git, unless `packed-refs` has already recorded its commit.
+    """
+
+    def __init__(self, git_dir=None):
+        self.git_dir = git_dir or find_git_dir(os.getcwd())
+        # a linked worktree has its own HEAD, but shares the refs
+        self.common_dir = find_common_dir(self.git_dir)
+
+    def read_refs(self):
+        """All the refs
+
+        :returns: dict of ref name to object id, dict of ref name to peeled commit id
+        """
+        refs = {}
+        peeled = {}
+        try:
+            with open(os.path.join(self.common_dir, "packed-refs")) as fh:
+                name = None
+                for line in fh:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.startswith("^"):
+                        peeled[name] = line[1:]
+                        continue
+                    sha, _, name = line.partition(" ")
+                    refs[name] = sha
+        except (IOError, OSError):
+            _LOG.debug("no packed refs")
+        # loose refs take precedence over packed ones
+        refs_dir = os.path.join(self.common_dir, "refs")
+        for root, _, files in os.walk(refs_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                name = "refs/" + os.path.relpath(path, refs_dir).replace(os.sep, "/")
+                if name.endswith(".lock"):
+                    continue
+                with open(path) as fh:
+                    refs[name] = fh.read().strip()
+                peeled.pop(name, None)
+        return refs, peeled
+
+    def ref_files(self, tags=True):
+        """The files HEAD (and the tags) are read from, for a build system to depend on
+
+        The directories are included, as refs are added to them as new files.
+        """
+        head_path = os.path.join(self.git_dir, "HEAD")
+        paths = [head_path, os.path.join(self.common_dir, "packed-refs")]
+        with open(head_path) as fh:
+            head = fh.read().strip()
+        if head.startswith("ref:"):
+            ref_path = os.path.join(self.common_dir, head[len("ref:"):].strip())
+            paths.extend([ref_path, os.path.dirname(ref_path)])
+        if tags:
+            for root, _, _ in os.walk(os.path.join(self.common_dir, "refs", "tags")):
+                paths.append(root)
+        return [os.path.normpath(path) for path in paths if os.path.exists(path)]
+
+    def read_object(self, sha):
+        """The type and content of a loose object (or None, if it's packed)"""
+        path = os.path.join(self.common_dir, "objects", sha[:2], sha[2:])
+        try:
+            with open(path, "rb") as fh:
+                data = zlib.decompress(fh.read())
+        except (IOError, OSError):
+            return None
+        header, _, content = data.partition(b"\0")
+        return header.split(b" ")[0].decode("ascii"), content
+
+    def peel(self, sha, ref=None):
+        """The commit a tag object points at (following tags of tags)"""
+        while True:
+            found = self.read_object(sha)
+            if found is None:
+                _LOG.debug("object %s is packed, asking git", sha)
+                return super(RefsBackend, self).resolve(ref or sha)
+            object_type, content = found
+            if object_type != "tag":
+                return sha
+            sha = content.split(b"\n", 1)[0].split(b" ")[1].decode("ascii")
+
+    def head(self):
+        with open(os.path.join(self.git_dir, "HEAD")) as fh:
+            head = fh.read().strip()
+        if not head.startswith("ref:"):
+            # detached
+            return head
+        return self.read_refs()[0].get(head[len("ref:"):].strip())
+
+    def resolve(self, ref):
+        if ref == "HEAD":
+            return self.head()
+        refs, peeled = self.read_refs()
+        for name in (ref, TAGS_PREFIX + ref, "refs/heads/" + ref):
+            if name in peeled:
+                return peeled[name]
+            if name in refs:
+                return self.peel(refs[name], ref)
+        if SHA_REGEX.match(ref):
+            return self.peel(ref)
+        # e.g. an abbreviated commit id, or a relative ref
+        return super(RefsBackend, self).resolve(ref)
+
+    def list_tags(self, pattern="*"):
+        names = (
+            name[len(TAGS_PREFIX):]
+            for name in self.read_refs()[0]
+            if name.startswith(TAGS_PREFIX)
+        )
+        return sorted(name for name in names if fnmatch.fnmatchcase(name, pattern))
+
+    def tag_commits(self):
+        refs, peeled = self.read_refs()
+        return {
+            name[len(TAGS_PREFIX):]: peeled.get(name) or self.peel(sha, name)
+            for name, sha in refs.items()
+            if name.startswith(TAGS_PREFIX)
+        }
+
+    def cache_dir(self):
+        return self.git_dir
+
+    def is_shallow(self):
+        return os.path.exists(os.path.join(self.common_dir, "shallow"))
+
+    # the tags are listed without git
+    tag_stream = Backend.tag_stream
+
+
+class MemoryBackend(Backend):
+    """A repository held in memory
+
+    Each commit holds the full set of paths in it. Commits are made on HEAD,
+    which always points directly at a commit.
+    """
+
+    def __init__(self):
+        self.commits = {}
+        self.tags = {}
+        self.messages = {}
+        self.head_commit = None
+        # made when first needed, and removed along with the backend
+        self._cache_dir = None
+
+    def commit(self, added=(), removed=(), parents=None):
+        """Makes a new commit
+
+        :param added: paths added (or changed)
+        :param removed: paths removed
+        :param parents: commit ids of the parents (default: HEAD)
+        :returns: the commit id
+        """
+        if parents is None:
+            parents = [self.head_commit] if self.head_commit else []
+        files = set()
+        for parent in parents:
+            files.update(self.commits[parent][1])
+        files.update(added)
+        files.difference_update(removed)
+        sha = hashlib.sha1(
+            ("%s %s %r" % (len(self.commits), parents, sorted(files))).encode("utf8")
+        ).hexdigest()
+        self.commits[sha] = (list(parents), frozenset(files))
+        self.head_commit = sha
+        return sha
+
+    def tag(self, tag, ref="HEAD", message=None):
+        """Tags a commit (annotated, if there's a message)"""
+        if tag in self.tags:
+            raise ValueError("tag %r already exists" % tag)
+        commit = self.resolve(ref)
+        if commit is None:
+            raise ValueError("can't tag %r: no such commit" % ref)
+        self.tags[tag] = commit
+        if message is not None:
+            self.messages[tag] = message
+
+    def resolve(self, ref):
+        if ref == "HEAD":
+            return self.head_commit
+        if ref in self.tags:
+            return self.tags[ref]
+        return ref if ref in self.commits else None
+
+    def ancestors(self, ref):
+        """The commits reachable from a ref (including itself)"""
+        seen = set()
+        commit = self.resolve(ref)
+        stack = [commit] if commit else []
+        while stack:
+            sha = stack.pop()
+            if sha not in seen:
+                seen.add(sha)
+                stack.extend(self.commits[sha][0])
+        return seen
+
+    def is_ancestor(self, ancestor, descendant="HEAD"):
+        commit = self.resolve(ancestor)
+        return commit is not None and commit in self.ancestors(descendant)
+
+    def commit_count(self, revision="HEAD", since=None):
+        commits = self.ancestors(revision)
+        if since:
+            commits.difference_update(self.ancestors(since))
+        return len(commits)
+
+    def added_files(self, since, pattern):
+        files = self.commits[self.head_commit][1] - self.commits[self.resolve(since)][1]
+        return sorted(path for path in files if fnmatch.fnmatchcase(path, pattern))
+
+    def list_tags(self, pattern="*"):
+        return sorted(tag for tag in self.tags if fnmatch.fnmatchcase(tag, pattern))
+
+    def root(self):
+        # the files of the commits are found in the current directory
+        return os.getcwd()
+
+    def list_files(self):
+        return sorted(self.commits[self.head_commit][1]) if self.head_commit else []
+
+    def cache_dir(self):
+        if self._cache_dir is None:
+            self._cache_dir = tempfile.TemporaryDirectory(prefix="auto_version")
+        return self._cache_dir.name
+
+    def create_tag(self, tag, message):
+        self.tag(tag, message=message)
+
+    def create_tags(self, tags):
+        existing = [tag for tag, _ in tags if tag in self.tags]
+        if existing:
+            raise ValueError("tags already exist: %s" % ", ".join(existing))
+        for tag, message in tags:
+            self.tag(tag, message=message)
+
+    def commit_graph(self):
+        return CommitGraph(sorted(self.ancestors("HEAD")))
+
+
+def find_work_tree(path):
+    """The top directory of the working tree containing a path, found without git"""
+    path = os.path.abspath(path)
+    while not os.path.exists(os.path.join(path, ".git")):
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise OSError("not in a git repository: %s" % os.getcwd())
+        path = parent
+    return path
+
+
+def find_git_dir(path):
+    """The git directory of the repository containing a path, found without git"""
+    work_tree = find_work_tree(path)
+    candidate = os.path.join(work_tree, ".git")
+    if os.path.isfile(candidate):
+        # a linked worktree, or a submodule
+        with open(candidate) as fh:
+            git_dir = fh.read().strip()[len("gitdir:"):].strip()
+        return os.path.join(work_tree, git_dir)
+    return candidate
+
+
+def find_common_dir(git_dir):
+    """The directory that the worktrees of a repository share (refs, objects, `shallow`)"""
+    common_dir_path = os.path.join(git_dir, "commondir")
+    if os.path.exists(common_dir_path):
+        with open(common_dir_path) as fh:
+            return os.path.join(git_dir, fh.read().strip())
+    return git_dir
+
+
+BACKENDS = {"git": GitBackend, "refs": RefsBackend}
+
+
+def get_backend():
+    """The backend in use: the active one, or as configured"""
+    if _active:
+        return _active[-1]
+    return BACKENDS[config.VCS_BACKEND]()
+
+
+def create_tag(tag, message):
+    """Creates an annotated tag on HEAD, or adds it to the current batch"""
+    if _batches:
+        _batches[-1].append((tag, message))
+    else:
+        get_backend().create_tag(tag, message)
+
+
+@contextlib.contextmanager
+def batched_tags():
+    """Collects the tags created within the block, and creates them all at the end
+
+    The tags are created in one step, and only if the block succeeds.
+    """
+    batch = []
+    _batches.append(batch)
+    try:
+        yield batch
+    finally:
+        _batches.pop()
+    if batch:
+        get_backend().create_tags(batch)
+
+
+@contextlib.contextmanager
+def active(backend):
+    """Uses the backend for all repository access, within the block"""
+    _active.append(backend)
+    try:
+        yield backend
+    finally:
+        _active.pop()
@@ -0,0 +1,90 @@
+"""A small native SemVer engine
+
+Versions are converted once into mutable records, and bumped in place, giving the same
+results as the equivalent `semver` functions without converting to and from strings
+at every step. This keeps computing many versions (e.g. for a what-if matrix) cheap.
+"""
+import re
+
+import semver
+
+LAST_NUMBER = re.compile(r"(\d+)\D*$")
+
+
+def increment_string(string):
+    """Increments the last number in a string, as `semver` does for prerelease and build"""
+    match = LAST_NUMBER.search(string)
+    if match:
+        next_ = str(int(match.group(1)) + 1)
+        start, end = match.span(1)
+        string = string[:max(end - len(next_), start)] + next_ + string[end:]
+    return string
+
+
+class VersionRecord(object):
+    """A mutable SemVer version"""
+
+    __slots__ = ("major", "minor", "patch", "prerelease", "build")
+
+    def __init__(self, major, minor=0, patch=0, prerelease=None, build=None):
+        self.major = major
+        self.minor = minor
+        self.patch = patch
+        self.prerelease = prerelease
+        self.build = build
+
+    @classmethod
+    def from_version(cls, version):
+        """A record of any version-like object (e.g. a semver.VersionInfo)"""
+        return cls(
+            version.major,
+            version.minor,
+            version.patch,
+            version.prerelease,
+            version.build,
+        )
+
+    def to_version_info(self):
+        return semver.VersionInfo(
+            self.major, self.minor, self.patch, self.prerelease, self.build
+        )
+
+    def bump(self, sig_fig, **token_args):
+        """Bumps the given significant figure"""
+        getattr(self, "bump_" + sig_fig)(**token_args)
+
+    def bump_major(self):
+        self.major += 1
+        self.minor = self.patch = 0
+        self.prerelease = self.build = None
+
+    def bump_minor(self):
+        self.minor += 1
+        self.patch = 0
+        self.prerelease = self.build = None
+
+    def bump_patch(self):
+        self.patch += 1
+        self.prerelease = self.build = None
+
+    def bump_prerelease(self, token="rc"):
+        self.prerelease = increment_string(self.prerelease or (token or "rc") + ".0")
+        self.build = None
+
+    def bump_build(self, token="build"):
+        self.build = increment_string(self.build or (token or "build") + ".0")
+
+    def finalize(self):
+        """Removes any prerelease and build, making it a release version"""
+        self.prerelease = self.build = None
+
+    def __str__(self):
+        version = "%d.%d.%d" % (self.major, self.minor, self.patch)
+        if self.prerelease:
+            version += "-%s" % self.prerelease
+        if self.build:
+            version += "+%s" % self.build
+        return version
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, str(self))
@@ -0,0 +1,124 @@
+"""Filesystem change notifications, using inotify
+
+A minimal ctypes wrapper, so there's no extra dependency. Waiting for events blocks
+on the inotify file descriptor (no polling), so changes are seen within milliseconds.
+Only available on Linux.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+
+_LOG = logging.getLogger(__file__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+# a file was written, or appeared or disappeared from a directory
+CHANGE_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 1 << 16
+
+
+def is_supported():
+    """Whether inotify is available on this platform"""
+    return sys.platform.startswith("linux")
+
+
+class Inotify(object):
+    """An inotify instance, watching a set of directories"""
+
+    def __init__(self):
+        if not is_supported():
+            raise OSError("inotify is not supported on %s" % sys.platform)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise("inotify_init1")
+        self._paths = {}
+
+    def _raise(self, name):
+        code = ctypes.get_errno()
+        raise OSError(code, "%s: %s" % (name, os.strerror(code)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    @property
+    def paths(self):
+        """The watched directories"""
+        return set(self._paths.values())
+
+    def add_watch(self, path, mask=CHANGE_MASK):
+        """Watches a directory for changes to the files in it
+
+        :returns: True if the directory is now watched
+        """
+        descriptor = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask | IN_ONLYDIR
+        )
+        if descriptor < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                _LOG.debug("not watching %s: not a directory", path)
+                return False
+            self._raise("inotify_add_watch")
+        self._paths[descriptor] = path
+        return True
+
+    def read_events(self, timeout=None):
+        """Waits for changes, and returns all those that have arrived
+
+        :param timeout: seconds to wait (default: forever)
+        :returns: list of (path of the changed file, event mask)
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            directory = self._paths.get(descriptor)
+            if mask & IN_IGNORED:
+                # the watch was removed, e.g. the directory was deleted
+                self._paths.pop(descriptor, None)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            events.append((path, mask))
+        return events